@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.convertors import Convertor, register_url_convertor
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+import uvicorn
+
+DEFAULT_WSGI_WORKERS = 32
+
+class SignedIntConvertor(Convertor):
+    """Конвертер пути Starlette для положительных и отрицательных целых (аналог 'sint' во Flask)."""
+    regex = "-?[0-9]+"
+
+    def convert(self, value: str) -> int:
+        return int(value)
+
+    def to_string(self, value: int) -> str:
+        return str(int(value))
+
+register_url_convertor("sint", SignedIntConvertor())
+
+def flask_response_to_asgi(flask_response) -> Response:
+    """Переносит готовый ответ Flask/Werkzeug (тело, статус, все заголовки и cookie) в ответ Starlette."""
+    response = Response(content=flask_response.get_data(), status_code=flask_response.status_code)
+    response.raw_headers = [
+        (name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, value in flask_response.headers.items()
+    ]
+    return response
+
+def _call_in_flask_context(flask_app, environ_args: dict, view_func, args, kwargs):
+    with flask_app.test_request_context(**environ_args):
+        flask_response = flask_app.make_response(view_func(*args, **kwargs))
+        flask_response = flask_app.process_response(flask_response)
+    return flask_response_to_asgi(flask_response)
+
+async def render_in_flask_context(flask_app, request, view_func, *args, **kwargs) -> Response:
+    """
+    Вызывает синхронную функцию отрисовки Flask (render_template, flash, session, url_for)
+    в контексте, собранном из запроса ASGI, и возвращает ответ Starlette.
+    Сессия и flash-сообщения читаются из cookie запроса и сохраняются обратно в ответ.
+    Отрисовка выполняется в пуле потоков, чтобы не блокировать цикл событий Telethon.
+    """
+    root_path = request.scope.get("root_path", "")
+    environ_args = {
+        "path": request.url.path[len(root_path):],
+        "base_url": f"{request.url.scheme}://{request.url.netloc}{root_path}",
+        "query_string": request.url.query,
+        "method": request.method,
+        "headers": list(request.headers.items()),
+    }
+    return await run_in_threadpool(_call_in_flask_context, flask_app, environ_args, view_func, args, kwargs)
+
+def create_asgi_app(flask_app, native_routes: list, wsgi_workers: int = DEFAULT_WSGI_WORKERS) -> Starlette:
+    """
+    Собирает ASGI-приложение: маршруты из native_routes обрабатываются асинхронно
+    в цикле событий, все остальные URL передаются в исходное Flask-приложение
+    (через WSGIMiddleware с пулом из wsgi_workers потоков).
+    """
+    routes = [Route(path, endpoint, methods=methods) for path, endpoint, methods in native_routes]
+    routes.append(Mount("/", app=WSGIMiddleware(flask_app, workers=wsgi_workers)))
+    return Starlette(routes=routes)
+
+async def serve_asgi_app(asgi_app, host: str, port: int):
+    """Запускает uvicorn в текущем цикле событий и возвращается после его остановки (Ctrl+C)."""
+    config = uvicorn.Config(asgi_app, host=host, port=port, loop="none", lifespan="off", log_level="warning")
+    server = uvicorn.Server(config)
+    logging.info(f"ASGI-сервер запускается на http://{host}:{port} (цикл событий: {asyncio.get_running_loop()})")
+    await server.serve()
+    logging.info("ASGI-сервер остановлен.")
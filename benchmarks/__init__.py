@@ -0,0 +1,11 @@
+"""
+Бенчмарки TeekaGramAi, которые не требуют живого аккаунта Telegram и ключа Gemini.
+
+  fakes.py  - заменители TelegramClient и клиента google.genai с синтетическими историями
+              и настраиваемой задержкой;
+  suite.py  - набор воспроизводимых бенчмарков горячих путей с выводом результатов в JSON
+              (python -m benchmarks.suite);
+  load_test_auto_mode.py - нагрузочный тест авто-режима от 1 до сотен чатов: задержка ответа,
+              потоки, память и частота вызовов API (python -m benchmarks.load_test_auto_mode);
+  bench_*.py - отдельные сравнительные бенчмарки (python benchmarks/bench_<имя>.py).
+"""
@@ -0,0 +1,122 @@
+"""
+Бенчмарк поиска эмодзи: префиксное дерево (text_utils.find_emoji_spans и др.)
+против прежней огромной альтернации из всех ключей emoji.EMOJI_DATA.
+
+Измеряются:
+  - время импорта text_utils и подготовки поиска (без кэша на диске и с ним);
+  - время одного вызова поиска / обрезки серий / схлопывания повторов. Серии ограничиваются
+    тем же text_utils.limit_emoji_runs, что и в final_fine_tune_sms (вместе с разбором на токены).
+
+Запуск из корня проекта:
+    python benchmarks/bench_emoji_scanner.py
+"""
+import os
+import re
+import sys
+import time
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import text_utils
+from benchmarks.bench_text_processing import make_long_reply
+
+SIZES_KB = (1, 4, 16)
+ITERATIONS = 50
+IMPORT_RUNS = 5
+
+LEGACY_SETUP = """
+import re, emoji
+pattern = re.compile("({})".format("|".join(re.escape(e) for e in sorted(emoji.EMOJI_DATA.keys(), key=len, reverse=True))))
+"""
+TRIE_SETUP = """
+import text_utils
+text_utils.load_emoji_trie()
+"""
+
+def time_subprocess(code, runs=IMPORT_RUNS, before_each=None):
+    """Среднее время (мс) выполнения кода в новом интерпретаторе, за вычетом пустого запуска."""
+    def run_once(snippet):
+        if before_each:
+            before_each()
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", snippet], cwd=ROOT_DIR, check=True)
+        return time.perf_counter() - start
+
+    baseline = min(run_once("pass") for _ in range(runs))
+    samples = [run_once(code) for _ in range(runs)]
+    return (sum(samples) / len(samples) - baseline) * 1000.0
+
+def remove_trie_cache():
+    try:
+        os.remove(os.path.join(ROOT_DIR, text_utils.EMOJI_TRIE_CACHE_FILE))
+    except FileNotFoundError:
+        pass
+
+def build_legacy_pattern():
+    import emoji
+    return re.compile(
+        "({})".format("|".join(re.escape(e) for e in sorted(emoji.EMOJI_DATA.keys(), key=len, reverse=True)))
+    )
+
+def bench(func, text, iterations=ITERATIONS):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(text)
+    return (time.perf_counter() - start) / iterations * 1000.0
+
+def main():
+    print("Импорт и подготовка поиска эмодзи (новый процесс):")
+    legacy_ms = time_subprocess(LEGACY_SETUP)
+    cold_ms = time_subprocess(TRIE_SETUP, before_each=remove_trie_cache)
+    warm_ms = time_subprocess(TRIE_SETUP)
+    print(f"  прежний EMOJI_PATTERN:        {legacy_ms:8.1f} мс")
+    print(f"  дерево, сборка без кэша:      {cold_ms:8.1f} мс")
+    print(f"  дерево, загрузка из кэша:     {warm_ms:8.1f} мс (x{legacy_ms / warm_ms:.1f})")
+
+    legacy_pattern = build_legacy_pattern()
+    text_utils.load_emoji_trie()
+
+    def legacy_spans(text):
+        return [m.span() for m in legacy_pattern.finditer(text)]
+
+    def legacy_collapse(text):
+        return re.sub(f'{legacy_pattern.pattern}\\1{{5,}}', lambda m: m.group(1) * 5, text)
+
+    def legacy_truncate(text):
+        return re.sub(f'(?:{legacy_pattern.pattern}){{15,}}',
+                      lambda m: ''.join(legacy_pattern.findall(m.group(0))[:14]), text)
+
+    def legacy_collapse_uncached(text):
+        re.purge()
+        return legacy_collapse(text)
+
+    def collapse_repeats(text):
+        return text_utils.tokens_to_text(text_utils.limit_emoji_runs(text_utils.tokenize_text(text), max_run=None))
+
+    def truncate_runs(text):
+        return text_utils.tokens_to_text(text_utils.limit_emoji_runs(text_utils.tokenize_text(text), max_repeat=None))
+
+    cases = (
+        ("поиск эмодзи", legacy_spans, text_utils.find_emoji_spans),
+        ("схлопывание повторов", legacy_collapse, collapse_repeats),
+        ("обрезка серий", legacy_truncate, truncate_runs),
+        ("схлопывание, вне кэша re", legacy_collapse_uncached, collapse_repeats),
+    )
+
+    print("\nВремя одного вызова:")
+    for size_kb in SIZES_KB:
+        # tokenize_text заодно сокращает повторы обычных символов; текст сокращается заранее,
+        # чтобы сравнение с прежними регулярками касалось только эмодзи.
+        text = text_utils.tokens_to_text(text_utils.tokenize_text(make_long_reply(size_kb)))
+        for name, legacy_func, new_func in cases:
+            same = "совпадает" if legacy_func(text) == new_func(text) else "ОТЛИЧАЕТСЯ"
+            iterations = 3 if legacy_func is legacy_collapse_uncached else ITERATIONS
+            legacy_call_ms = bench(legacy_func, text, iterations)
+            new_call_ms = bench(new_func, text, iterations)
+            print(f"  {size_kb:>3} KB, {name:<26} прежний {legacy_call_ms:9.3f} мс, "
+                  f"дерево {new_call_ms:8.3f} мс (x{legacy_call_ms / new_call_ms:.1f}), результат {same}")
+
+if __name__ == "__main__":
+    main()
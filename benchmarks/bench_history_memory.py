@@ -0,0 +1,117 @@
+"""
+Бенчмарк памяти форматирования истории на 1 000 и 10 000 сообщений (окно CHAT_LIMIT).
+
+Сравниваются:
+  - промежуточные записи: прежние словари (с _original_msg, _sender_id, _msg_id,
+    _reactions_to_prepend) против HistoryRecord (dataclass со slots=True);
+  - группировка: прежнее наращивание part['text'] += ... против списка-буфера и join;
+  - пиковая память всего конвейера history_pipeline.format_history.
+
+Запуск из корня проекта:
+    python benchmarks/bench_history_memory.py
+"""
+import os
+import sys
+import time
+import asyncio
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history_pipeline
+from benchmarks.bench_history_pipeline import make_messages, sender_name, no_media, MY_ID, CHAT_ID
+
+SIZES = (1000, 10000)
+GROUP_THRESHOLD_MINUTES = 4.5
+
+def measure(func, *args):
+    """(результат, прирост удерживаемой памяти в байтах, пик в байтах) для вызова func."""
+    tracemalloc.start()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+def timed(func, *args):
+    """Время вызова в мс (без tracemalloc, который сильно замедляет код)."""
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000.0
+
+def build_records(messages):
+    records = history_pipeline.normalize_messages(messages, MY_ID, True, {}, {}, sender_name)
+    asyncio.run(history_pipeline.enrich_media(records, CHAT_ID, False, no_media))
+    history_pipeline.build_text_blocks(records)
+    return records
+
+def legacy_intermediate(messages, records):
+    """Промежуточный список в прежнем формате: словарь со ссылкой на Message на каждое сообщение."""
+    messages_by_id = {msg.id: msg for msg in messages}
+    return [{
+        "role": record.role, "parts": [dict(part) for part in record.parts], "is_media": record.is_media,
+        "_original_msg": messages_by_id[record.msg_id], "_sender_id": record.sender_id, "_msg_id": record.msg_id,
+        "_reactions_to_prepend": []
+    } for record in records]
+
+def compact_intermediate(messages, records):
+    """Те же сообщения в виде HistoryRecord (копии, чтобы мерить только их выделение)."""
+    return [history_pipeline.HistoryRecord(
+        record.msg_id, record.sender_id, record.role, record.date, record.header, record.sender_prefix,
+        record.has_id_header, record.text, parts=[dict(part) for part in record.parts], is_media=record.is_media,
+    ) for record in records]
+
+def legacy_group(items, messages):
+    """Прежняя группировка: текст группы наращивается через += на каждом сообщении."""
+    messages_by_id = {msg.id: msg for msg in messages}
+    group_delta = timedelta(minutes=GROUP_THRESHOLD_MINUTES)
+    groups = []
+    for item in items:
+        msg = messages_by_id[item["_msg_id"]]
+        if groups:
+            last = groups[-1]
+            last_msg = last["_original_msg"]
+            if (not item["is_media"] and not last["is_media"] and item["role"] == last["role"] and
+                    msg.sender_id == last_msg.sender_id and (msg.date - last_msg.date) < group_delta):
+                for part in last["parts"]:
+                    if 'text' in part:
+                        part["text"] += f"{history_pipeline.SPLIT_SEPARATOR}{item['parts'][0]['text']}"
+                        break
+                last["_original_msg"] = msg
+                continue
+        groups.append(item)
+    return groups
+
+def format_full(messages):
+    return asyncio.run(history_pipeline.format_history(
+        messages, CHAT_ID, MY_ID, {}, False, GROUP_THRESHOLD_MINUTES,
+        sticker_codenames={}, sender_name=sender_name, load_media=no_media,
+    ))
+
+def kib(size_bytes):
+    return size_bytes / 1024.0
+
+def main():
+    for size in SIZES:
+        messages = make_messages(size)
+        records = build_records(messages)
+        print(f"{size} сообщений:")
+
+        _, legacy_bytes, _ = measure(legacy_intermediate, messages, records)
+        _, compact_bytes, _ = measure(compact_intermediate, messages, records)
+        print(f"  промежуточные записи: словари {kib(legacy_bytes):9.1f} КиБ ({legacy_bytes / size:5.0f} Б/сообщ.), "
+              f"HistoryRecord {kib(compact_bytes):9.1f} КиБ ({compact_bytes / size:5.0f} Б/сообщ.)")
+
+        _, _, legacy_peak = measure(legacy_group, legacy_intermediate(messages, records), messages)
+        _, _, compact_peak = measure(history_pipeline.group_records, build_records(messages), GROUP_THRESHOLD_MINUTES)
+        legacy_ms = timed(legacy_group, legacy_intermediate(messages, records), messages)
+        compact_ms = timed(history_pipeline.group_records, build_records(messages), GROUP_THRESHOLD_MINUTES)
+        print(f"  группировка: += пик {kib(legacy_peak):8.1f} КиБ, {legacy_ms:7.2f} мс; "
+              f"join пик {kib(compact_peak):8.1f} КиБ, {compact_ms:7.2f} мс")
+
+        _, retained, peak = measure(format_full, messages)
+        elapsed_ms = timed(format_full, messages)
+        print(f"  format_history целиком: пик {kib(peak):9.1f} КиБ, результат {kib(retained):9.1f} КиБ, {elapsed_ms:7.1f} мс")
+
+if __name__ == "__main__":
+    main()
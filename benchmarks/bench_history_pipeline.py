@@ -0,0 +1,123 @@
+"""
+Бенчмарк конвейера форматирования истории (history_pipeline): время каждой стадии
+на синтетических сообщениях Telethon, а также сравнение линейной привязки реакций
+с прежним вложенным поиском следующего сообщения автора реакции.
+
+Запуск из корня проекта:
+    python benchmarks/bench_history_pipeline.py
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telethon.tl.types import (
+    Message, PeerUser, PeerChannel, MessageReplyHeader, MessageReactions, MessagePeerReaction,
+    ReactionEmoji, ReactionCount, MessageMediaPhoto, Photo, PhotoSize
+)
+import history_pipeline
+
+SIZES = (1000, 10000)
+MY_ID = 1000
+CHAT_ID = -1001
+SENDERS = (MY_ID, 11, 12, 13, 14, 15, 16, 17)
+SILENT_REACTORS = (901, 902, 903)
+SEED = 7
+
+def make_messages(count, seed=SEED):
+    """Сообщения группы от новых к старым (как их отдает get_messages): текст, ответы, фото и реакции."""
+    rng = random.Random(seed)
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for msg_id in range(1, count + 1):
+        date += timedelta(seconds=rng.choice((5, 30, 120, 600)))
+        media = None
+        if rng.random() < 0.05:
+            media = MessageMediaPhoto(photo=Photo(id=msg_id, access_hash=1, file_reference=b'', date=date,
+                                                  sizes=[PhotoSize(type='x', w=1, h=1, size=1)], dc_id=1))
+        reactions = None
+        if rng.random() < 0.3:
+            reactors = SENDERS + SILENT_REACTORS
+            recent = [MessagePeerReaction(peer_id=PeerUser(rng.choice(reactors)), date=date,
+                                          reaction=ReactionEmoji(emoticon=rng.choice("👍❤🔥")))
+                      for _ in range(rng.randint(1, 3))]
+            reactions = MessageReactions(results=[ReactionCount(reaction=ReactionEmoji(emoticon='👍'), count=1)],
+                                         recent_reactions=recent)
+        reply_to = MessageReplyHeader(reply_to_msg_id=rng.randint(1, msg_id)) if rng.random() < 0.1 else None
+        messages.append(Message(id=msg_id, peer_id=PeerChannel(1), date=date, message="сообщение " * rng.randint(1, 20),
+                                media=media, reply_to=reply_to, from_id=PeerUser(rng.choice(SENDERS)),
+                                reactions=reactions))
+    messages.reverse()
+    return messages
+
+def sender_name(msg):
+    return f"User_{msg.sender_id}"
+
+async def no_media(msg_id):
+    return None, "benchmark"
+
+def legacy_attribute_reactions(records, reactions_by_msg_id):
+    """
+    Прежняя привязка реакций: для каждой реакции поиск вперед по списку до сообщения ее автора.
+    Возвращает списки команд react(...) по индексам records.
+    """
+    reactions_to_prepend = [[] for _ in records]
+    msg_id_to_index = {record.msg_id: i for i, record in enumerate(records)}
+    for reacted_on_msg_id, reactions in reactions_by_msg_id.items():
+        if reacted_on_msg_id not in msg_id_to_index:
+            continue
+        start_index = msg_id_to_index[reacted_on_msg_id]
+        for reactor_id, emoji in reactions:
+            reaction_command = f"react({reacted_on_msg_id})[{emoji}]"
+            for i in range(start_index + 1, len(records)):
+                if records[i].sender_id == reactor_id:
+                    if reaction_command not in reactions_to_prepend[i]:
+                        reactions_to_prepend[i].append(reaction_command)
+                    break
+    return reactions_to_prepend
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000.0
+
+def prepare_records(messages, reactions_by_msg_id):
+    records = history_pipeline.normalize_messages(messages, MY_ID, True, {}, {}, sender_name)
+    asyncio.run(history_pipeline.enrich_media(records, CHAT_ID, False, no_media))
+    history_pipeline.build_text_blocks(records)
+    return records
+
+def main():
+    for size in SIZES:
+        messages = make_messages(size)
+        print(f"{size} сообщений:")
+
+        reactions_by_msg_id, extract_ms = timed(history_pipeline.extract_reactions, messages)
+        records, normalize_ms = timed(history_pipeline.normalize_messages, messages, MY_ID, True, {}, {}, sender_name)
+        _, enrich_ms = timed(asyncio.run, history_pipeline.enrich_media(records, CHAT_ID, False, no_media))
+        _, build_ms = timed(history_pipeline.build_text_blocks, records)
+        _, reactions_ms = timed(history_pipeline.attribute_reactions, records, reactions_by_msg_id)
+        groups, group_ms = timed(history_pipeline.group_records, records, 4.5)
+        _, render_ms = timed(history_pipeline.render_records, groups)
+
+        for name, stage_ms in (("extract_reactions", extract_ms), ("normalize_messages", normalize_ms),
+                               ("enrich_media", enrich_ms), ("build_text_blocks", build_ms),
+                               ("attribute_reactions", reactions_ms), ("group_records", group_ms),
+                               ("render_records", render_ms)):
+            print(f"  {name:<22} {stage_ms:9.2f} мс")
+        print(f"  блоков после группировки: {len(groups)}")
+
+        legacy_records = prepare_records(messages, reactions_by_msg_id)
+        linear_records = prepare_records(messages, reactions_by_msg_id)
+        legacy_reactions, legacy_ms = timed(legacy_attribute_reactions, legacy_records, reactions_by_msg_id)
+        _, linear_ms = timed(history_pipeline.attribute_reactions, linear_records, reactions_by_msg_id)
+        same = legacy_reactions == [record.reactions or [] for record in linear_records]
+        print(f"  привязка реакций: прежняя {legacy_ms:9.2f} мс, линейная {linear_ms:8.2f} мс "
+              f"(x{legacy_ms / linear_ms:.1f}), результат {'совпадает' if same else 'ОТЛИЧАЕТСЯ'}")
+
+if __name__ == "__main__":
+    main()
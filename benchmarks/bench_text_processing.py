@@ -0,0 +1,108 @@
+"""
+Бенчмарк финальной обработки текста (final_fine_tune_sms) на длинных ответах.
+Сравнивает текущую реализацию с прежней цепочкой re.sub.
+
+Запуск из корня проекта:
+    python benchmarks/bench_text_processing.py
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emoji
+import text_utils
+
+SIZES_KB = (1, 4, 16)
+ITERATIONS = 20
+
+_legacy_emoji_pattern = None
+
+def legacy_final_fine_tune_sms(comment, substitution_chance=0.005, transposition_chance=0.005,
+                               skip_chance=0.002, lower_chance=0.01, word_loss_chance=0.0, max_lost_words=0):
+    """Прежняя реализация: восемь проходов re.sub и посимвольная проверка emoji.is_emoji."""
+    global _legacy_emoji_pattern
+    if _legacy_emoji_pattern is None:
+        _legacy_emoji_pattern = re.compile(
+            "({})".format("|".join(re.escape(e) for e in sorted(emoji.EMOJI_DATA.keys(), key=len, reverse=True)))
+        )
+    emoji_pattern = _legacy_emoji_pattern
+
+    if not comment:
+        return "", ""
+    cleaned_comment = comment.replace('&quot;', '"')
+    cleaned_comment = cleaned_comment.replace('—', '-')
+    cleaned_comment = re.sub(r"<\s*ник\s*:.*?>", '', cleaned_comment, flags=re.IGNORECASE)
+    cleaned_comment = re.sub(r'^\[\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}\]\s*', '', cleaned_comment, flags=re.MULTILINE)
+    cleaned_comment = re.sub(r'\s*\(\s*(U?ID)\s*:\s*\d+\s*\)\s*', ' ', cleaned_comment, flags=re.IGNORECASE)
+    cleaned_comment = re.sub(r'(.)\1{45,}', lambda m: m.group(1) * 25, cleaned_comment)
+    cleaned_comment = re.sub(f'{emoji_pattern.pattern}\\1{{5,}}', lambda m: m.group(1) * 5, cleaned_comment)
+
+    def truncate_emoji_sequence(match):
+        return ''.join(emoji_pattern.findall(match.group(0))[:14])
+
+    cleaned_comment = re.sub(f'(?:{emoji_pattern.pattern}){{15,}}', truncate_emoji_sequence, cleaned_comment)
+
+    last_significant_char_index = -1
+    for i in range(len(cleaned_comment) - 1, -1, -1):
+        char = cleaned_comment[i]
+        if not char.isspace() and not emoji.is_emoji(char):
+            last_significant_char_index = i
+            break
+    if last_significant_char_index != -1 and cleaned_comment[last_significant_char_index] == '.':
+        if last_significant_char_index == 0 or cleaned_comment[last_significant_char_index - 1] != '.':
+            cleaned_comment = cleaned_comment[:last_significant_char_index] + cleaned_comment[last_significant_char_index + 1:]
+
+    text_with_typos = text_utils.make_human_like_typos(cleaned_comment, substitution_chance, transposition_chance, skip_chance, lower_chance)
+    return text_utils.simulate_word_loss(text_with_typos, word_loss_chance, max_lost_words)
+
+def make_long_reply(size_kb, seed=42):
+    """Собирает синтетический ответ модели примерно заданного размера."""
+    rng = random.Random(seed)
+    fragments = [
+        "Привет, как дела? Я тут подумала о нашем разговоре.",
+        "Well, that's actually a pretty interesting point, honestly.",
+        "Ахахаха 😂😂😂😂😂😂😂😂",
+        "<ник:Вася> ну да",
+        "[2024-05-01 12:30:45] вот это поворот",
+        "кстати (ID: 12345) я это уже видела",
+        "🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥🔥",
+        "ммммммммммммммммммммммммммммммммммммммммммммммммммм",
+        "Ну и ладно...",
+        "&quot;цитата&quot; — и всё",
+        "❤️👍🎉 класс!",
+    ]
+    parts = []
+    total = 0
+    while total < size_kb * 1024:
+        fragment = rng.choice(fragments)
+        parts.append(fragment)
+        total += len(fragment.encode('utf-8')) + 1
+    return "\n".join(parts) + "."
+
+def bench(func, text, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(text, 0.005, 0.005, 0.002, 0.05)
+    return (time.perf_counter() - start) / iterations * 1000.0
+
+def main():
+    legacy_final_fine_tune_sms("прогрев")
+    text_utils.final_fine_tune_sms("прогрев")
+
+    for size_kb in SIZES_KB:
+        text = make_long_reply(size_kb)
+        legacy_clean, _ = legacy_final_fine_tune_sms(text, 0, 0, 0, 0)
+        new_clean, _ = text_utils.final_fine_tune_sms(text, 0, 0, 0, 0)
+        same = "совпадает" if legacy_clean == new_clean else "ОТЛИЧАЕТСЯ"
+
+        legacy_ms = bench(legacy_final_fine_tune_sms, text, ITERATIONS)
+        new_ms = bench(text_utils.final_fine_tune_sms, text, ITERATIONS)
+        print(f"{size_kb:>3} KB: прежняя {legacy_ms:8.2f} мс, новая {new_ms:8.2f} мс "
+              f"(x{legacy_ms / new_ms:.1f}), результат без опечаток {same}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Бенчмарк движка опечаток (text_utils.make_human_like_typos).
+Показывает время одного вызова на длинных ответах и проверяет, что при одинаковом
+seed генератора результат воспроизводится.
+
+Запуск из корня проекта:
+    python benchmarks/bench_typos.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import text_utils
+from benchmarks.bench_text_processing import make_long_reply
+
+SIZES_KB = (1, 4, 16)
+ITERATIONS = 50
+SEED = 12345
+CHANCES = (0.005, 0.005, 0.002, 0.05)
+
+def bench(text, iterations=ITERATIONS):
+    rng = np.random.default_rng(SEED)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        text_utils.make_human_like_typos(text, *CHANCES, rng=rng)
+    return (time.perf_counter() - start) / iterations * 1000.0
+
+def main():
+    for size_kb in SIZES_KB:
+        text = make_long_reply(size_kb)
+        first = text_utils.make_human_like_typos(text, *CHANCES, rng=np.random.default_rng(SEED))
+        second = text_utils.make_human_like_typos(text, *CHANCES, rng=np.random.default_rng(SEED))
+        reproducible = "воспроизводится" if first == second else "НЕ воспроизводится"
+        print(f"{size_kb:>3} KB: {bench(text):7.3f} мс на вызов, результат с одним seed {reproducible}")
+
+if __name__ == "__main__":
+    main()
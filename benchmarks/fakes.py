@@ -0,0 +1,264 @@
+"""
+Заменители внешних сервисов для офлайн-бенчмарков.
+
+FakeTelegramClient - минимальный TelegramClient, который отдает синтетическую историю
+(make_history: текст, ответы, реакции, фото, стикеры, группы с большим числом участников),
+"загружает" медиа и записывает отправленные сообщения. start_fake_telegram регистрирует
+аккаунт с этим клиентом и запускает цикл telegram_loop в отдельном потоке, как это делает main.py.
+
+FakeGenaiClient - заменитель google.genai.Client: models.generate_content отвечает заданным
+текстом через latency_s секунд.
+"""
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.types import (
+    Message, PeerUser, PeerChannel, MessageReplyHeader, MessageReactions, MessagePeerReaction,
+    ReactionEmoji, ReactionCount, MessageMediaPhoto, Photo, PhotoSize, MessageMediaDocument, Document,
+    DocumentAttributeSticker, InputStickerSetEmpty, User
+)
+
+import telegram_utils
+
+ME_ID = 1000
+GROUP_CHAT_ID = -1001
+PRIVATE_CHAT_ID = 11
+SEED = 7
+STICKER_IDS = (900, 901, 902)
+FAKE_MEDIA_BYTES = b"\xff\xd8\xff" + b"\0" * 20 * 1024
+HISTORY_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def make_history(count, chat_id=GROUP_CHAT_ID, senders=None, seed=SEED, photo_share=0.05,
+                 sticker_share=0.03, reaction_share=0.3, reply_share=0.1, latest_from=None):
+    """
+    Синтетическая история чата от новых сообщений к старым (как ее отдает get_messages).
+    senders - ID отправителей (по умолчанию: в группе 30 участников и бот, в личке собеседник и бот);
+    latest_from - отправитель самого нового сообщения (по умолчанию первый не-бот из senders).
+    """
+    rng = random.Random(seed)
+    if senders is None:
+        senders = (ME_ID,) + (tuple(range(11, 41)) if chat_id < 0 else (chat_id,))
+    peer = PeerChannel(-chat_id) if chat_id < 0 else PeerUser(chat_id)
+    if latest_from is None:
+        latest_from = next(sender for sender in senders if sender != ME_ID)
+
+    date = HISTORY_START
+    messages = []
+    for msg_id in range(1, count + 1):
+        date += timedelta(seconds=rng.choice((5, 30, 120, 600)))
+        sender = latest_from if msg_id == count else rng.choice(senders)
+        text = "сообщение " * rng.randint(1, 20)
+        media = None
+        roll = rng.random()
+        if roll < photo_share:
+            media = MessageMediaPhoto(photo=Photo(id=msg_id, access_hash=1, file_reference=b'', date=date,
+                                                  sizes=[PhotoSize(type='x', w=1, h=1, size=len(FAKE_MEDIA_BYTES))], dc_id=1))
+        elif roll < photo_share + sticker_share:
+            media = MessageMediaDocument(document=Document(
+                id=rng.choice(STICKER_IDS), access_hash=1, file_reference=b'', date=date, mime_type='image/webp',
+                size=1, dc_id=1, attributes=[DocumentAttributeSticker(alt='🙂', stickerset=InputStickerSetEmpty())]))
+            text = ""
+        reactions = None
+        if rng.random() < reaction_share:
+            recent = [MessagePeerReaction(peer_id=PeerUser(rng.choice(senders)), date=date,
+                                          reaction=ReactionEmoji(emoticon=rng.choice("👍❤🔥")))
+                      for _ in range(rng.randint(1, 3))]
+            reactions = MessageReactions(results=[ReactionCount(reaction=ReactionEmoji(emoticon='👍'), count=1)],
+                                         recent_reactions=recent)
+        reply_to = MessageReplyHeader(reply_to_msg_id=rng.randint(1, msg_id)) if rng.random() < reply_share else None
+        messages.append(Message(id=msg_id, peer_id=peer, date=date, message=text, out=sender == ME_ID, media=media,
+                                reply_to=reply_to, from_id=PeerUser(sender), reactions=reactions))
+    messages.reverse()
+    return messages
+
+class _FakeAction:
+    """Результат client.action(): работает и как async with (печать), и как await (отмена)."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __await__(self):
+        return asyncio.sleep(0).__await__()
+
+class FakeTelegramClient:
+    """
+    Заменитель TelegramClient для бенчмарков. histories - {chat_id: сообщения от новых к старым};
+    latency_s - задержка каждого сетевого вызова (get_messages, download_media, send_message...).
+    calls считает сетевые вызовы по ключу (метод, chat_id); on_send(chat_id, text), если задан,
+    вызывается при каждой отправке. Все методы выполняются только в цикле telegram_loop.
+    """
+
+    def __init__(self, histories, me_id=ME_ID, latency_s=0.0, media_bytes=FAKE_MEDIA_BYTES):
+        self.me_id = me_id
+        self.latency_s = latency_s
+        self.parse_mode = None
+        self.media_bytes = media_bytes
+        self.histories = {}
+        self.sent_messages = []
+        self.calls = Counter()
+        self.on_send = None
+        self.sent_condition = threading.Condition()
+        self.connected = True
+        self._disconnected = None
+        for chat_id, messages in histories.items():
+            self.set_history(chat_id, messages)
+
+    def set_history(self, chat_id, messages):
+        """Заменяет историю чата (копией списка, чтобы отправленные сообщения не попадали в исходный)."""
+        for msg in messages:
+            msg._client = self
+        self.histories[chat_id] = list(messages)
+
+    async def _network(self, method=None, chat_id=None):
+        if method:
+            self.calls[(method, chat_id)] += 1
+        await asyncio.sleep(self.latency_s)
+
+    def _new_message(self, chat_id, text, sender_id, reply_to=None):
+        history = self.histories.setdefault(chat_id, [])
+        msg = Message(id=(history[0].id + 1) if history else 1, peer_id=PeerUser(chat_id) if chat_id > 0 else PeerChannel(-chat_id),
+                      date=datetime.now(timezone.utc), message=text, out=sender_id == self.me_id, from_id=PeerUser(sender_id),
+                      reply_to=MessageReplyHeader(reply_to_msg_id=reply_to) if reply_to else None)
+        msg._client = self
+        history.insert(0, msg)
+        return msg
+
+    def receive_message(self, chat_id, sender_id, text):
+        """Входящее сообщение от sender_id с текущим временем. Вызывать в цикле telegram_loop (call_soon_threadsafe)."""
+        return self._new_message(chat_id, text, sender_id)
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self):
+        return User(id=self.me_id, first_name="Bench")
+
+    async def get_entity(self, peer_id):
+        await self._network("get_entity", peer_id)
+        if peer_id < 0:
+            return SimpleNamespace(id=-peer_id, title=f"Группа {-peer_id}", broadcast=False, username=None)
+        return User(id=peer_id, first_name=f"User_{peer_id}")
+
+    async def get_messages(self, chat_id, limit=None, offset_id=0, ids=None):
+        await self._network("get_messages", chat_id)
+        history = self.histories.get(chat_id, [])
+        if ids is not None:
+            by_id = {msg.id: msg for msg in history}
+            return [by_id.get(msg_id) for msg_id in ids] if isinstance(ids, list) else by_id.get(ids)
+        if offset_id:
+            history = [msg for msg in history if msg.id < offset_id]
+        return history[:limit] if limit else list(history)
+
+    async def get_dialogs(self, limit=None):
+        await self._network()
+        return []
+
+    async def download_media(self, message, file=None, **kwargs):
+        await self._network("download_media", getattr(message, "chat_id", None))
+        return self.media_bytes
+
+    def action(self, chat_id, action, **kwargs):
+        return _FakeAction()
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        await self._network("send_message", chat_id)
+        msg = self._new_message(chat_id, text, self.me_id, reply_to=reply_to)
+        if self.on_send:
+            self.on_send(chat_id, text)
+        with self.sent_condition:
+            self.sent_messages.append((chat_id, text))
+            self.sent_condition.notify_all()
+        return msg
+
+    def wait_for_sent(self, count, timeout=30):
+        """Ждет (в вызывающем потоке), пока отправленных сообщений станет не меньше count."""
+        with self.sent_condition:
+            return self.sent_condition.wait_for(lambda: len(self.sent_messages) >= count, timeout=timeout)
+
+    async def edit_message(self, peer, message_id, text=None, **kwargs):
+        await self._network()
+
+    async def send_file(self, chat_id, file, **kwargs):
+        await self._network("send_file", chat_id)
+
+    async def send_read_acknowledge(self, *args, **kwargs):
+        await self._network()
+
+    async def __call__(self, request):
+        await self._network()
+
+    def add_event_handler(self, *args, **kwargs):
+        pass
+
+    async def run_until_disconnected(self):
+        self._disconnected = asyncio.Event()
+        await self._disconnected.wait()
+
+    async def disconnect(self):
+        self.connected = False
+        if self._disconnected:
+            self._disconnected.set()
+
+def start_fake_telegram(client, key="bench", media_cache_dir="media_cache/bench"):
+    """
+    Регистрирует аккаунт key с клиентом client и запускает цикл telegram_loop в фоновом потоке.
+    Аккаунт становится текущим для вызывающего потока. Возвращает TelegramAccount.
+    """
+    account = telegram_utils.register_account(key, key, key, media_cache_dir=media_cache_dir)
+    account.client = client
+    account.my_id = client.me_id
+    ready = threading.Event()
+
+    async def run_loop():
+        telegram_utils.telegram_loop = asyncio.get_running_loop()
+        ready.set()
+        await client.run_until_disconnected()
+
+    threading.Thread(target=asyncio.run, args=(run_loop(),), name="FakeTelethon", daemon=True).start()
+    ready.wait()
+    telegram_utils.use_account(key)
+    return account
+
+def stop_fake_telegram(account):
+    """Отключает клиента аккаунта, после чего фоновый цикл завершается."""
+    future = asyncio.run_coroutine_threadsafe(account.client.disconnect(), telegram_utils.telegram_loop)
+    future.result(timeout=5)
+
+class _FakeModels:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def generate_content(self, model=None, contents=None, config=None):
+        time.sleep(self.owner.latency_s)
+        with self.owner.lock:
+            self.owner.calls += 1
+        part = SimpleNamespace(text=self.owner.reply_text)
+        candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]), finish_reason=None)
+        return SimpleNamespace(candidates=[candidate], prompt_feedback=None)
+
+    def list(self):
+        return []
+
+    def get(self, model=None):
+        return SimpleNamespace(name=model)
+
+class FakeGenaiClient:
+    """Заменитель google.genai.Client: каждый generate_content ждет latency_s и возвращает reply_text."""
+
+    def __init__(self, reply_text, latency_s=0.0):
+        self.reply_text = reply_text
+        self.latency_s = latency_s
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.models = _FakeModels(self)
@@ -0,0 +1,308 @@
+"""
+Нагрузочный тест авто-режима: сколько чатов в авто-режиме выдерживает один инстанс,
+прежде чем задержка ответа начинает расти.
+
+Для каждого уровня нагрузки (--chats 1 10 50 ...) запускается столько же настоящих потоков
+auto_mode_worker против поддельных Telegram и Gemini из benchmarks.fakes. Генератор по сценарию
+(--pattern) подбрасывает в чаты входящие сообщения:
+  poisson - личные чаты, пачки сообщений (1 + геометрическое число) с пуассоновскими интервалами;
+  group   - групповые чаты, непрерывная болтовня нескольких участников (пуассоновский поток);
+  mixed   - каждый четвертый чат групповой, остальные личные.
+
+Задержка ответа - время от последнего входящего сообщения до отправки первой части ответа,
+поэтому в нее входят auto_mode_initial_wait, половина auto_mode_check_interval в среднем и
+задержка Gemini. По каждому уровню печатаются p50/p95/p99 задержки, число потоков, память (RSS)
+и частота вызовов API на один чат в минуту.
+
+Запуск из корня проекта:
+    python -m benchmarks.load_test_auto_mode                              # 1, 10, 50, 100, 250, 500 чатов по 60 сек
+    python -m benchmarks.load_test_auto_mode --chats 1 50 200 --duration 30 --pattern group --genai-latency-ms 1500
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import contextvars
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('TELAGRAMM_API_ID', '1')
+os.environ.setdefault('TELAGRAMM_API_HASH', 'benchmark')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import main
+import telegram_utils
+from benchmarks.fakes import ME_ID, make_history
+from benchmarks.suite import BenchEnvironment, BENCH_SETTINGS, git_revision
+
+SEED = 7
+DEFAULT_LEVELS = (1, 10, 50, 100, 250, 500)
+DEFAULT_DURATION_S = 60.0
+DEFAULT_GENAI_LATENCY_MS = 800.0
+DEFAULT_TELEGRAM_LATENCY_MS = 50.0
+HISTORY_SIZE = 100
+GROUP_MEMBERS = 8
+PRIVATE_CHAT_BASE = 100000
+GROUP_CHAT_BASE = 200000
+SAMPLE_INTERVAL_S = 0.5
+REPLY_TEXT = "Привет! Да, я тоже об этом думала.{split}А у тебя как дела?"
+TELEGRAM_METHODS = ("get_messages", "get_entity", "download_media", "send_message")
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def chat_ids_for_level(count, pattern):
+    """ID чатов уровня: личные положительные, групповые отрицательные (как в Telegram)."""
+    chat_ids = []
+    for index in range(count):
+        is_group = pattern == "group" or (pattern == "mixed" and index % 4 == 3)
+        chat_ids.append(-(GROUP_CHAT_BASE + index) if is_group else PRIVATE_CHAT_BASE + index)
+    return chat_ids
+
+def make_arrivals(chat_ids, duration_s, burst_interval_s, group_interval_s, seed=SEED):
+    """
+    Сценарий входящих сообщений: список (смещение в секундах, chat_id, sender_id), отсортированный по времени.
+    Личные чаты получают пачки сообщений в среднем раз в burst_interval_s секунд,
+    групповые - отдельные сообщения разных участников в среднем раз в group_interval_s секунд.
+    """
+    rng = random.Random(seed)
+    arrivals = []
+    for chat_id in chat_ids:
+        offset = 0.0
+        if chat_id < 0:
+            while True:
+                offset += rng.expovariate(1.0 / group_interval_s)
+                if offset >= duration_s:
+                    break
+                arrivals.append((offset, chat_id, rng.randint(1, GROUP_MEMBERS)))
+            continue
+        while True:
+            offset += rng.expovariate(1.0 / burst_interval_s)
+            if offset >= duration_s:
+                break
+            message_offset = offset
+            while message_offset < duration_s:
+                arrivals.append((message_offset, chat_id, chat_id))
+                if rng.random() < 0.5:
+                    break
+                message_offset += rng.uniform(0.5, 2.0)
+            offset = message_offset
+    arrivals.sort()
+    return arrivals
+
+def current_rss_bytes():
+    """Текущий RSS процесса; без /proc - пиковый из getrusage, без resource - None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class ReplyLatencyRecorder:
+    """
+    Время последнего непрочитанного входящего сообщения по чатам и задержки ответов на них.
+    incoming и on_send вызываются в цикле telegram_loop, результаты читаются из основного потока.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latencies = []
+        self.incoming_count = 0
+
+    def incoming(self, chat_id):
+        with self.lock:
+            self.pending[chat_id] = time.perf_counter()
+            self.incoming_count += 1
+
+    def on_send(self, chat_id, text):
+        with self.lock:
+            received_at = self.pending.pop(chat_id, None)
+            if received_at is not None:
+                self.latencies.append(time.perf_counter() - received_at)
+
+class ResourceSampler(threading.Thread):
+    """Раз в SAMPLE_INTERVAL_S секунд записывает число потоков и RSS процесса."""
+
+    def __init__(self):
+        super().__init__(name="LoadTestSampler", daemon=True)
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.rss = []
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.threads.append(threading.active_count())
+            rss = current_rss_bytes()
+            if rss is not None:
+                self.rss.append(rss)
+            self.stop_event.wait(SAMPLE_INTERVAL_S)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+def start_workers(chat_ids):
+    """Запускает auto_mode_worker для каждого чата так же, как это делает /toggle_auto_mode."""
+    workers = main.get_auto_mode_workers()
+    stop_events = {}
+    for chat_id in chat_ids:
+        stop_event = threading.Event()
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(main.auto_mode_worker, chat_id, stop_event),
+                                  name=f"AutoMode-{chat_id}", daemon=True)
+        with main.auto_mode_lock:
+            workers[chat_id] = {"thread": thread, "stop_event": stop_event, "status": "active", "bot_last_message_anchor": None}
+        stop_events[chat_id] = stop_event
+    for chat_id in chat_ids:
+        workers[chat_id]["thread"].start()
+    return stop_events
+
+def stop_workers(stop_events, timeout_s=30):
+    workers = main.get_auto_mode_workers()
+    with main.auto_mode_lock:
+        threads = [workers.pop(chat_id)["thread"] for chat_id in stop_events if chat_id in workers]
+    for stop_event in stop_events.values():
+        stop_event.set()
+    deadline = time.monotonic() + timeout_s
+    for thread in threads:
+        thread.join(timeout=max(0.0, deadline - time.monotonic()))
+    return sum(1 for thread in threads if thread.is_alive())
+
+def run_level(env, chat_count, args):
+    """Один уровень нагрузки: chat_count потоков авто-режима, сценарий входящих длиной args.duration секунд."""
+    chat_ids = chat_ids_for_level(chat_count, args.pattern)
+    members = tuple(range(1, GROUP_MEMBERS + 1))
+    for index, chat_id in enumerate(chat_ids):
+        senders = (ME_ID,) + (members if chat_id < 0 else (chat_id,))
+        env.client.set_history(chat_id, make_history(args.history, chat_id, senders=senders, seed=SEED + index, latest_from=ME_ID))
+    level_settings = dict(BENCH_SETTINGS, auto_mode_initial_wait=args.initial_wait, auto_mode_check_interval=args.check_interval,
+                          num_messages_to_fetch=args.history_limit)
+    chat_settings = {"active_character_id": env.character_id, "character_specifics": {
+        env.character_id: {"advanced_settings": level_settings}}}
+    main.save_chat_settings({chat_id: chat_settings for chat_id in chat_ids})
+
+    recorder = ReplyLatencyRecorder()
+    env.client.on_send = recorder.on_send
+    calls_before = env.client.calls.copy()
+    genai_calls_before = env.genai.calls
+    arrivals = make_arrivals(chat_ids, args.duration, args.burst_interval, args.group_interval, seed=SEED + chat_count)
+
+    def deliver(chat_id, sender_id):
+        env.client.receive_message(chat_id, sender_id, "сообщение " * 5)
+        recorder.incoming(chat_id)
+
+    sampler = ResourceSampler()
+    sampler.start()
+    stop_events = start_workers(chat_ids)
+    started = time.perf_counter()
+    time.sleep(args.warmup)
+    arrivals_started = time.perf_counter()
+    for offset, chat_id, sender_id in arrivals:
+        delay = arrivals_started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        telegram_utils.telegram_loop.call_soon_threadsafe(deliver, chat_id, sender_id)
+
+    drain_deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < drain_deadline:
+        with recorder.lock:
+            if not recorder.pending:
+                break
+        time.sleep(0.2)
+    elapsed_min = (time.perf_counter() - started) / 60.0
+    stuck_workers = stop_workers(stop_events)
+    sampler.stop()
+    env.client.on_send = None
+
+    with recorder.lock:
+        latencies = sorted(recorder.latencies)
+        unanswered = len(recorder.pending)
+        incoming_count = recorder.incoming_count
+    per_chat_minute = chat_count * elapsed_min
+    calls = {method: sum(count - calls_before[key] for key, count in env.client.calls.items()
+                         if key[0] == method and key[1] in stop_events) / per_chat_minute
+             for method in TELEGRAM_METHODS}
+    calls["generate_content"] = (env.genai.calls - genai_calls_before) / per_chat_minute
+    return {
+        "chats": chat_count,
+        "incoming_messages": incoming_count,
+        "replies": len(latencies),
+        "unanswered": unanswered,
+        "stuck_workers": stuck_workers,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000.0, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000.0, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000.0, 1),
+        "max_ms": round(latencies[-1] * 1000.0, 1) if latencies else 0.0,
+        "threads_max": max(sampler.threads, default=0),
+        "rss_mb_max": round(max(sampler.rss) / 2**20, 1) if sampler.rss else None,
+        "calls_per_chat_minute": {name: round(rate, 2) for name, rate in calls.items()},
+    }
+
+def print_level(result):
+    calls = result["calls_per_chat_minute"]
+    rss = f"{result['rss_mb_max']:7.1f} МБ" if result["rss_mb_max"] is not None else "      - МБ"
+    print(f"{result['chats']:4d} чатов: p50 {result['p50_ms']:8.1f} мс, p95 {result['p95_ms']:8.1f} мс, "
+          f"p99 {result['p99_ms']:8.1f} мс, ответов {result['replies']:5d}, без ответа {result['unanswered']:4d}, "
+          f"потоков {result['threads_max']:4d}, RSS {rss}, на чат в минуту: get_messages {calls['get_messages']:.1f}, "
+          f"Gemini {calls['generate_content']:.2f}, send_message {calls['send_message']:.2f}")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест авто-режима TeekaGramAi с поддельными Telegram и Gemini.")
+    parser.add_argument('--chats', type=int, nargs='+', default=list(DEFAULT_LEVELS), help="Уровни нагрузки: число чатов в авто-режиме.")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION_S, help="Длительность сценария на каждом уровне, секунд.")
+    parser.add_argument('--pattern', choices=("poisson", "group", "mixed"), default="mixed", help="Сценарий входящих сообщений.")
+    parser.add_argument('--burst-interval', type=float, default=20.0, help="Средний интервал между пачками в личном чате, секунд.")
+    parser.add_argument('--group-interval', type=float, default=6.0, help="Средний интервал между сообщениями в группе, секунд.")
+    parser.add_argument('--initial-wait', type=float, default=1.0, help="auto_mode_initial_wait для всех чатов, секунд.")
+    parser.add_argument('--check-interval', type=float, default=1.0, help="auto_mode_check_interval для всех чатов, секунд.")
+    parser.add_argument('--history', type=int, default=HISTORY_SIZE, help="Размер синтетической истории каждого чата.")
+    parser.add_argument('--history-limit', type=int, default=65, help="num_messages_to_fetch для всех чатов.")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Пауза между запуском потоков и первым сообщением, секунд.")
+    parser.add_argument('--drain', type=float, default=15.0, help="Сколько ждать ответов на последние сообщения, секунд.")
+    parser.add_argument('--collapse-p95-ms', type=float, default=30000.0,
+                        help="Если p95 превысил порог, следующие уровни не запускаются.")
+    parser.add_argument('--genai-latency-ms', type=float, default=DEFAULT_GENAI_LATENCY_MS,
+                        help="Задержка поддельного Gemini на один generate_content.")
+    parser.add_argument('--telegram-latency-ms', type=float, default=DEFAULT_TELEGRAM_LATENCY_MS,
+                        help="Задержка поддельного Telegram на один сетевой вызов.")
+    parser.add_argument('--json', help="Сохранить результаты в JSON-файл.")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    commit, dirty = git_revision()
+    env = BenchEnvironment(args.genai_latency_ms / 1000.0, args.telegram_latency_ms / 1000.0)
+    env.genai.reply_text = REPLY_TEXT
+    results = []
+    try:
+        for chat_count in args.chats:
+            result = run_level(env, chat_count, args)
+            print_level(result)
+            results.append(result)
+            if result["p95_ms"] > args.collapse_p95_ms:
+                print(f"p95 выше {args.collapse_p95_ms:.0f} мс - следующие уровни пропущены.")
+                break
+    finally:
+        env.close()
+
+    if args.json:
+        report = {"commit": commit, "dirty": dirty, "settings": vars(args), "levels": results}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,92 @@
+"""
+Нагрузочный тест веб-интерфейса: запросов в секунду и задержки (p50/p95/p99).
+Используется для сравнения обычного режима (Flask, потоки) и ASGI-режима (--asgi).
+
+Пример: запустить два инстанса с разными INSTANCE_NUMBER, обычный и с --asgi, затем
+    python benchmarks/load_test_web.py --url http://127.0.0.1:5001 --url http://127.0.0.1:5002 \\
+        --path / --path /chat/-1002398372400 --concurrency 50 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def run_load(base_url, paths, concurrency, duration_s, timeout_s=60):
+    """Держит concurrency одновременных запросов к base_url в течение duration_s секунд по кругу по paths."""
+    latencies = []
+    errors = 0
+    statuses = {}
+    deadline = time.perf_counter() + duration_s
+    timeout = aiohttp.ClientTimeout(total=timeout_s)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def worker(worker_index):
+            nonlocal errors
+            request_index = worker_index
+            while time.perf_counter() < deadline:
+                url = base_url.rstrip('/') + paths[request_index % len(paths)]
+                request_index += 1
+                start = time.perf_counter()
+                try:
+                    async with session.get(url, allow_redirects=False) as response:
+                        await response.read()
+                        statuses[response.status] = statuses.get(response.status, 0) + 1
+                        if response.status >= 500:
+                            errors += 1
+                            continue
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "url": base_url,
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000.0,
+        "p95_ms": percentile(latencies, 0.95) * 1000.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000.0,
+    }
+
+def print_result(result):
+    print(f"{result['url']}: {result['rps']:8.1f} запр/с, p50 {result['p50_ms']:7.1f} мс, "
+          f"p95 {result['p95_ms']:7.1f} мс, p99 {result['p99_ms']:7.1f} мс, "
+          f"успешно {result['requests']}, ошибок {result['errors']}, статусы {result['statuses']}")
+
+async def main_async(args):
+    results = []
+    for base_url in args.url:
+        result = await run_load(base_url, args.path or ['/'], args.concurrency, args.duration)
+        print_result(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест веб-интерфейса TeekaGramAi.")
+    parser.add_argument('--url', action='append', required=True, help='Базовый адрес инстанса (можно указать несколько).')
+    parser.add_argument('--path', action='append', help='Путь для запросов (можно указать несколько, по умолчанию /).')
+    parser.add_argument('--concurrency', type=int, default=50, help='Число одновременных запросов.')
+    parser.add_argument('--duration', type=float, default=20.0, help='Длительность теста для каждого адреса, секунд.')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл.')
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Набор офлайн-бенчмарков горячих путей: Telegram и Gemini заменены на benchmarks.fakes,
+поэтому живой аккаунт и ключ API не нужны, а результаты воспроизводимы (фиксированные seed).
+
+Бенчмарки:
+  get_formatted_history_text  - 300 сообщений группы без медиа (через run_in_telegram_loop);
+  get_formatted_history_media - то же с медиа (фото из дискового кэша после прогрева);
+  final_fine_tune_sms         - финальная обработка ответа на 4 КБ;
+  send_generated_reply_parse  - разбор ответа (react, {split}, sticker, длинные части) в план отправки;
+  replace_standalone_sticker_names - поиск кодовых имен 1000 стикеров в ответе на 2 КБ;
+  structure_sticker_data      - иерархия наборов для 1000 стикеров;
+  auto_mode_turn              - полный цикл авто-режима: проверка истории, промпт, история, Gemini, отправка.
+
+Запуск из корня проекта:
+    python -m benchmarks.suite                        # все бенчмарки, JSON в benchmarks/results/<коммит>.json
+    python -m benchmarks.suite --only auto_mode_turn --genai-latency-ms 300
+    python -m benchmarks.suite --compare benchmarks/results/<старый коммит>.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import contextvars
+import subprocess
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('TELAGRAMM_API_ID', '1')
+os.environ.setdefault('TELAGRAMM_API_HASH', 'benchmark')
+
+import numpy as np
+
+import main
+import text_utils
+import telegram_utils
+import gemini_utils
+import character_utils
+from benchmarks.fakes import (
+    FakeTelegramClient, FakeGenaiClient, make_history, start_fake_telegram, stop_fake_telegram,
+    GROUP_CHAT_ID, PRIVATE_CHAT_ID
+)
+from benchmarks.bench_text_processing import make_long_reply
+
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+SEED = 7
+DEFAULT_REPEAT = 20
+HISTORY_SIZE = 1000
+HISTORY_LIMIT = 300
+STICKER_SETS = 50
+STICKERS_PER_SET = 20
+DEFAULT_GENAI_LATENCY_MS = 50.0
+DEFAULT_TELEGRAM_LATENCY_MS = 0.0
+
+GENERATED_REPLY = (
+    "react(995)[👍] answer(998) Привет! Да, я тоже об этом думала, pack3_7 "
+    "{split}Кстати, sticker(pack1_2) как прошел день?{split}" + "Очень длинная мысль. " * 250
+)
+
+BENCH_SETTINGS = {
+    "auto_mode_initial_wait": 0.0,
+    "auto_mode_check_interval": 0.05,
+    "max_typing_duration_s": 0.0,
+    "base_thinking_delay_s_min": 0.0,
+    "base_thinking_delay_s_max": 0.0,
+    "sticker_choosing_delay_min": 0.0,
+    "sticker_choosing_delay_max": 0.0,
+    "substitution_chance": 0.0,
+    "transposition_chance": 0.0,
+    "skip_chance": 0.0,
+    "lower_chance": 0.0,
+    "enable_auto_memory": True,
+    "num_messages_to_fetch": HISTORY_LIMIT,
+}
+
+def make_sticker_db(sets=STICKER_SETS, per_set=STICKERS_PER_SET):
+    """Синтетическая база стикеров в формате data/stickers.json: наборы packN и стикеры packN_K."""
+    sticker_db = {}
+    sticker_id = 10000
+    for set_index in range(sets):
+        sticker_db[f"pack{set_index}"] = {"description": f"Набор {set_index}"}
+        for sticker_index in range(per_set):
+            sticker_id += 1
+            sticker_db[f"pack{set_index}_{sticker_index}"] = {
+                "description": f"Стикер {sticker_index} из набора {set_index}",
+                "enabled": True,
+                "stickers": [{"id": sticker_id, "access_hash": 1}],
+            }
+    return sticker_db
+
+def git_revision():
+    """(короткий хеш коммита, есть ли незакоммиченные изменения) или ("unknown", None) без git."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", None
+
+def summarize(samples_ms):
+    samples = sorted(samples_ms)
+    return {
+        "repeat": len(samples),
+        "median_ms": round(statistics.median(samples), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "min_ms": round(samples[0], 3),
+        "max_ms": round(samples[-1], 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "stdev_ms": round(statistics.stdev(samples), 3) if len(samples) > 1 else 0.0,
+    }
+
+def run_timed(func, repeat, warmup=1):
+    """Вызывает func warmup раз без замера и repeat раз с замером; возвращает сводку времени в мс."""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return summarize(samples)
+
+class BenchEnvironment:
+    """
+    Рабочая папка во временном каталоге (data/, media_cache/, generation_log.txt пишутся туда),
+    персонаж, настройки чатов, поддельные Telegram и Gemini.
+    """
+
+    def __init__(self, genai_latency_s, telegram_latency_s):
+        self.previous_cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix="teekagram-bench-")
+        os.chdir(self.work_dir)
+        os.makedirs('data', exist_ok=True)
+
+        self.group_history = make_history(HISTORY_SIZE, GROUP_CHAT_ID)
+        self.private_history = make_history(HISTORY_SIZE, PRIVATE_CHAT_ID)
+        self.client = FakeTelegramClient({GROUP_CHAT_ID: self.group_history, PRIVATE_CHAT_ID: self.private_history},
+                                         latency_s=telegram_latency_s)
+        self.account = start_fake_telegram(self.client)
+
+        self.genai = FakeGenaiClient(GENERATED_REPLY, latency_s=genai_latency_s)
+        self.previous_gemini_client = gemini_utils.gemini_client
+        gemini_utils.gemini_client = self.genai
+
+        self.sticker_db = make_sticker_db()
+        self.previous_sticker_db = main.STICKER_DB
+        main.STICKER_DB = telegram_utils.STICKER_DB = self.sticker_db
+
+        self.character_id = character_utils.create_new_character("Бенчмарк")
+        chat_settings = {"active_character_id": self.character_id, "character_specifics": {
+            self.character_id: {"advanced_settings": BENCH_SETTINGS}}}
+        main.save_chat_settings({GROUP_CHAT_ID: chat_settings, PRIVATE_CHAT_ID: chat_settings})
+
+    def close(self):
+        stop_fake_telegram(self.account)
+        gemini_utils.gemini_client = self.previous_gemini_client
+        main.STICKER_DB = telegram_utils.STICKER_DB = self.previous_sticker_db
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def bench_history_text(env):
+    def run():
+        history, error = main.run_in_telegram_loop(main.get_formatted_history(
+            GROUP_CHAT_ID, limit=HISTORY_LIMIT, settings=main.get_chat_settings(GROUP_CHAT_ID), download_media=False))
+        assert history and not error, error
+    return run
+
+def bench_history_media(env):
+    def run():
+        history, error = main.run_in_telegram_loop(main.get_formatted_history(
+            GROUP_CHAT_ID, limit=HISTORY_LIMIT, settings=main.get_chat_settings(GROUP_CHAT_ID), download_media=True))
+        assert history and not error, error
+    return run
+
+def bench_final_fine_tune_sms(env):
+    text = make_long_reply(4, seed=SEED)
+
+    def run():
+        random.seed(SEED)
+        text_utils.final_fine_tune_sms(text, word_loss_chance=0.01, max_lost_words=1, rng=np.random.default_rng(SEED))
+    return run
+
+def plan_reply(chat_id, reply_text):
+    """
+    Вызывает send_generated_reply, заменив execute_send_plan записью плана (разбор ответа
+    и переход в цикл Telethon остаются настоящими). Возвращает список задач плана.
+    """
+    planned = []
+
+    async def record_plan(chat_id, tasks, settings=None, cancel_on_new_message=False):
+        planned.extend(tasks)
+        return True, None
+
+    original_execute_send_plan = main.execute_send_plan
+    main.execute_send_plan = record_plan
+    try:
+        success, error = main.send_generated_reply(chat_id, reply_text, settings=dict(BENCH_SETTINGS))
+    finally:
+        main.execute_send_plan = original_execute_send_plan
+    assert success, error
+    return planned
+
+def bench_send_generated_reply_parse(env):
+    def run():
+        plan_reply(GROUP_CHAT_ID, GENERATED_REPLY)
+    return run
+
+def bench_replace_sticker_names(env):
+    text = make_long_reply(2, seed=SEED) + " pack3_7 и sticker(pack1_2) ещё pack42_19"
+
+    def run():
+        main.replace_standalone_sticker_names(text)
+    return run
+
+def bench_structure_sticker_data(env):
+    def run():
+        main.structure_sticker_data(json.loads(json.dumps(env.sticker_db)))
+    return run
+
+def bench_auto_mode_turn(env):
+    """
+    Один ответ авто-режима в личном чате: новый поток auto_mode_worker видит свежее сообщение
+    собеседника и работает до отправки всех частей ответа.
+    """
+    text_parts = sum(1 for task in plan_reply(PRIVATE_CHAT_ID, GENERATED_REPLY) if task["type"] == "text")
+
+    def run():
+        env.client.set_history(PRIVATE_CHAT_ID, env.private_history)
+        sent_before = len(env.client.sent_messages)
+        stop_event = threading.Event()
+        with main.auto_mode_lock:
+            main.get_auto_mode_workers()[PRIVATE_CHAT_ID] = {
+                "thread": None, "stop_event": stop_event, "status": "active", "bot_last_message_anchor": None}
+        worker = threading.Thread(target=contextvars.copy_context().run,
+                                  args=(main.auto_mode_worker, PRIVATE_CHAT_ID, stop_event), daemon=True)
+        worker.start()
+        try:
+            assert env.client.wait_for_sent(sent_before + text_parts), "auto_mode_worker не отправил ответ"
+        finally:
+            stop_event.set()
+            worker.join(timeout=10)
+    return run
+
+BENCHMARKS = {
+    "get_formatted_history_text": bench_history_text,
+    "get_formatted_history_media": bench_history_media,
+    "final_fine_tune_sms": bench_final_fine_tune_sms,
+    "send_generated_reply_parse": bench_send_generated_reply_parse,
+    "replace_standalone_sticker_names": bench_replace_sticker_names,
+    "structure_sticker_data": bench_structure_sticker_data,
+    "auto_mode_turn": bench_auto_mode_turn,
+}
+
+def compare_results(previous, current):
+    """Печатает изменение медианы по каждому бенчмарку относительно предыдущего файла результатов."""
+    print(f"\nСравнение с {previous.get('commit')} ({previous.get('created_at')}):")
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not old:
+            print(f"  {name:<34} {result['median_ms']:10.3f} мс  (нет в предыдущих результатах)")
+            continue
+        change = (result["median_ms"] - old["median_ms"]) / old["median_ms"] * 100.0 if old["median_ms"] else 0.0
+        print(f"  {name:<34} {old['median_ms']:10.3f} -> {result['median_ms']:10.3f} мс  ({change:+6.1f}%)")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки TeekaGramAi с поддельными Telegram и Gemini.")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="Запустить только указанные бенчмарки.")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Число замеров каждого бенчмарка.")
+    parser.add_argument('--genai-latency-ms', type=float, default=DEFAULT_GENAI_LATENCY_MS,
+                        help="Задержка поддельного Gemini на один generate_content.")
+    parser.add_argument('--telegram-latency-ms', type=float, default=DEFAULT_TELEGRAM_LATENCY_MS,
+                        help="Задержка поддельного Telegram на один сетевой вызов.")
+    parser.add_argument('--output', help="Файл для результатов (по умолчанию benchmarks/results/<коммит>.json).")
+    parser.add_argument('--compare', help="Файл предыдущих результатов для сравнения медиан.")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    commit, dirty = git_revision()
+    names = args.only or list(BENCHMARKS)
+    env = BenchEnvironment(args.genai_latency_ms / 1000.0, args.telegram_latency_ms / 1000.0)
+    results = {}
+    try:
+        for name in names:
+            results[name] = run_timed(BENCHMARKS[name](env), args.repeat)
+            print(f"{name:<34} медиана {results[name]['median_ms']:10.3f} мс, p95 {results[name]['p95_ms']:10.3f} мс")
+    finally:
+        env.close()
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "repeat": args.repeat, "genai_latency_ms": args.genai_latency_ms,
+            "telegram_latency_ms": args.telegram_latency_ms, "history_size": HISTORY_SIZE,
+            "history_limit": HISTORY_LIMIT, "stickers": STICKER_SETS * STICKERS_PER_SET,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), report)
+
+if __name__ == "__main__":
+    main_cli()
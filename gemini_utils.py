@@ -1,11 +1,12 @@
 import os
+import re
+import time
 import logging
-from google import genai
-from google.genai import types
-import google.auth
-from google.api_core import exceptions as google_exceptions
+import threading
+from functools import lru_cache
 from colorama import Fore, init
 import base64 
+from metrics import GEMINI_REQUEST_SECONDS, GEMINI_RATE_LIMITED
 
 init(autoreset=True)
 
@@ -13,10 +14,55 @@ GENERATION_LOG_FILE = "generation_log.txt"
 BASE_GEMENI_MODEL = os.getenv("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash")
 
 gemini_client = None
+# google.genai импортируется около секунды, поэтому он загружается внутри функций (при создании
+# клиента и первой генерации), а клиент создается в фоне - см. start_gemini_init.
+GEMINI_INIT_WAIT_S = 30
+_gemini_init_thread = None
+
+# Доступность API для /readyz: результат последнего обращения к Gemini (генерации или пробы models.list).
+GEMINI_PROBE_MAX_AGE_S = 60
+_health_lock = threading.Lock()
+gemini_health_state = {
+    "reachable": None, "checked_at": None, "last_success_at": None,
+    "last_error": None, "last_error_at": None, "probe_running": False,
+}
+
+# Оценки токенов Gemini для медиа: изображение - 258 токенов, видео ~263 токена/с,
+# аудио ~32 токена/с, страница PDF - 258 токенов (число страниц заранее неизвестно).
+IMAGE_TOKENS = 258
+VIDEO_TOKENS_PER_SECOND = 263
+AUDIO_TOKENS_PER_SECOND = 32
+PDF_TOKENS_ESTIMATE = 258 * 10
+DEFAULT_MEDIA_DURATION_S = 30
+TEXT_CHARS_PER_TOKEN = 4
+
+_TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+@lru_cache(maxsize=8192)
+def estimate_text_tokens(text):
+    """
+    Локальная оценка числа токенов Gemini для текста без запроса count_tokens:
+    каждое слово или знак - минимум один токен, длинные слова - по токену на TEXT_CHARS_PER_TOKEN символов.
+    """
+    return sum(1 + len(piece) // TEXT_CHARS_PER_TOKEN for piece in _TOKEN_PIECE_PATTERN.findall(text))
+
+def estimate_media_tokens(media_type, duration_s=None):
+    """Оценка числа токенов Gemini для медиа ('image', 'video', 'audio', 'file') по типу и длительности."""
+    if media_type == 'image':
+        return IMAGE_TOKENS
+    if media_type == 'video':
+        return int((duration_s or DEFAULT_MEDIA_DURATION_S) * VIDEO_TOKENS_PER_SECOND)
+    if media_type == 'audio':
+        return int((duration_s or DEFAULT_MEDIA_DURATION_S) * AUDIO_TOKENS_PER_SECOND)
+    if media_type == 'file':
+        return PDF_TOKENS_ESTIMATE
+    return 0
 
 def init_gemini_client():
     """Инициализирует клиент Gemini API."""
     global gemini_client, BASE_GEMENI_MODEL
+    from google import genai
+    import google.auth
     logging.info("Инициализация клиента Gemini...")
     try:
         api_key = os.getenv("GOOGLE_API_KEY", "").strip()
@@ -33,6 +79,7 @@ def init_gemini_client():
              gemini_client = genai.Client(api_key=api_key) 
 
         gemini_client.models.list()
+        _record_reachability(True)
         logging.info(Fore.GREEN + "Клиент Gemini создан и аутентифицирован.")
 
         try:
@@ -54,6 +101,91 @@ def init_gemini_client():
         gemini_client = None
         return None
 
+def start_gemini_init(on_done=None):
+    """
+    Запускает init_gemini_client в фоновом потоке: импорт google.genai и сетевая проверка ключа
+    и модели (models.list, models.get) не задерживают запуск веб-сервера и Telegram.
+    on_done(client или None) вызывается в том же потоке по завершении.
+    """
+    global _gemini_init_thread
+
+    def run():
+        client = init_gemini_client()
+        if on_done:
+            on_done(client)
+
+    _gemini_init_thread = threading.Thread(target=run, name="GeminiInit", daemon=True)
+    _gemini_init_thread.start()
+    return _gemini_init_thread
+
+def wait_for_gemini_client(timeout=GEMINI_INIT_WAIT_S):
+    """Если клиент еще создается в фоне, ждет его не дольше timeout секунд. Возвращает gemini_client."""
+    init_thread = _gemini_init_thread
+    if gemini_client is None and init_thread is not None and init_thread is not threading.current_thread():
+        init_thread.join(timeout)
+    return gemini_client
+
+def observe_generation(model_name, outcome, started, error=None):
+    """Записывает задержку запроса к Gemini в метрики; ответы 429 считаются отдельно."""
+    if error is not None and getattr(error, 'code', None) == 429:
+        outcome = "rate_limited"
+        GEMINI_RATE_LIMITED.inc(model=model_name)
+    GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - started, model=model_name, outcome=outcome)
+    # api_error - это ответ API (400, 429...), значит Gemini доступен; "error" - сбой до получения ответа.
+    _record_reachability(outcome != "error", error)
+
+def _record_reachability(reachable, error=None):
+    now = time.time()
+    with _health_lock:
+        gemini_health_state["reachable"] = reachable
+        gemini_health_state["checked_at"] = now
+        if error is None:
+            gemini_health_state["last_success_at"] = now
+        else:
+            gemini_health_state["last_error"] = str(error)[:300]
+            gemini_health_state["last_error_at"] = now
+
+def _probe_gemini(client):
+    try:
+        client.models.list()
+        _record_reachability(True)
+    except Exception as e:
+        logging.warning("Проба доступности Gemini не прошла: %s", e)
+        _record_reachability(False, e)
+    finally:
+        with _health_lock:
+            gemini_health_state["probe_running"] = False
+
+def get_gemini_health(probe_max_age_s=GEMINI_PROBE_MAX_AGE_S):
+    """
+    Состояние Gemini для /readyz: клиент ("ready", "initializing" или "unavailable") и доступность API.
+    Если последнему обращению к Gemini больше probe_max_age_s секунд, в фоне запускается проба
+    models.list; вызов не ждет сети и возвращает результат предыдущего обращения.
+    """
+    client = gemini_client
+    init_thread = _gemini_init_thread
+    if client is not None:
+        client_state = "ready"
+    elif init_thread is not None and init_thread.is_alive():
+        client_state = "initializing"
+    else:
+        client_state = "unavailable"
+
+    now = time.time()
+    with _health_lock:
+        checked_at = gemini_health_state["checked_at"]
+        start_probe = (client is not None and not gemini_health_state["probe_running"]
+                       and (checked_at is None or now - checked_at > probe_max_age_s))
+        if start_probe:
+            gemini_health_state["probe_running"] = True
+        state = dict(gemini_health_state)
+    if start_probe:
+        threading.Thread(target=_probe_gemini, args=(client,), name="GeminiProbe", daemon=True).start()
+
+    state["client"] = client_state
+    state["checked_age_s"] = round(now - checked_at, 1) if checked_at else None
+    return state
+
 def generate_chat_reply_original(model_name, system_prompt, chat_history, config=None):
     """
     Генерирует ответ на основе истории чата Telegram.
@@ -70,8 +202,10 @@ def generate_chat_reply_original(model_name, system_prompt, chat_history, config
     """
 
     global GENERATION_LOG_FILE, gemini_client, BASE_GEMENI_MODEL
+    from google.genai import types
+    from google.api_core import exceptions as google_exceptions
 
-    if not gemini_client:
+    if not gemini_client and not wait_for_gemini_client():
         logging.error("Клиент Gemini не инициализирован.")
         return None, "Клиент Gemini не инициализирован."
     if not chat_history:
@@ -82,7 +216,7 @@ def generate_chat_reply_original(model_name, system_prompt, chat_history, config
         model_name = BASE_GEMENI_MODEL
         logging.info(f"Имя модели не указано, используется по умолчанию: {model_name}")
 
-    logging.info(f"Используемое имя модели для API: {model_name}")
+    logging.debug("Используемое имя модели для API: %s", model_name)
 
     history_for_api = list(chat_history)
     if history_for_api and history_for_api[-1].get('role') == 'model':
@@ -204,18 +338,19 @@ def generate_chat_reply_original(model_name, system_prompt, chat_history, config
     if should_add_config:
         api_args["config"] = generation_config_to_use
     
+    request_started = time.perf_counter()
     try:
         if api_args.get("config"):
             conf_to_log = api_args.get("config")
-            logging.info(f"[DEBUG-CONFIG] Объект 'config' ПЕРЕДАЕТСЯ в API.")
+            logging.debug("[DEBUG-CONFIG] Объект 'config' ПЕРЕДАЕТСЯ в API.")
             if hasattr(conf_to_log, 'tools'):
-                 logging.info(f"[DEBUG-CONFIG] Tools: {repr(conf_to_log.tools)}")
+                 logging.debug("[DEBUG-CONFIG] Tools: %r", conf_to_log.tools)
             if hasattr(conf_to_log, 'thinking_config'):
-                 logging.info(f"[DEBUG-CONFIG] Thinking Config: {repr(conf_to_log.thinking_config)}")
+                 logging.debug("[DEBUG-CONFIG] Thinking Config: %r", conf_to_log.thinking_config)
             if hasattr(conf_to_log, 'system_instruction') and conf_to_log.system_instruction:
-                 logging.info(f"[DEBUG-CONFIG] System Instruction: Присутствует.")
+                 logging.debug("[DEBUG-CONFIG] System Instruction: Присутствует.")
         else:
-            logging.info("[DEBUG-CONFIG] Объект 'config' НЕ передается в API.")
+            logging.debug("[DEBUG-CONFIG] Объект 'config' НЕ передается в API.")
 
         log_prefix = f"ГЕНЕРАЦИЯ ответа (Модель: {model_name}) [История: {len(contents_list)}]"
         if system_instruction_text_to_log and not system_instruction_text_to_log.startswith("["): log_prefix += " [С system_instruction]"
@@ -258,12 +393,15 @@ def generate_chat_reply_original(model_name, system_prompt, chat_history, config
         if generated_comment is None:
             error_msg = f"Модель '{model_name}' вернула пустой ответ. {reason_empty}"
             logging.warning(Fore.YELLOW + error_msg)
+            observe_generation(model_name, "empty", request_started)
             return None, error_msg
         logging.info(Fore.GREEN + f"Ответ успешно сгенерирован '{model_name}'.")
+        observe_generation(model_name, "ok", request_started)
         return generated_comment, None
     except google_exceptions.GoogleAPIError as e:
         error_message = f"Ошибка API Google при вызове '{model_name}': {e}"
         logging.error(Fore.RED + error_message)
+        observe_generation(model_name, "api_error", request_started, e)
         http_code = getattr(e, 'code', None) or getattr(e, 'resp', {}).get('status')
         if http_code:
             try: http_code = int(http_code)
@@ -278,6 +416,7 @@ def generate_chat_reply_original(model_name, system_prompt, chat_history, config
         return None, error_message
     except Exception as e:
         logging.error(Fore.RED + f"Неожиданная ошибка при вызове модели '{model_name}': {e}", exc_info=True)
+        observe_generation(model_name, "error", request_started, e)
         error_message = str(e)
         response_obj_during_exception = locals().get('response')
         if response_obj_during_exception:
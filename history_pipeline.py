@@ -0,0 +1,331 @@
+"""
+Конвейер форматирования истории чата для нейросети.
+
+Стадии (каждую можно вызвать, замерить и заменить отдельно):
+    fetch (telegram_utils.get_history_page, client.get_messages)
+    → extract_reactions / normalize_messages   сообщения Telethon → HistoryRecord
+    → apply_token_budget                       самые новые сообщения в пределах бюджета токенов
+    → enrich_media                             загрузка медиа или заглушки для страницы
+    → build_text_blocks                        текстовый блок "(ID) [время] <ник> текст"
+    → attribute_reactions                      react(ID)[эмодзи] к следующему сообщению автора реакции
+    → group_records                            склейка подряд идущих сообщений одного автора
+    → render_records                           [{"role", "parts"}] для Gemini и шаблонов
+"""
+import re
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from telethon.tl.types import (
+    MessageMediaPhoto, MessageMediaDocument, MessageMediaUnsupported, MessageMediaContact,
+    MessageMediaGeo, MessageMediaGame, MessageMediaInvoice, MessageMediaPoll,
+    MessageMediaVenue,
+    MessageService, DocumentAttributeVideo, DocumentAttributeAudio,
+    ReactionEmoji, MessageReactions, PeerUser, PeerChannel
+)
+
+from gemini_utils import estimate_text_tokens, estimate_media_tokens
+
+LOADING_ERROR_SUFFIX = " - не удалось загрузить."
+SPLIT_SEPARATOR = "\n{split}\n"
+MEDIA_ENRICH_CONCURRENCY = 4
+
+_GROUPED_NICK_PREFIX = re.compile(r"<ник:.*?>\s")
+
+OTHER_MEDIA_PLACEHOLDERS = (
+    (MessageMediaContact, "[Контакт]"),
+    (MessageMediaGeo, "[Геопозиция]"),
+    (MessageMediaPoll, "[Опрос]"),
+    (MessageMediaVenue, "[Место]"),
+    (MessageMediaGame, "[Игра]"),
+    (MessageMediaInvoice, "[Счет]"),
+    (MessageMediaUnsupported, "[Неподдерживаемое сообщение]"),
+)
+
+@dataclass(slots=True)
+class HistoryRecord:
+    """
+    Одно сообщение истории на всех стадиях конвейера. Хранит только поля, нужные
+    для форматирования (без ссылки на объект Message Telethon).
+    """
+    msg_id: int
+    sender_id: int
+    role: str
+    date: datetime
+    header: str
+    sender_prefix: str
+    has_id_header: bool
+    text: str
+    sticker_text: str | None = None
+    media_type: str | None = None
+    media_duration: float | None = None
+    media_placeholder: str = ""
+    media_note: str = ""
+    media_parts: list | None = None
+    is_media: bool = False
+    reactions: list | None = None
+    parts: list | None = None
+    group_text: str = ""
+
+def extract_reactions(messages):
+    """Реакции на сообщения: {ID сообщения: [(ID автора реакции, эмодзи), ...]} в порядке messages."""
+    reactions_by_msg_id = {}
+    for msg in messages:
+        if msg and isinstance(msg.reactions, MessageReactions) and msg.reactions.recent_reactions:
+            reactions_list = []
+            for recent_reaction in msg.reactions.recent_reactions:
+                reactor_id = None
+                peer = recent_reaction.peer_id
+                if isinstance(peer, PeerUser):
+                    reactor_id = peer.user_id
+                elif isinstance(peer, PeerChannel):
+                    reactor_id = peer.channel_id
+
+                if reactor_id and hasattr(recent_reaction, 'reaction'):
+                    emoji = ''
+                    if isinstance(recent_reaction.reaction, ReactionEmoji):
+                        emoji = recent_reaction.reaction.emoticon
+                    if emoji:
+                        reactions_list.append((reactor_id, emoji))
+            if reactions_list:
+                reactions_by_msg_id[msg.id] = reactions_list
+    return reactions_by_msg_id
+
+def _classify_media(record, media, settings):
+    """Заполняет в record тип медиа для загрузки или текстовую пометку (если медиа не показывается)."""
+    replace_placeholder_with_empty = settings.get('ignore_all_media', False)
+
+    if isinstance(media, MessageMediaPhoto):
+        placeholder = "[Изображение]" + LOADING_ERROR_SUFFIX
+        if settings.get('can_see_photos', True):
+            record.media_type, record.media_placeholder = 'image', placeholder
+        else:
+            record.media_note = "" if replace_placeholder_with_empty else placeholder
+        return
+
+    if isinstance(media, MessageMediaDocument):
+        doc = media.document; doc_attrs = getattr(doc, 'attributes', []); doc_mime = getattr(doc, 'mime_type', '')
+        media_kind = None
+        duration_attr = next((attr for attr in doc_attrs if isinstance(attr, (DocumentAttributeVideo, DocumentAttributeAudio))), None)
+        record.media_duration = getattr(duration_attr, 'duration', None)
+        if any(isinstance(attr, DocumentAttributeVideo) for attr in doc_attrs):
+            is_round = any(getattr(attr, 'round_message', False) for attr in doc_attrs)
+            media_kind = ('video', ("[Видео-кружок]" if is_round else "[Видео]"), 'can_see_videos')
+        elif any(isinstance(attr, DocumentAttributeAudio) for attr in doc_attrs):
+            is_voice = any(getattr(attr, 'voice', False) for attr in doc_attrs)
+            media_kind = ('audio', ("[Голосовое сообщение]" if is_voice else "[Аудиофайл]"), 'can_see_audio')
+        elif doc_mime == 'application/pdf':
+            media_kind = ('file', "[PDF-файл]", 'can_see_files_pdf')
+
+        if media_kind:
+            media_type, label, setting_key = media_kind
+            placeholder = label + LOADING_ERROR_SUFFIX
+            if settings.get(setting_key, True):
+                record.media_type, record.media_placeholder = media_type, placeholder
+            else:
+                record.media_note = "" if replace_placeholder_with_empty else placeholder
+            return
+
+    placeholder_text = "[Документ]"
+    for media_class, media_label in OTHER_MEDIA_PLACEHOLDERS:
+        if isinstance(media, media_class):
+            placeholder_text = media_label
+            break
+    record.media_note = "" if replace_placeholder_with_empty else (placeholder_text + LOADING_ERROR_SUFFIX)
+
+def normalize_messages(messages, my_id, is_group_chat, settings, sticker_codenames, sender_name):
+    """
+    Переводит сообщения Telethon (от новых к старым, как их отдает get_messages) в HistoryRecord
+    в хронологическом порядке. Служебные сообщения и сообщения без отправителя пропускаются.
+    sender_name(msg) - имя отправителя для префикса <ник:...> в группах.
+    """
+    records = []
+    for msg in reversed(messages):
+        if isinstance(msg, MessageService) or not msg.sender_id:
+            continue
+
+        role = "model" if msg.sender_id == my_id else "user"
+        timestamp_str = msg.date.strftime("%Y-%m-%d %H:%M:%S")
+        id_prefix = f"(ID: {msg.id}) " if role == "user" or is_group_chat else ""
+        reply_prefix = f"answer({msg.reply_to_msg_id})\n" if msg.reply_to_msg_id else ""
+        sender_prefix = f"<ник:{sender_name(msg)}> " if is_group_chat and role == "user" else ""
+
+        sticker_text = None
+        if msg.sticker:
+            codename = sticker_codenames.get(msg.sticker.id, '')
+            sticker_text = f"sticker({codename})" if codename else "[Стикер]"
+
+        record = HistoryRecord(
+            msg.id, msg.sender_id, role, msg.date,
+            header=f"{reply_prefix}{id_prefix}\n[{timestamp_str}]\n",
+            sender_prefix=sender_prefix,
+            has_id_header=bool(id_prefix) and not reply_prefix,
+            text=msg.text or "",
+            sticker_text=sticker_text,
+        )
+        if msg.media:
+            _classify_media(record, msg.media, settings)
+        records.append(record)
+    return records
+
+def estimate_record_tokens(record):
+    """Оценка токенов сообщения до загрузки медиа: заголовок, ник, текст и вес медиа по типу."""
+    text_tokens = estimate_text_tokens(f"{record.header}{record.sender_prefix}{record.text}\n{record.media_note}")
+    media_tokens = estimate_media_tokens(record.media_type, record.media_duration) if record.media_type else 0
+    return text_tokens + media_tokens
+
+def apply_token_budget(records, token_budget):
+    """
+    Оставляет самые новые сообщения, чья суммарная оценка (estimate_record_tokens) укладывается
+    в token_budget; самое новое сообщение остается всегда. Выполняется до enrich_media,
+    чтобы не загружать медиа сообщений, которые не попадут в контекст.
+    """
+    total_tokens = 0
+    for index in range(len(records) - 1, -1, -1):
+        record_tokens = estimate_record_tokens(records[index])
+        if total_tokens + record_tokens > token_budget and index < len(records) - 1:
+            logging.info("Бюджет %s токенов: в контекст вошли %s из %s сообщений (~%s токенов).", token_budget, len(records) - index - 1, len(records), total_tokens)
+            return records[index + 1:]
+        total_tokens += record_tokens
+    return records
+
+async def enrich_media(records, chat_id, download_media, load_media, max_concurrency=MEDIA_ENRICH_CONCURRENCY):
+    """
+    Для сообщений с показываемым медиа: при download_media загружает его через
+    load_media(msg_id) -> (parts, ошибка) (параллельно, не больше max_concurrency),
+    иначе добавляет заглушку media_placeholder для подгрузки на странице.
+    Если загрузить не удалось, в текст попадает пометка "[...] - не удалось загрузить.".
+    """
+    media_records = [record for record in records if record.media_type]
+    for record in media_records:
+        record.is_media = True
+        if not download_media:
+            record.media_parts = [{"type": "media_placeholder", "chat_id": chat_id, "message_id": record.msg_id,
+                                   "media_type": record.media_type}]
+    if not download_media or not media_records:
+        return records
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def load(record):
+        async with semaphore:
+            media_data, _ = await load_media(record.msg_id)
+        if media_data:
+            record.media_parts = list(media_data)
+        else:
+            record.is_media = False
+            record.media_note = record.media_placeholder
+
+    await asyncio.gather(*(load(record) for record in media_records))
+    return records
+
+def build_text_blocks(records):
+    """Собирает parts каждого сообщения: текстовый блок (заголовок, ник, текст) и затем медиа."""
+    for record in records:
+        content_text = record.media_note
+        if record.text:
+            content_text = f"{record.text}\n{content_text}" if content_text else record.text
+        elif record.sticker_text is not None and not record.media_parts:
+            content_text = record.sticker_text
+
+        tail = f"{record.sender_prefix}{content_text}".rstrip()
+        full_text_block = f"{record.header}{tail}".strip()
+        media_parts = record.media_parts or []
+        record.parts = [{"text": full_text_block}] + media_parts if full_text_block else list(media_parts)
+        record.media_parts = None
+
+        if record.has_id_header and tail:
+            nick_match = _GROUPED_NICK_PREFIX.match(tail)
+            record.group_text = tail[nick_match.end():] if nick_match else tail
+        else:
+            record.group_text = full_text_block
+    return records
+
+def attribute_reactions(records, reactions_by_msg_id):
+    """
+    Добавляет перед текстом сообщения команды react(ID)[эмодзи] - реакции, которые его автор
+    поставил на более ранние сообщения (к первому следующему сообщению автора реакции).
+    Один проход с конца: для каждого отправителя хранится индекс его ближайшего следующего сообщения.
+    """
+    next_index_by_sender = {}
+    for index in range(len(records) - 1, -1, -1):
+        record = records[index]
+        reactions = reactions_by_msg_id.get(record.msg_id)
+        if reactions:
+            for reactor_id, emoji in reactions:
+                target_index = next_index_by_sender.get(reactor_id)
+                if target_index is None:
+                    continue
+                reaction_command = f"react({record.msg_id})[{emoji}]"
+                target = records[target_index]
+                if target.reactions is None:
+                    target.reactions = [reaction_command]
+                elif reaction_command not in target.reactions:
+                    target.reactions.append(reaction_command)
+        next_index_by_sender[record.sender_id] = index
+
+    for record in records:
+        if record.reactions:
+            reactions_text = "\n".join(record.reactions)
+            for part in record.parts:
+                if 'text' in part:
+                    part['text'] = f"{reactions_text}\n{part['text']}"
+                    break
+            else:
+                record.parts.insert(0, {'text': reactions_text})
+    return records
+
+def _flush_group_text(text_part, text_buffer):
+    if text_part is not None and len(text_buffer) > 1:
+        text_part["text"] = SPLIT_SEPARATOR.join(text_buffer)
+
+def group_records(records, group_threshold_minutes):
+    """
+    Склеивает подряд идущие текстовые сообщения одного автора с промежутком меньше
+    group_threshold_minutes: текст следующего (без заголовка) добавляется через SPLIT_SEPARATOR.
+    Тексты группы копятся в списке и соединяются один раз, при закрытии группы.
+    Возвращает список записей-групп (первая запись каждой группы).
+    """
+    group_delta = timedelta(minutes=group_threshold_minutes)
+    groups = []
+    last_group = None
+    last_date = None
+    text_part = None
+    text_buffer = []
+    for record in records:
+        first_part = record.parts[0] if record.parts else None
+        record_text_part = first_part if first_part is not None and 'text' in first_part else None
+        if (last_group is not None and not record.is_media and not last_group.is_media and
+                record.role == last_group.role and record.sender_id == last_group.sender_id and
+                (record.date - last_date) < group_delta and
+                (record_text_part is None or 'react(' not in record_text_part['text'])):
+            text_buffer.append(record.group_text)
+        else:
+            _flush_group_text(text_part, text_buffer)
+            groups.append(record)
+            last_group = record
+            text_part = record_text_part
+            text_buffer = [text_part["text"]] if text_part is not None else []
+        last_date = record.date
+    _flush_group_text(text_part, text_buffer)
+    return groups
+
+def render_records(groups):
+    """Итоговый формат истории: [{"role": ..., "parts": [...]}]."""
+    return [{"role": group.role, "parts": group.parts} for group in groups]
+
+async def format_history(messages, chat_id, my_id, settings, download_media, group_threshold_minutes,
+                         sticker_codenames, sender_name, load_media, token_budget=None):
+    """
+    Прогоняет сообщения Telethon (от новых к старым) через все стадии конвейера.
+    token_budget - ограничение истории по оценке токенов (None - все полученные сообщения).
+    """
+    reactions_by_msg_id = extract_reactions(messages)
+    records = normalize_messages(messages, my_id, chat_id < 0, settings, sticker_codenames, sender_name)
+    if token_budget:
+        records = apply_token_budget(records, token_budget)
+    await enrich_media(records, chat_id, download_media, load_media)
+    build_text_blocks(records)
+    attribute_reactions(records, reactions_by_msg_id)
+    return render_records(group_records(records, group_threshold_minutes))
@@ -0,0 +1,198 @@
+"""
+Настройка логирования инстанса по глобальным настройкам (data/global_settings.json):
+
+    "log_level": "INFO",                                   - уровень по умолчанию;
+    "log_levels": {"telegram_utils": "WARNING", "telethon": "ERROR"},
+                                                           - уровни отдельных модулей проекта
+                                                             (по имени файла) и библиотек (по имени логгера);
+    "log_format": "text" | "json"                          - обычные строки или JSON по строке на запись.
+
+Записи из вызывающих потоков (Flask, цикл Telethon, авто-режим) только кладутся в очередь
+QueueHandler, а форматирование и вывод в консоль выполняет отдельный поток QueueListener.
+Если очередь переполнена, записи отбрасываются (метрика teekagram_log_records_dropped_total),
+чтобы медленная консоль не тормозила горячие пути. Уровни применяются на лету (apply_logging_settings).
+"""
+import os
+import re
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import LOG_RECORDS_DROPPED
+
+LOG_QUEUE_SIZE = 10000
+TEXT_LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s'
+DEFAULT_LOG_LEVEL = 'INFO'
+LOG_FORMATS = ('text', 'json')
+ANSI_ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+# Атрибуты LogRecord, которые не являются пользовательскими полями из extra=...
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+_exception_formatter = logging.Formatter()
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON: время, уровень, модуль, поток, сообщение и поля из extra."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "module": record.module,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": ANSI_ESCAPE_PATTERN.sub('', record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    Вызовы logging.info(...) через корневой логгер пропускаются, если уровень записи не ниже уровня
+    модуля (record.module - имя файла без .py), иначе уровня по умолчанию. Записи именованных
+    логгеров библиотек, уровень которых задан в log_levels, уже отфильтрованы самим логгером.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.default_level = logging.INFO
+        self.module_levels = {}
+
+    def filter(self, record):
+        if record.name == 'root':
+            return record.levelno >= self.module_levels.get(record.module, self.default_level)
+        return record.name.partition('.')[0] in self.module_levels or record.levelno >= self.default_level
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который при переполненной очереди отбрасывает запись вместо ожидания."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def prepare(self, record):
+        """
+        Как QueueHandler.prepare: сообщение подставляется сразу (аргументы могут измениться),
+        но трассировка исключения остается в exc_text, а не дописывается к тексту сообщения.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_setup_lock = threading.Lock()
+_listener = None
+_output_handler = None
+_level_filter = ModuleLevelFilter()
+_library_levels = {}
+
+def parse_level(name, default=logging.INFO):
+    level = logging.getLevelName(str(name).upper())
+    return level if isinstance(level, int) else default
+
+def setup_logging(stream=None):
+    """
+    Заменяет обработчики корневого логгера на очередь с фоновым потоком вывода.
+    Повторный вызов ничего не делает. Поток вывода останавливается (с выводом остатка очереди) при выходе.
+    """
+    global _listener, _output_handler
+    with _setup_lock:
+        if _listener is not None:
+            return
+        _output_handler = logging.StreamHandler(stream or sys.stderr)
+        _output_handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+        queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        queue_handler.addFilter(_level_filter)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        _listener = QueueListener(queue_handler.queue, _output_handler)
+        _listener.start()
+        atexit.register(stop_logging)
+
+def stop_logging():
+    global _listener
+    with _setup_lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+def apply_logging_settings(settings):
+    """
+    Применяет log_level, log_levels и log_format из глобальных настроек. Корневой логгер получает
+    самый подробный из уровней, поэтому вызовы ниже всех настроенных уровней отсекаются сразу,
+    до создания записи. Возвращает список ошибок в настройках (пустой, если все в порядке).
+    """
+    errors = []
+    default_level = parse_level(settings.get('log_level', DEFAULT_LOG_LEVEL), None)
+    if default_level is None:
+        errors.append(f"Неизвестный уровень log_level: {settings.get('log_level')}")
+        default_level = logging.INFO
+
+    module_levels = {}
+    for name, level_name in (settings.get('log_levels') or {}).items():
+        level = parse_level(level_name, None)
+        if level is None:
+            errors.append(f"Неизвестный уровень для '{name}': {level_name}")
+            continue
+        module_levels[name] = level
+
+    _level_filter.default_level = default_level
+    _level_filter.module_levels = module_levels
+    for name in set(_library_levels) - set(module_levels):
+        logging.getLogger(name).setLevel(_library_levels.pop(name))
+    for name, level in module_levels.items():
+        library_logger = logging.getLogger(name)
+        _library_levels.setdefault(name, library_logger.level)
+        library_logger.setLevel(level)
+    logging.getLogger().setLevel(min([default_level, *module_levels.values()]))
+
+    log_format = settings.get('log_format', 'text')
+    if log_format not in LOG_FORMATS:
+        errors.append(f"Неизвестный log_format: {log_format}")
+        log_format = 'text'
+    if _output_handler is not None:
+        _output_handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_LOG_FORMAT))
+    return errors
+
+def watch_settings_file(path, load_settings, interval_s=5.0):
+    """
+    Фоновый поток: при изменении файла path (по времени изменения) заново загружает
+    настройки через load_settings() и применяет их к логированию.
+    """
+    def get_mtime():
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def run():
+        last_mtime = get_mtime()
+        while True:
+            time.sleep(interval_s)
+            mtime = get_mtime()
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            for error in apply_logging_settings(load_settings()):
+                logging.warning(f"Настройки логирования: {error}")
+            logging.info(f"Настройки логирования перечитаны из {path}.")
+
+    thread = threading.Thread(target=run, name="LogSettingsWatcher", daemon=True)
+    thread.start()
+    return thread
@@ -3,18 +3,26 @@ import logging
 import threading 
 import asyncio 
 import time 
+# Отсчет для --profile-startup: до импорта Flask, Telethon и остальных тяжелых модулей.
+STARTUP_STARTED_AT = time.perf_counter()
 import random
 import atexit 
 import re
 from datetime import timedelta, datetime
 import json 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify 
+import hmac
+from contextlib import contextmanager
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, send_file 
 from dotenv import load_dotenv
 from colorama import Fore, Style, init
 from werkzeug.routing import BaseConverter
 import character_utils 
-from google.genai import types
 import argparse 
+import contextvars
+import metrics
+import profiler
+import log_utils
+from tracing import start_trace, span, load_recent_traces, waterfall_rows
 
 init(autoreset=True)
 load_dotenv()
@@ -22,27 +30,46 @@ load_dotenv()
 INSTANCE_NUMBER = int(os.getenv('INSTANCE_NUMBER', 1))
 TELAGRAMM_API_ID = os.getenv('TELAGRAMM_API_ID')
 TELAGRAMM_API_HASH = os.getenv('TELAGRAMM_API_HASH')
+PROFILER_TOKEN = os.getenv('PROFILER_TOKEN')
 
 if not TELAGRAMM_API_ID or not TELAGRAMM_API_HASH:
     raise ValueError("TELAGRAMM_API_ID и TELAGRAMM_API_HASH должны быть установлены в .env файле")
 
 from telegram_utils import (
-    get_chats,
+    get_cached_chats,
+    get_dialog_list_updated_at,
     get_chat_info,
     get_formatted_history,
-    send_telegram_message,
+    get_history_page,
+    get_cached_chat_info,
     disconnect_telegram,
     telegram_main_loop, 
     run_in_telegram_loop,
+    await_in_telegram_loop,
     STICKER_DB,
-    send_sticker_by_codename,
-    send_telegram_reaction,
     get_media_for_message,
+    get_media_file_for_message,
+    find_cached_media_file,
+    iter_media_for_messages,
+    stream_in_telegram_loop,
     cleanup_old_cache_files,
-    calculate_telegram_send_delay 
+    execute_send_plan,
+    estimate_send_plan_duration,
+    get_send_queue_backlog_s,
+    get_send_queue_stats,
+    cancel_pending_sends,
+    start_generation_typing,
+    stop_generation_typing,
+    register_account,
+    get_account,
+    use_account,
+    has_connected_accounts,
+    get_telegram_health,
+    ACCOUNTS
 )
 from gemini_utils import (
-    init_gemini_client,
+    start_gemini_init,
+    get_gemini_health,
     generate_chat_reply_original,
     BASE_GEMENI_MODEL,
     
@@ -70,28 +97,94 @@ def inject_instance_number():
     """Передает номер инстанса в контекст всех шаблонов."""
     return dict(instance_number=INSTANCE_NUMBER)
 
+def split_account_prefix(path):
+    """
+    Разбирает путь вида /a/<ключ аккаунта>/... на (ключ, остаток пути).
+    Для путей без префикса или с неизвестным ключом возвращает (None, path).
+    """
+    if not path.startswith(ACCOUNT_URL_PREFIX):
+        return None, path
+    key, _, rest = path[len(ACCOUNT_URL_PREFIX):].partition('/')
+    if key not in ACCOUNTS:
+        return None, path
+    return key, '/' + rest
+
+class AccountPrefixMiddleware:
+    """
+    WSGI-обертка для мультиаккаунтного режима: /a/<ключ аккаунта>/... обслуживается теми же
+    маршрутами, а префикс переносится в SCRIPT_NAME, поэтому url_for строит ссылки внутри того же аккаунта.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        key, path = split_account_prefix(environ.get('PATH_INFO', ''))
+        if key is not None:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + ACCOUNT_URL_PREFIX + key
+            environ['PATH_INFO'] = path
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = AccountPrefixMiddleware(app.wsgi_app)
+
+@app.before_request
+def select_request_account():
+    """Делает аккаунт из префикса адреса текущим для запроса (без префикса - аккаунт по умолчанию)."""
+    key, _ = split_account_prefix(request.script_root + '/')
+    use_account(key)
+
+def account_url_prefix() -> str:
+    """Префикс адресов текущего аккаунта ('' в обычном режиме с одним аккаунтом)."""
+    if not multi_account_mode:
+        return ''
+    return ACCOUNT_URL_PREFIX + get_account().key
+
+@app.context_processor
+def inject_accounts():
+    """Передает в шаблоны список аккаунтов процесса и текущий аккаунт (для переключателя)."""
+    current = get_account()
+    accounts = [{"key": account.key, "name": account.name, "url": f"{ACCOUNT_URL_PREFIX}{account.key}/"}
+                for account in ACCOUNTS.values()] if multi_account_mode else []
+    return dict(accounts=accounts, current_account_key=current.key if current else None)
+
 ACCOUNTS_JSON_FILE = 'data/accounts.json'
 DEFAULT_SESSION_NAME = 'kadzu'
 CHAT_SETTINGS_FILE = 'data/chat_settings.json'
+ACCOUNTS_DATA_DIR = 'data/accounts'
+MEDIA_CACHE_DIR = 'media_cache'
+ACCOUNT_URL_PREFIX = '/a/'
 GLOBAL_SETTINGS_FILE = 'data/global_settings.json'
 STICKER_JSON_FILE = 'data/stickers.json'
 CHARTS_LIMIT = 120
 CHAT_LIMIT = 10000
+HISTORY_PAGE_SIZE = 100
+MEDIA_BATCH_MAX_IDS = 100
+MEDIA_FILE_MAX_AGE = 365 * 24 * 60 * 60
 TELEGRAM_MAX_MESSAGE_LENGTH = 4006
+TRACES_VIEW_LIMIT = 20
+TRACES_VIEW_MAX_LIMIT = 200
+MEDIA_CLEANUP_DELAY_S = 5
 
 
 gemini_client_global = None
 telegram_thread = None 
 telegram_ready_event = threading.Event() 
+profile_startup_enabled = False
+startup_phases = []
+startup_phases_lock = threading.Lock()
 
 DEFAULT_GLOBAL_SETTINGS = {
     "media_cleanup_enabled": True,
     "media_cleanup_days": 7,
+    # Логирование (см. log_utils): уровень по умолчанию, уровни модулей/библиотек, "text" или "json".
+    "log_level": "INFO",
+    "log_levels": {},
+    "log_format": "text",
 }
 
 DEFAULT_CHAT_SETTINGS = {
     # Общие
     "num_messages_to_fetch": 65,
+    "history_token_budget": 0,
     "add_chat_name_prefix": True,
     # Настройки для Gemini
     "model_name": "", 
@@ -118,6 +211,8 @@ DEFAULT_CHAT_SETTINGS = {
     "base_thinking_delay_s_min": 1.2,
     "base_thinking_delay_s_max": 2.8,
     "max_typing_duration_s": 25.0,
+    "cancel_reply_on_new_message": False,
+    "overlap_typing_with_generation": False,
     # Настройки для опечаток
     "substitution_chance": 0.005,
     "transposition_chance": 0.005,
@@ -130,6 +225,7 @@ DEFAULT_CHAT_SETTINGS = {
 
 auto_mode_workers = {} 
 auto_mode_lock = threading.Lock() 
+multi_account_mode = False
 
 def load_global_settings():
     """Загружает глобальные настройки из JSON файла."""
@@ -213,27 +309,107 @@ def choose_account_from_console(account_choice_arg=None):
             print(Fore.YELLOW + "\nВыбор отменен. Завершение работы.")
             exit()
 
+def account_key_for_session(session_file: str) -> str:
+    """Ключ аккаунта (для адресов /a/<ключ>/ и папок данных) - имя файла сессии без пути и расширения."""
+    return os.path.splitext(os.path.basename(session_file))[0]
+
+def register_selected_account(session_file: str):
+    """Регистрирует один выбранный аккаунт (обычный режим: данные и кэш медиа - в общих папках)."""
+    account_name = next((name for name, session in load_accounts().items() if session == session_file), session_file)
+    return [register_account(account_key_for_session(session_file), account_name, session_file)]
+
+def register_all_accounts():
+    """
+    Регистрирует все аккаунты из ACCOUNTS_JSON_FILE для мультиаккаунтного режима.
+    У каждого аккаунта свой кэш медиа (MEDIA_CACHE_DIR/<ключ>) и свои настройки чатов.
+    """
+    accounts = []
+    for account_name, session_file in load_accounts().items():
+        key = account_key_for_session(session_file)
+        if key in ACCOUNTS:
+            logging.warning("Аккаунт '%s' пропущен: ключ '%s' уже занят другим аккаунтом.", account_name, key)
+            continue
+        accounts.append(register_account(key, account_name, session_file,
+                                         media_cache_dir=os.path.join(MEDIA_CACHE_DIR, key)))
+    return accounts
+
+def cleanup_media_caches(max_age_days):
+    """Очищает от старых файлов кэш медиа всех аккаунтов процесса."""
+    cache_dirs = {account.media_cache_dir for account in ACCOUNTS.values()} or {MEDIA_CACHE_DIR}
+    for cache_dir in sorted(cache_dirs):
+        cleanup_old_cache_files(directory=cache_dir, max_age_days=max_age_days)
+
+def start_media_cache_cleanup():
+    """
+    Очистка кэша медиа при старте. Выполняется в фоновом потоке через MEDIA_CLEANUP_DELAY_S секунд,
+    когда веб-сервер уже принимает запросы: на большом кэше обход папок занимает секунды.
+    """
+    global_settings = load_global_settings()
+    if not global_settings.get('media_cleanup_enabled', True):
+        logging.info("Автоматическая очистка кэша при старте отключена в настройках.")
+        return
+    cleanup_days = global_settings.get('media_cleanup_days', 7)
+
+    def run_cleanup():
+        time.sleep(MEDIA_CLEANUP_DELAY_S)
+        logging.info("Запуск очистки кэша при старте (файлы старше %s дней).", cleanup_days)
+        with startup_phase("media_cleanup", background=True):
+            cleanup_media_caches(max_age_days=cleanup_days)
+
+    threading.Thread(target=run_cleanup, name="MediaCacheCleanup", daemon=True).start()
+
+def print_account_urls(port: int):
+    """В мультиаккаунтном режиме выводит в консоль адреса веб-интерфейса каждого аккаунта."""
+    if not multi_account_mode:
+        return
+    for account in ACCOUNTS.values():
+        print(Fore.CYAN + f"  {account.name}: http://127.0.0.1:{port}{ACCOUNT_URL_PREFIX}{account.key}/")
+
+def count_auto_mode_workers():
+    """Число живых потоков авто-режима по аккаунтам (для метрики teekagram_auto_mode_workers)."""
+    with auto_mode_lock:
+        return {key: sum(1 for worker_info in account_workers.values() if worker_info["thread"] and worker_info["thread"].is_alive())
+                for key, account_workers in auto_mode_workers.items()}
+
+metrics.AUTO_MODE_WORKERS.collect = count_auto_mode_workers
+
+def get_auto_mode_workers():
+    """Потоки авто-режима текущего аккаунта: {chat_id: worker_info} (под auto_mode_lock)."""
+    return auto_mode_workers.setdefault(get_account().key, {})
+
+def auto_mode_session_key(chat_id):
+    """Ключ статуса авто-режима в сессии: у каждого аккаунта свой, даже если чат у них общий."""
+    return f'auto_mode_status_{get_account().key}_{chat_id}'
+
+def chat_settings_file():
+    """Файл настроек чатов текущего аккаунта: в мультиаккаунтном режиме у каждого аккаунта свой."""
+    if not multi_account_mode:
+        return CHAT_SETTINGS_FILE
+    return os.path.join(ACCOUNTS_DATA_DIR, get_account().key, 'chat_settings.json')
+
 def load_chat_settings():
     """Загружает все сохраненные настройки чатов из JSON файла."""
+    settings_file = chat_settings_file()
     try:
-        if os.path.exists(CHAT_SETTINGS_FILE):
-            with open(CHAT_SETTINGS_FILE, 'r', encoding='utf-8') as f:
+        if os.path.exists(settings_file):
+            with open(settings_file, 'r', encoding='utf-8') as f:
                 return {int(k): v for k, v in json.load(f).items()}
         return {}
     except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
-        logging.warning(f"Не удалось загрузить файл настроек ({CHAT_SETTINGS_FILE}): {e}. Будет использован пустой словарь.")
+        logging.warning("Не удалось загрузить файл настроек (%s): %s. Будет использован пустой словарь.", settings_file, e)
         return {}
 
 def save_chat_settings(settings_dict):
     """Сохраняет словарь настроек чатов в JSON файл."""
+    settings_file = chat_settings_file()
     try:
-        os.makedirs(os.path.dirname(CHAT_SETTINGS_FILE), exist_ok=True)
+        os.makedirs(os.path.dirname(settings_file), exist_ok=True)
         
         settings_to_save = {str(k): v for k, v in settings_dict.items()}
-        with open(CHAT_SETTINGS_FILE, 'w', encoding='utf-8') as f:
+        with open(settings_file, 'w', encoding='utf-8') as f:
             json.dump(settings_to_save, f, ensure_ascii=False, indent=4)
     except IOError as e:
-        logging.error(f"Ошибка сохранения файла настроек ({CHAT_SETTINGS_FILE}): {e}")
+        logging.error("Ошибка сохранения файла настроек (%s): %s", settings_file, e)
 
 def get_chat_settings(chat_id):
     """
@@ -265,6 +441,14 @@ def get_chat_settings(chat_id):
 
     return final_settings
 
+def get_history_token_budget(settings):
+    """Бюджет токенов истории для генерации из настроек чата или None, если он не задан (0)."""
+    try:
+        token_budget = int(settings.get('history_token_budget') or 0)
+    except (TypeError, ValueError):
+        return None
+    return token_budget if token_budget > 0 else None
+
 def structure_sticker_data(sticker_db: dict) -> list:
     """
     Структурирует плоский список стикеров в иерархию наборов на основе префиксов.
@@ -373,6 +557,24 @@ def load_sticker_data():
         logging.warning(f"Не удалось загрузить файл стикеров ({STICKER_JSON_FILE}): {e}.")
         return {}
 
+_structured_stickers_cache = {"key": None, "data": []}
+
+def get_structured_sticker_data() -> list:
+    """
+    Возвращает structure_sticker_data(load_sticker_data()), пересчитывая результат
+    только при изменении файла стикеров (по времени изменения и размеру).
+    """
+    try:
+        file_stat = os.stat(STICKER_JSON_FILE)
+        cache_key = (file_stat.st_mtime_ns, file_stat.st_size)
+    except OSError:
+        cache_key = None
+
+    if cache_key is None or cache_key != _structured_stickers_cache["key"]:
+        _structured_stickers_cache["data"] = structure_sticker_data(load_sticker_data())
+        _structured_stickers_cache["key"] = cache_key
+    return _structured_stickers_cache["data"]
+
 def save_sticker_data(data):
     """Безопасно сохраняет данные о стикерах в JSON-файл."""
     try:
@@ -383,33 +585,69 @@ def save_sticker_data(data):
         logging.error(f"Ошибка сохранения файла стикеров ({STICKER_JSON_FILE}): {e}")
         return False
     
+def record_startup_phase(name, seconds, background=False):
+    """Запоминает длительность этапа запуска; с --profile-startup фоновые этапы печатаются по завершении."""
+    with startup_phases_lock:
+        startup_phases.append((name, seconds, background))
+    if profile_startup_enabled and background:
+        print(Fore.CYAN + f"[startup] {name} (в фоне): {seconds * 1000:.0f} мс")
+
+@contextmanager
+def startup_phase(name, background=False):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_phase(name, time.perf_counter() - started, background)
+
+def print_startup_profile():
+    """С --profile-startup выводит этапы запуска до старта веб-сервера и общее время."""
+    if not profile_startup_enabled:
+        return
+    with startup_phases_lock:
+        phases = list(startup_phases)
+    print(Fore.CYAN + "=== Этапы запуска ===")
+    for name, seconds, background in phases:
+        print(Fore.CYAN + f"  {name:<20} {seconds * 1000:8.0f} мс{' (в фоне)' if background else ''}")
+    print(Fore.CYAN + f"  {'до веб-сервера':<20} {(time.perf_counter() - STARTUP_STARTED_AT) * 1000:8.0f} мс")
+
 def initialize_gemini():
-    """Инициализирует клиент Gemini."""
-    global gemini_client_global
-    logging.info("Инициализация клиента Gemini...")
-    gemini_client_global = init_gemini_client()
-    if not gemini_client_global:
-        logging.error(Fore.RED + "Не удалось инициализировать Gemini. Генерация будет недоступна.")
-    else:
-        logging.info(Fore.GREEN + "Клиент Gemini инициализирован.")
+    """
+    Инициализирует клиент Gemini в фоновом потоке (импорт google.genai и проверка ключа по сети
+    идут параллельно с подключением к Telegram). Генерация, запрошенная раньше, дождется клиента.
+    """
+    started = time.perf_counter()
+
+    def on_gemini_ready(client):
+        global gemini_client_global
+        gemini_client_global = client
+        record_startup_phase("gemini_init", time.perf_counter() - started, background=True)
+        if not client:
+            logging.error(Fore.RED + "Не удалось инициализировать Gemini. Генерация будет недоступна.")
+        else:
+            logging.info(Fore.GREEN + "Клиент Gemini инициализирован.")
+
+    logging.info("Инициализация клиента Gemini (в фоне)...")
+    start_gemini_init(on_gemini_ready)
 
-def start_telegram_thread(session_name_to_use: str):
-    """Запускает поток для Telethon с УКАЗАННЫМ именем сессии."""
+def start_telegram_thread(accounts: list):
+    """Запускает поток для Telethon, в цикле которого работают клиенты УКАЗАННЫХ аккаунтов."""
     global telegram_thread
     if telegram_thread and telegram_thread.is_alive():
         logging.warning("Поток Telethon уже запущен.")
         return
 
-    logging.info(f"Запуск потока для Telethon с сессией '{session_name_to_use}'...")
+    session_names = ", ".join(account.session_name for account in accounts)
+    logging.info("Запуск потока для Telethon с сессиями: %s...", session_names)
     thread = threading.Thread(
         target=asyncio.run, 
         args=(telegram_main_loop( 
             TELAGRAMM_API_ID,
             TELAGRAMM_API_HASH,
-            session_name_to_use,  
+            accounts,  
             telegram_ready_event 
         ),),
-        name=f"TelegramThread-{session_name_to_use}", 
+        name="TelegramThread" if len(accounts) > 1 else f"TelegramThread-{accounts[0].session_name}", 
         daemon=True 
     )
     thread.start()
@@ -420,13 +658,15 @@ def stop_telegram_thread():
     """Останавливает цикл событий Telethon и ждет завершения потока."""
     logging.info("Остановка всех активных потоков авто-режима...")
     with auto_mode_lock:
-        for chat_id, worker_info in list(auto_mode_workers.items()):
+        all_workers = [(chat_id, worker_info) for account_workers in auto_mode_workers.values()
+                       for chat_id, worker_info in account_workers.items()]
+        for chat_id, worker_info in all_workers:
             if worker_info["thread"] and worker_info["thread"].is_alive():
                 logging.info(f"Отправка сигнала остановки потоку для чата {chat_id}")
                 worker_info["stop_event"].set()
                 worker_info["status"] = "stopping" 
         
-        active_threads = [wi["thread"] for wi in auto_mode_workers.values() if wi["thread"] and wi["thread"].is_alive()]
+        active_threads = [wi["thread"] for _, wi in all_workers if wi["thread"] and wi["thread"].is_alive()]
     if active_threads:
         logging.info(f"Ожидание завершения {len(active_threads)} потоков авто-режима (макс 5 секунд)...")
         for thread in active_threads:
@@ -436,10 +676,10 @@ def stop_telegram_thread():
     logging.info("Все потоки авто-режима остановлены или им дан сигнал.")
 
     logging.info("Получен сигнал завершения. Остановка потока Telethon...")
-    from telegram_utils import telegram_loop, client as telethon_client, disconnect_telegram 
+    from telegram_utils import telegram_loop
 
     if telegram_loop and telegram_loop.is_running():
-        if telethon_client and telethon_client.is_connected():
+        if has_connected_accounts():
             logging.info("Отправка команды disconnect в цикл Telethon...")
             future = asyncio.run_coroutine_threadsafe(disconnect_telegram(), telegram_loop)
             try:
@@ -660,71 +900,22 @@ def send_generated_reply(chat_id: int, message_text: str, settings: dict = None)
                      else:
                         tasks_to_send.append({"type": "text", "content": text_after})
 
-    logging.info(f"Будет выполнено {len(tasks_to_send)} задач на отправку в чат {chat_id}.")
-    
-    all_success = True
-    first_error_message = None
-
-    for i, task in enumerate(tasks_to_send):
-        success = False
-        error_message = None
-
-        timeout = 60 
-
-        if task["type"] == "text":
-            logging.info(f"Отправка текста в чат {chat_id}: \"{task['content'][:50]}...\"")
-            
-            calculated_delay = calculate_telegram_send_delay(task["content"], settings_to_use)
-            timeout = calculated_delay + 20 
-            logging.info(f"Расчетное время операции: {calculated_delay:.2f}s. Установлен таймаут: {timeout:.2f}s.")
-            
-            success, error_message = run_in_telegram_loop(
-                send_telegram_message(chat_id, task["content"], settings=settings_to_use),
-                timeout=timeout
-            )
-
-        elif task["type"] == "sticker":
-            logging.info(f"Отправка стикера '{task['content']}' в чат {chat_id}.")
-            success, error_message = run_in_telegram_loop(send_sticker_by_codename(chat_id, task["content"], settings=settings_to_use))
-
-            if success and error_message:
-                logging.warning(f"Задача отправки стикера '{task['content']}' пропущена: {error_message}")
-        
-        elif task["type"] == "reaction":
-            logging.info(f"Отправка реакции '{task['emoji']}' на сообщение {task['message_id']} в чат {chat_id}.")
-            success, error_message = run_in_telegram_loop(
-                send_telegram_reaction(chat_id, task["message_id"], task["emoji"])
-            )
-            if success and error_message:
-                logging.warning(f"Задача отправки реакции '{task['emoji']}' пропущена: {error_message}")
+    logging.info("Будет выполнено %d задач на отправку в чат %s.", len(tasks_to_send), chat_id)
 
+    timeout = estimate_send_plan_duration(tasks_to_send, settings_to_use) + get_send_queue_backlog_s(chat_id)
+    logging.info("Расчетное время выполнения плана (с учетом очереди чата): до %.2fs.", timeout)
 
+    with span("send_generated_reply", parts=len(tasks_to_send), timeout_s=round(timeout, 2)) as send_span:
+        success, error = run_in_telegram_loop(
+            execute_send_plan(
+                chat_id, tasks_to_send, settings=settings_to_use,
+                cancel_on_new_message=settings_to_use.get('cancel_reply_on_new_message', False)
+            ),
+            timeout=timeout
+        )
         if not success:
-            all_success = False
-            logging.error(f"Ошибка отправки задачи {i+1} ({task['type']}) в чат {chat_id}: {error_message}")
-            if first_error_message is None:
-                first_error_message = error_message
-            break 
-
-        if i < len(tasks_to_send) - 1:
-            delay = 0.0
-            current_type = task["type"]
-            next_type = tasks_to_send[i+1]["type"]
-
-            if current_type == "reaction" and next_type == "reaction":
-                delay = random.uniform(0.3, 0.8)
-                logging.info(f"Короткая пауза между реакциями: {delay:.2f} сек.")
-            else:
-                min_pause = settings_to_use.get('base_thinking_delay_s_min', 1.0)
-                max_pause = settings_to_use.get('base_thinking_delay_s_max', 2.0)
-                if max_pause < min_pause: max_pause = min_pause
-                delay = random.uniform(min_pause, max_pause)
-                logging.info(f"Пауза перед следующей частью: {delay:.2f} сек.")
-            
-            if delay > 0.05:
-                time.sleep(delay)
-
-    return all_success, first_error_message
+            send_span.fail(error)
+    return success, error
 
 def auto_mode_worker(chat_id: int, stop_event: threading.Event):
     """
@@ -734,12 +925,14 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
     перестает отправлять сообщения.
     Также управляет автоматическим обновлением памяти персонажа.
     """ 
-    global auto_mode_workers, auto_mode_lock
+    global auto_mode_lock
     global BASE_GEMENI_MODEL
     global run_in_telegram_loop, get_formatted_history, generate_chat_reply_original, character_utils
+    from google.genai import types
+    account_workers = get_auto_mode_workers()
 
     worker_name = f"AutoMode-{chat_id}"
-    logging.info(f"[{worker_name}] Поток запущен.")
+    logging.info("[%s] Поток запущен.", worker_name)
 
     last_processed_user_msg_time = None
     last_own_message_sent_time = datetime.now()
@@ -750,13 +943,13 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
 
         character_id = settings_for_generation.get('active_character_id')
         if not character_id:
-            logging.warning(f"[{worker_name}] В чате не выбран активный персонаж. Авто-режим приостановлен. Пауза 60 сек.")
+            logging.warning("[%s] В чате не выбран активный персонаж. Авто-режим приостановлен. Пауза 60 сек.", worker_name)
             stop_event.wait(60)
             continue
             
         character_data = character_utils.get_character(character_id)
         if not character_data:
-            logging.error(f"[{worker_name}] Не найдены данные для персонажа {character_id}. Авто-режим приостановлен. Пауза 60 сек.")
+            logging.error("[%s] Не найдены данные для персонажа %s. Авто-режим приостановлен. Пауза 60 сек.", worker_name, character_id)
             stop_event.wait(60)
             continue
         
@@ -765,9 +958,9 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
         try:
             
             with auto_mode_lock:
-                 current_status = auto_mode_workers.get(chat_id, {}).get("status", "inactive")
+                 current_status = account_workers.get(chat_id, {}).get("status", "inactive")
             if current_status != "active":
-                 logging.info(f"[{worker_name}] Статус изменился на '{current_status}'. Остановка.")
+                 logging.info("[%s] Статус изменился на '%s'. Остановка.", worker_name, current_status)
                  break
 
             should_generate = False
@@ -776,7 +969,7 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
             history_check, error_check = run_in_telegram_loop(get_formatted_history(chat_id, limit=2, settings=settings_for_generation))
 
             if error_check:
-                logging.error(f"[{worker_name}] Ошибка получения истории для проверки: {error_check}. Пауза 30 сек.")
+                logging.error("[%s] Ошибка получения истории для проверки: %s. Пауза 30 сек.", worker_name, error_check)
                 stop_event.wait(30)
                 continue
             if not history_check:
@@ -791,7 +984,7 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
 
             if is_latest_from_user and latest_message_time and \
                (last_processed_user_msg_time is None or latest_message_time > last_processed_user_msg_time):
-                logging.info(f"[{worker_name}] Обнаружено новое сообщение от пользователя. Ожидание {initial_wait_s} сек...")
+                logging.info("[%s] Обнаружено новое сообщение от пользователя. Ожидание %s сек...", worker_name, initial_wait_s)
                 last_processed_user_msg_time = latest_message_time
                 
                 stop_event.wait(initial_wait_s)
@@ -799,23 +992,23 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
                 
                 history_after_wait, error_after_wait = run_in_telegram_loop(get_formatted_history(chat_id, limit=2, settings=settings_for_generation))
                 if error_after_wait or not history_after_wait:
-                    logging.warning(f"[{worker_name}] Не удалось перепроверить историю. Пропуск цикла.")
+                    logging.warning("[%s] Не удалось перепроверить историю. Пропуск цикла.", worker_name)
                 else:
                     latest_message_after_wait = history_after_wait[-1]
                     time_after_wait = parse_time_from_message(latest_message_after_wait)
                     
                     if time_after_wait == last_processed_user_msg_time:
-                        logging.info(f"[{worker_name}] Новых сообщений за время ожидания не было. Пора отвечать.")
+                        logging.info("[%s] Новых сообщений за время ожидания не было. Пора отвечать.", worker_name)
                         should_generate = True
                     else:
-                        logging.info(f"[{worker_name}] Обнаружено еще более новое сообщение. Сброс таймера.")
+                        logging.info("[%s] Обнаружено еще более новое сообщение. Сброс таймера.", worker_name)
             
             if not should_generate:
                  time_since_last_sent = datetime.now() - last_own_message_sent_time
                  no_reply_timeout_min = settings_for_generation.get('auto_mode_no_reply_timeout', DEFAULT_CHAT_SETTINGS['auto_mode_no_reply_timeout'])
                  
                  if not is_latest_from_user and time_since_last_sent > timedelta(minutes=no_reply_timeout_min):
-                     logging.info(f"[{worker_name}] Собеседник не отвечает > {no_reply_timeout_min} мин. Генерация напоминания.")
+                     logging.info("[%s] Собеседник не отвечает > %s мин. Генерация напоминания.", worker_name, no_reply_timeout_min)
                      should_generate = True
                      is_timeout_trigger = True
                      last_own_message_sent_time = datetime.now()
@@ -823,131 +1016,166 @@ def auto_mode_worker(chat_id: int, stop_event: threading.Event):
                          last_processed_user_msg_time = latest_message_time
 
             if should_generate:
-                chat_info, _ = run_in_telegram_loop(get_chat_info(chat_id))
+                with start_trace("auto_reply", chat_id=chat_id, account=get_account().key,
+                                 trigger="no_reply_timeout" if is_timeout_trigger else "new_message") as reply_span:
+                    with span("get_chat_info"):
+                        chat_info, _ = run_in_telegram_loop(get_chat_info(chat_id))
                 
-                model_name_from_settings = settings_for_generation.get('model_name', '')
-                model_name_to_use = model_name_from_settings or BASE_GEMENI_MODEL
+                    model_name_from_settings = settings_for_generation.get('model_name', '')
+                    model_name_to_use = model_name_from_settings or BASE_GEMENI_MODEL
                 
-                logging.info(f"[{worker_name}] Работа от лица персонажа: {character_data.get('name')}")
+                    logging.info("[%s] Работа от лица персонажа: %s", worker_name, character_data.get('name'))
                 
-                final_system_prompt = character_utils.get_full_prompt_for_character(
-                    character_id, 
-                    chat_name=chat_info.get('name', str(chat_id)),
-                    is_group=(chat_id < 0),
-                    chat_context_prompt=settings_for_generation.get('chat_context_prompt')
-                )
-
-                if is_timeout_trigger:
-                    no_reply_suffix = settings_for_generation.get('auto_mode_no_reply_suffix', DEFAULT_CHAT_SETTINGS['auto_mode_no_reply_suffix'])
-                    final_system_prompt += f"\n\n{no_reply_suffix}"
-
-                num_messages = settings_for_generation.get('num_messages_to_fetch', DEFAULT_CHAT_SETTINGS['num_messages_to_fetch'])
-                full_history, history_error = run_in_telegram_loop(get_formatted_history(chat_id, limit=num_messages, settings=settings_for_generation))
-
-                if history_error or not full_history:
-                    logging.error(f"[{worker_name}] Ошибка получения истории для генерации: {history_error}. Пропуск.")
-                    stop_event.wait(15)
-                    continue
-
-                if settings_for_generation.get('enable_auto_memory', True):
-                    with auto_mode_lock:
-                        bot_last_message_anchor = auto_mode_workers.get(chat_id, {}).get("bot_last_message_anchor")
+                    final_system_prompt = character_utils.get_full_prompt_for_character(
+                        character_id, 
+                        chat_name=chat_info.get('name', str(chat_id)),
+                        is_group=(chat_id < 0),
+                        chat_context_prompt=settings_for_generation.get('chat_context_prompt')
+                    )
+
+                    if is_timeout_trigger:
+                        no_reply_suffix = settings_for_generation.get('auto_mode_no_reply_suffix', DEFAULT_CHAT_SETTINGS['auto_mode_no_reply_suffix'])
+                        final_system_prompt += f"\n\n{no_reply_suffix}"
+
+                    num_messages = settings_for_generation.get('num_messages_to_fetch', DEFAULT_CHAT_SETTINGS['num_messages_to_fetch'])
+                    full_history, history_error = run_in_telegram_loop(get_formatted_history(
+                        chat_id, limit=num_messages, settings=settings_for_generation,
+                        token_budget=get_history_token_budget(settings_for_generation)))
+
+                    if history_error or not full_history:
+                        logging.error("[%s] Ошибка получения истории для генерации: %s. Пропуск.", worker_name, history_error)
+                        reply_span.fail(history_error or "Empty history.")
+                        with span("retry_pause", seconds=15):
+                            stop_event.wait(15)
+                        continue
+
+                    if settings_for_generation.get('enable_auto_memory', True):
+                        with auto_mode_lock:
+                            bot_last_message_anchor = account_workers.get(chat_id, {}).get("bot_last_message_anchor")
                     
-                    def find_last_bot_message_text(history):
-                        for msg in reversed(history):
-                            if msg.get("role") == "model":
-                                for part in msg.get("parts", []):
-                                    if "text" in part: return part["text"]
-                        return None
-
-                    if not bot_last_message_anchor:
-                        new_anchor_text = find_last_bot_message_text(full_history)
-                        if new_anchor_text:
-                            with auto_mode_lock:
-                                if chat_id in auto_mode_workers: auto_mode_workers[chat_id]["bot_last_message_anchor"] = new_anchor_text
-                            logging.info(f"[{worker_name}] Авто-память: Установлен начальный якорь: '{new_anchor_text[:50]}...'")
-                    else:
-                        anchor_is_visible = any( part.get("text") == bot_last_message_anchor for msg in full_history if msg.get("role") == "model" for part in msg.get("parts", []) if "text" in part )
+                        def find_last_bot_message_text(history):
+                            for msg in reversed(history):
+                                if msg.get("role") == "model":
+                                    for part in msg.get("parts", []):
+                                        if "text" in part: return part["text"]
+                            return None
+
+                        if not bot_last_message_anchor:
+                            new_anchor_text = find_last_bot_message_text(full_history)
+                            if new_anchor_text:
+                                with auto_mode_lock:
+                                    if chat_id in account_workers: account_workers[chat_id]["bot_last_message_anchor"] = new_anchor_text
+                                logging.info("[%s] Авто-память: Установлен начальный якорь: '%s...'", worker_name, new_anchor_text[:50])
+                        else:
+                            anchor_is_visible = any( part.get("text") == bot_last_message_anchor for msg in full_history if msg.get("role") == "model" for part in msg.get("parts", []) if "text" in part )
                         
-                        if not anchor_is_visible:
-                            logging.info(f"[{worker_name}] Авто-память: Якорь '{bot_last_message_anchor[:50]}...' больше не виден. Запуск обновления памяти.")
-                            _, mem_update_error = character_utils.update_character_memory(
-                                character_id=character_id, chat_name=chat_info.get('name', str(chat_id)),
-                                is_group=chat_id < 0, chat_history=full_history
+                            if not anchor_is_visible:
+                                logging.info("[%s] Авто-память: Якорь '%s...' больше не виден. Запуск обновления памяти.", worker_name, bot_last_message_anchor[:50])
+                                with span("update_character_memory", character_id=character_id) as memory_span:
+                                    _, mem_update_error = character_utils.update_character_memory(
+                                        character_id=character_id, chat_name=chat_info.get('name', str(chat_id)),
+                                        is_group=chat_id < 0, chat_history=full_history
+                                    )
+                                    if mem_update_error:
+                                        memory_span.fail(mem_update_error)
+                                if mem_update_error:
+                                    logging.error("[%s] Авто-память: Ошибка: %s", worker_name, mem_update_error)
+                                else:
+                                    logging.info("[%s] Авто-память: Память персонажа ID %s успешно обновлена.", worker_name, character_id)
+                                    new_anchor_text = find_last_bot_message_text(full_history)
+                                    with auto_mode_lock:
+                                        if chat_id in account_workers: account_workers[chat_id]["bot_last_message_anchor"] = new_anchor_text
+                                    logging.info("[%s] Авто-память: Установлен новый якорь: '%s'", worker_name, new_anchor_text[:50] if new_anchor_text else 'None')
+                    else:
+                        logging.info("[%s] Авто-память отключена в настройках персонажа. Пропуск обновления.", worker_name)
+
+                    tools = []
+                    if settings_for_generation.get('enable_google_search', False):
+                        tools.append(types.Tool(googleSearch=types.GoogleSearch()))
+
+                    thinking_config = None
+                    thinking_models = ['gemini-2.5-pro', 'gemini-2.5-flash', 'gemini-2.5-flash-lite']
+                    model_name_lower = model_name_to_use.lower()
+                    is_thinking_model = any(m in model_name_lower for m in thinking_models)
+
+                    if settings_for_generation.get('enable_thinking', False) and is_thinking_model:
+                        thinking_config = types.ThinkingConfig(thinking_budget=-1)
+                    elif settings_for_generation.get('enable_thinking', False):
+                        logging.warning("[%s] Thinking mode включен, но модель '%s' его не поддерживает. Игнорируется.", worker_name, model_name_to_use)
+
+                    final_generation_config_parts = {}
+                    if tools:
+                        final_generation_config_parts['tools'] = tools
+                    if thinking_config:
+                        final_generation_config_parts['thinking_config'] = thinking_config
+                
+                    final_generation_config = types.GenerateContentConfig(**final_generation_config_parts) if final_generation_config_parts else None
+
+                    overlap_typing = settings_for_generation.get('overlap_typing_with_generation', False)
+                    if overlap_typing:
+                        run_in_telegram_loop(start_generation_typing(chat_id))
+
+                    try:
+                        logging.info("[%s] Вызов Gemini для генерации (лимит истории: %s)...", worker_name, num_messages)
+                        with span("generate_chat_reply_original", model=model_name_to_use, history_blocks=len(full_history)) as generation_span:
+                            generated_text, gen_error = generate_chat_reply_original(
+                                model_name=model_name_to_use, 
+                                system_prompt=final_system_prompt.strip(), 
+                                chat_history=full_history,
+                                config=final_generation_config 
                             )
-                            if mem_update_error:
-                                logging.error(f"[{worker_name}] Авто-память: Ошибка: {mem_update_error}")
+                            if gen_error:
+                                generation_span.fail(gen_error)
                             else:
-                                logging.info(f"[{worker_name}] Авто-память: Память персонажа ID {character_id} успешно обновлена.")
-                                new_anchor_text = find_last_bot_message_text(full_history)
-                                with auto_mode_lock:
-                                    if chat_id in auto_mode_workers: auto_mode_workers[chat_id]["bot_last_message_anchor"] = new_anchor_text
-                                logging.info(f"[{worker_name}] Авто-память: Установлен новый якорь: '{new_anchor_text[:50] if new_anchor_text else 'None'}'")
-                else:
-                    logging.info(f"[{worker_name}] Авто-память отключена в настройках персонажа. Пропуск обновления.")
-
-                tools = []
-                if settings_for_generation.get('enable_google_search', False):
-                    tools.append(types.Tool(googleSearch=types.GoogleSearch()))
-
-                thinking_config = None
-                thinking_models = ['gemini-2.5-pro', 'gemini-2.5-flash', 'gemini-2.5-flash-lite']
-                model_name_lower = model_name_to_use.lower()
-                is_thinking_model = any(m in model_name_lower for m in thinking_models)
-
-                if settings_for_generation.get('enable_thinking', False) and is_thinking_model:
-                    thinking_config = types.ThinkingConfig(thinking_budget=-1)
-                elif settings_for_generation.get('enable_thinking', False):
-                    logging.warning(f"[{worker_name}] Thinking mode включен, но модель '{model_name_to_use}' его не поддерживает. Игнорируется.")
-
-                final_generation_config_parts = {}
-                if tools:
-                    final_generation_config_parts['tools'] = tools
-                if thinking_config:
-                    final_generation_config_parts['thinking_config'] = thinking_config
-                
-                final_generation_config = types.GenerateContentConfig(**final_generation_config_parts) if final_generation_config_parts else None
-
-                logging.info(f"[{worker_name}] Вызов Gemini для генерации (лимит истории: {num_messages})...")
-                generated_text, gen_error = generate_chat_reply_original(
-                    model_name=model_name_to_use, 
-                    system_prompt=final_system_prompt.strip(), 
-                    chat_history=full_history,
-                    config=final_generation_config 
-                )
-                if gen_error:
-                    logging.error(f"[{worker_name}] Ошибка генерации Gemini: {gen_error}")
-                    stop_event.wait(20)
-                elif generated_text and generated_text.strip():
-                    logging.info(f"[{worker_name}] Ответ сгенерирован. Отправка...")
-                    success, error_msg = send_generated_reply(chat_id, generated_text.strip(), settings=settings_for_generation)
-                    if success:
-                        logging.info(f"[{worker_name}] Ответ успешно отправлен.")
-                        last_own_message_sent_time = datetime.now()
-                    else:
-                        logging.error(f"[{worker_name}] Ошибка при отправке: {error_msg}")
-                else:
-                    logging.warning(f"[{worker_name}] Gemini вернул пустой ответ.")
+                                generation_span.set(reply_chars=len(generated_text or ""))
+                        if overlap_typing and (gen_error or not (generated_text and generated_text.strip())):
+                            run_in_telegram_loop(stop_generation_typing(chat_id))
+
+                        if gen_error:
+                            logging.error("[%s] Ошибка генерации Gemini: %s", worker_name, gen_error)
+                            reply_span.fail(gen_error)
+                            with span("retry_pause", seconds=20):
+                                stop_event.wait(20)
+                        elif generated_text and generated_text.strip():
+                            logging.info("[%s] Ответ сгенерирован. Отправка...", worker_name)
+                            success, error_msg = send_generated_reply(chat_id, generated_text.strip(), settings=settings_for_generation)
+                            if success:
+                                logging.info("[%s] Ответ успешно отправлен.", worker_name)
+                                last_own_message_sent_time = datetime.now()
+                            else:
+                                logging.error("[%s] Ошибка при отправке: %s", worker_name, error_msg)
+                                reply_span.fail(error_msg)
+                        else:
+                            logging.warning("[%s] Gemini вернул пустой ответ.", worker_name)
+                    finally:
+                        # Если план отправки не запускался (ответ из одних реакций, пустой текст, исключение),
+                        # индикатор печати снимается здесь, а не висит до GENERATION_TYPING_MAX_S.
+                        if overlap_typing:
+                            run_in_telegram_loop(stop_generation_typing(chat_id))
             
             if not should_generate:
                 stop_event.wait(check_interval)
         
         except Exception as e:
-            logging.exception(f"[{worker_name}] Неперехваченная ошибка в цикле worker: {e}")
+            logging.exception("[%s] Неперехваченная ошибка в цикле worker: %s", worker_name, e)
             stop_event.wait(60)
 
-    logging.info(f"[{worker_name}] Поток завершает работу.")
+    logging.info("[%s] Поток завершает работу.", worker_name)
     with auto_mode_lock:
-        if chat_id in auto_mode_workers:
-            if auto_mode_workers[chat_id].get("status") != "stopping":
-                 auto_mode_workers[chat_id]["status"] = "inactive"
+        if chat_id in account_workers:
+            if account_workers[chat_id].get("status") != "stopping":
+                 account_workers[chat_id]["status"] = "inactive"
 
 @app.route('/')
 def index():
     """Главная страница - выбор чата."""
     logging.info("Запрос GET /")
-    chats_data, error = run_in_telegram_loop(get_chats(limit=CHARTS_LIMIT))
+    force_refresh = request.args.get('refresh') == '1'
+    chats_data, error = run_in_telegram_loop(get_cached_chats(limit=CHARTS_LIMIT, force_refresh=force_refresh))
+    return render_index_page(chats_data, error)
 
+def render_index_page(chats_data, error):
+    """Отрисовывает страницу выбора чата по уже полученному списку чатов."""
     if error:
         flash(f"Ошибка получения списка чатов: {error}", "error")
         logging.error(f"Ошибка при получении чатов: {error}")
@@ -956,9 +1184,11 @@ def index():
          logging.warning("Список чатов пуст или не получен.")
 
     global_settings = load_global_settings()
+    updated_at = get_dialog_list_updated_at()
     return render_template('index.html',
                            chats=chats_data if chats_data else [],
                            error=error,
+                           chats_updated_at=datetime.fromtimestamp(updated_at).strftime('%H:%M:%S') if updated_at else None,
                            global_settings=global_settings)
 
 @app.route('/select_chat', methods=['POST'])
@@ -974,7 +1204,7 @@ def select_chat():
         logging.info(f"Выбран чат с ID: {chat_id}")
         session.pop('generated_reply', None)
         session.pop('last_generation_error', None)
-        session.pop(f'auto_mode_status_{chat_id}', None)
+        session.pop(auto_mode_session_key(chat_id), None)
         return redirect(url_for('chat_page', chat_id=chat_id))
     except ValueError:
         flash("Некорректный ID чата.", "error")
@@ -985,6 +1215,7 @@ def generate_reply(chat_id):
     """
     Обрабатывает ручную генерацию ответа и возвращает результат в формате JSON.
     """
+    from google.genai import types
     logging.info(f"Запрос POST /generate/{chat_id} (AJAX)")
 
     settings_for_generation = get_chat_settings(chat_id)
@@ -1003,7 +1234,9 @@ def generate_reply(chat_id):
     )
     
     limit = settings_for_generation.get('num_messages_to_fetch', DEFAULT_CHAT_SETTINGS['num_messages_to_fetch'])
-    history_data, history_error = run_in_telegram_loop(get_formatted_history(chat_id, limit=limit, settings=settings_for_generation))
+    history_data, history_error = run_in_telegram_loop(get_formatted_history(
+        chat_id, limit=limit, settings=settings_for_generation,
+        token_budget=get_history_token_budget(settings_for_generation)))
 
     if history_error or not history_data:
         error = history_error or "История чата пуста."
@@ -1045,11 +1278,37 @@ def generate_reply(chat_id):
     
     return jsonify({'status': 'success', 'reply': reply_to_send})
 
+def resolve_history_limit(limit_str, settings_to_use) -> int:
+    """Проверяет лимит истории из URL (?limit=) и при ошибке возвращает лимит из настроек чата."""
+    current_limit_from_settings = settings_to_use.get('num_messages_to_fetch', DEFAULT_CHAT_SETTINGS['num_messages_to_fetch'])
+    if limit_str is None:
+        return current_limit_from_settings
+    try:
+        current_limit = int(limit_str)
+        if not (0 < current_limit <= CHAT_LIMIT):
+            logging.warning("Недопустимый лимит %s из URL, используется %s", current_limit, current_limit_from_settings)
+            current_limit = current_limit_from_settings
+    except ValueError:
+        logging.warning("Некорректный лимит '%s' из URL, используется %s", limit_str, current_limit_from_settings)
+        current_limit = current_limit_from_settings
+    return current_limit
+
 @app.route('/chat/<sint:chat_id>')
 def chat_page(chat_id):
+    """
+    Страница чата. Отрисовывается сразу, без запросов к Telegram: название чата
+    берется из кэша, а история подгружается страницами через /chat/<id>/history.
+    """
     logging.info(f"Запрос GET /chat/{chat_id}")
 
     settings_to_use = get_chat_settings(chat_id)
+    current_limit = resolve_history_limit(request.args.get('limit'), settings_to_use)
+
+    return render_chat_page(chat_id, settings_to_use, current_limit, get_cached_chat_info(chat_id))
+
+def render_chat_page(chat_id, settings_to_use, current_limit, chat_info_data):
+    """Отрисовывает каркас страницы чата (без истории сообщений)."""
+    account_workers = get_auto_mode_workers()
     active_character_id = settings_to_use.get('active_character_id')
     
     active_character_data = None
@@ -1061,49 +1320,25 @@ def chat_page(chat_id):
             enabled_packs = active_character_data.get('enabled_sticker_packs', [])
             sticker_prompt_text = generate_sticker_prompt(enabled_packs)
 
-    current_limit_from_settings = settings_to_use.get('num_messages_to_fetch', DEFAULT_CHAT_SETTINGS['num_messages_to_fetch'])
-    limit_str = request.args.get('limit', str(current_limit_from_settings))
-    try:
-        current_limit = int(limit_str)
-        if not (0 < current_limit <= CHAT_LIMIT):
-            logging.warning(f"Недопустимый лимит {current_limit} из URL, используется {current_limit_from_settings}")
-            current_limit = current_limit_from_settings
-    except ValueError:
-        logging.warning(f"Некорректный лимит '{limit_str}' из URL, используется {current_limit_from_settings}")
-        current_limit = current_limit_from_settings
-
-    logging.info(f"Запрос информации для чата {chat_id}")
-    chat_info_data, info_error = run_in_telegram_loop(get_chat_info(chat_id))
-    if info_error:
-        flash(f"Не удалось получить информацию о чате: {info_error}", "warning")
-        logging.warning(f"Ошибка получения инфо о чате {chat_id}: {info_error}")
-
     with auto_mode_lock:
-        worker_info = auto_mode_workers.get(chat_id)
+        worker_info = account_workers.get(chat_id)
         if worker_info and worker_info["thread"] and worker_info["thread"].is_alive():
              auto_mode_status = worker_info["status"] 
         else:
              auto_mode_status = "inactive"
-             if chat_id in auto_mode_workers:
-                 del auto_mode_workers[chat_id]
-    session[f'auto_mode_status_{chat_id}'] = auto_mode_status
-
-    logging.info(f"Запрос истории для чата {chat_id} с лимитом {current_limit} (быстрый режим)")
-    history_data, history_error = run_in_telegram_loop(
-        get_formatted_history(chat_id, limit=current_limit, settings=settings_to_use, download_media=False)
-    )
+             if chat_id in account_workers:
+                 del account_workers[chat_id]
+    session[auto_mode_session_key(chat_id)] = auto_mode_status
 
     all_characters = character_utils.load_characters()
     
-    sticker_db = load_sticker_data()
-    structured_stickers = structure_sticker_data(sticker_db)
+    structured_stickers = get_structured_sticker_data()
 
     return render_template(
         'chat.html',
         chat_id=chat_id,
         chat_info=chat_info_data,
-        history=history_data if history_data else [],
-        history_error=history_error,
+        history_page_size=HISTORY_PAGE_SIZE,
         generated_reply=None,  
         generation_error=None, 
         sticker_prompt_text_for_js=sticker_prompt_text,
@@ -1117,6 +1352,51 @@ def chat_page(chat_id):
         active_character_data=active_character_data
     )
 
+def parse_history_page_args(args):
+    """Разбирает параметры offset_id и limit запроса страницы истории."""
+    try:
+        offset_id = max(0, int(args.get('offset_id', 0) or 0))
+    except ValueError:
+        offset_id = 0
+    try:
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    return offset_id, min(max(limit, 1), HISTORY_PAGE_SIZE)
+
+@app.route('/chat/<sint:chat_id>/history')
+def chat_history_page(chat_id):
+    """
+    Одна страница истории чата в JSON: готовый HTML блоков сообщений и курсор
+    next_offset_id для следующей (более старой) страницы.
+    """
+    offset_id, limit = parse_history_page_args(request.args)
+    logging.info("Запрос GET /chat/%s/history (offset_id=%s, limit=%s)", chat_id, offset_id, limit)
+    settings_to_use = get_chat_settings(chat_id)
+
+    chat_info_data = get_cached_chat_info(chat_id)
+    if not offset_id and not chat_info_data:
+        chat_info_data, _ = run_in_telegram_loop(get_chat_info(chat_id))
+
+    page, error = run_in_telegram_loop(
+        get_history_page(chat_id, limit=limit, settings=settings_to_use, download_media=False, offset_id=offset_id)
+    )
+    return history_page_response(page, error, chat_info_data)
+
+def history_page_response(page, error, chat_info_data):
+    """Формирует JSON-ответ со страницей истории (общий для Flask и ASGI-режима)."""
+    if error and not (page and page["messages"]):
+        return jsonify({'status': 'error', 'message': error}), 500
+
+    return jsonify({
+        'status': 'success',
+        'html': render_template('_history_messages.html', history=page["messages"]),
+        'message_count': len(page["messages"]),
+        'fetched_count': page["fetched_count"],
+        'next_offset_id': page["next_offset_id"],
+        'chat_info': chat_info_data,
+    })
+
 @app.route('/media/<sint:chat_id>/<int:message_id>')
 def get_media(chat_id, message_id):
     """
@@ -1130,6 +1410,96 @@ def get_media(chat_id, message_id):
     
     return jsonify({'status': 'success', 'parts': media_parts})
 
+def parse_media_batch_ids(payload) -> list:
+    """Достает из JSON {"ids": [...]} список уникальных ID сообщений (не больше MEDIA_BATCH_MAX_IDS)."""
+    raw_ids = payload.get('ids') if isinstance(payload, dict) else None
+    if not isinstance(raw_ids, list):
+        return []
+    message_ids = []
+    for raw_id in raw_ids:
+        try:
+            message_id = int(raw_id)
+        except (TypeError, ValueError):
+            continue
+        if message_id > 0 and message_id not in message_ids:
+            message_ids.append(message_id)
+            if len(message_ids) >= MEDIA_BATCH_MAX_IDS:
+                break
+    return message_ids
+
+def media_batch_wants_files(payload) -> bool:
+    """Клиент просит вместо base64 только ссылки на файлы из кэша: {"ids": [...], "format": "url"}."""
+    return isinstance(payload, dict) and payload.get('format') == 'url'
+
+def media_batch_line(chat_id, message_id, media_result, error, as_files=False) -> str:
+    """Одна строка NDJSON-ответа пакетной загрузки медиа."""
+    if error:
+        item = {'message_id': message_id, 'status': 'error', 'message': error}
+    elif as_files:
+        item = {'message_id': message_id, 'status': 'success', 'url': media_file_url(chat_id, message_id),
+                'media_type': media_result['media_type'], 'mime_type': media_result['mime_type']}
+    else:
+        item = {'message_id': message_id, 'status': 'success', 'parts': media_result}
+    return json.dumps(item, ensure_ascii=False) + "\n"
+
+@app.route('/media/<sint:chat_id>/batch', methods=['POST'])
+def get_media_batch(chat_id):
+    """
+    Пакетная загрузка медиа: принимает JSON {"ids": [...]} и отдает NDJSON,
+    по одной строке на сообщение в порядке готовности.
+    С "format": "url" медиа только сохраняется в кэш, а в ответе вместо base64 приходит ссылка на файл.
+    """
+    payload = request.get_json(silent=True)
+    message_ids = parse_media_batch_ids(payload)
+    if not message_ids:
+        return jsonify({'status': 'error', 'message': 'Не переданы ID сообщений.'}), 400
+    as_files = media_batch_wants_files(payload)
+
+    logging.info("AJAX-запрос на пакетное получение медиа для %s сообщений в чате %s", len(message_ids), chat_id)
+
+    def generate():
+        media_iter = iter_media_for_messages(chat_id, message_ids, as_files=as_files)
+        for message_id, media_result, error in stream_in_telegram_loop(media_iter):
+            yield media_batch_line(chat_id, message_id, media_result, error, as_files)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def media_file_url(chat_id, message_id) -> str:
+    """Адрес файла медиа сообщения (маршрут get_media_file) в текущем аккаунте."""
+    return f"{account_url_prefix()}/media/{chat_id}/{message_id}/file"
+
+@app.template_global()
+def cached_media_url(chat_id, message_id):
+    """Адрес файла медиа, если он уже есть в дисковом кэше, иначе None (тогда на странице остается заглушка)."""
+    file_path, _ = find_cached_media_file(chat_id, message_id)
+    return media_file_url(chat_id, message_id) if file_path else None
+
+def media_file_error_status(error) -> int:
+    """HTTP-статус для ошибки загрузки файла медиа."""
+    if error.startswith("Message not found") or error.startswith("Unsupported media type"):
+        return 404
+    return 500
+
+@app.route('/media/<sint:chat_id>/<int:message_id>/file')
+def get_media_file(chat_id, message_id):
+    """
+    Отдает медиа сообщения как обычный файл из дискового кэша (для <img>/<video> на странице).
+    Поддерживаются ETag/Last-Modified (ответ 304), Range-запросы для перемотки видео
+    и долгий Cache-Control: файл сообщения в Telegram не меняется.
+    """
+    file_path, mime_type = find_cached_media_file(chat_id, message_id)
+    if not file_path:
+        logging.info("Файла медиа для сообщения %s в чате %s нет в кэше, загрузка...", message_id, chat_id)
+        media_file, error = run_in_telegram_loop(get_media_file_for_message(chat_id, message_id))
+        if error:
+            return jsonify({'status': 'error', 'message': error}), media_file_error_status(error)
+        file_path, mime_type = media_file['path'], media_file['mime_type']
+
+    response = send_file(os.path.abspath(file_path), mimetype=mime_type, conditional=True, etag=True,
+                         max_age=MEDIA_FILE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/update_sticker_status/<sint:chat_id>', methods=['POST'])
 def update_sticker_status(chat_id):
     """
@@ -1161,21 +1531,22 @@ def update_sticker_status(chat_id):
 @app.route('/start_auto_mode/<sint:chat_id>', methods=['POST'])
 def start_auto_mode(chat_id):
     logging.info(f"Запрос POST /start_auto_mode/{chat_id}")
+    account_workers = get_auto_mode_workers()
 
     with auto_mode_lock:
-        if chat_id in auto_mode_workers and auto_mode_workers[chat_id]["thread"] and auto_mode_workers[chat_id]["thread"].is_alive():
+        if chat_id in account_workers and account_workers[chat_id]["thread"] and account_workers[chat_id]["thread"].is_alive():
              flash(f"Авто-режим для чата {chat_id} уже активен или останавливается.", "warning")
         else:
              logging.info(f"Запуск потока авто-режима для чата {chat_id}...")
              stop_event = threading.Event()
              thread = threading.Thread(
-                 target=auto_mode_worker,
-                 args=(chat_id, stop_event),
+                 target=contextvars.copy_context().run,
+                 args=(auto_mode_worker, chat_id, stop_event),
                  name=f"AutoMode-{chat_id}",
                  daemon=True 
              )
              
-             auto_mode_workers[chat_id] = {
+             account_workers[chat_id] = {
                  "thread": thread, 
                  "stop_event": stop_event, 
                  "status": "active",
@@ -1183,7 +1554,7 @@ def start_auto_mode(chat_id):
              }
              
              thread.start()
-             session[f'auto_mode_status_{chat_id}'] = "active" 
+             session[auto_mode_session_key(chat_id)] = "active" 
              flash(f"Авто-режим для чата {chat_id} запущен.", "success")
 
     return redirect(url_for('chat_page', chat_id=chat_id))
@@ -1191,42 +1562,192 @@ def start_auto_mode(chat_id):
 @app.route('/stop_auto_mode/<sint:chat_id>', methods=['POST'])
 def stop_auto_mode(chat_id):
     logging.info(f"Запрос POST /stop_auto_mode/{chat_id}")
+    account_workers = get_auto_mode_workers()
 
     with auto_mode_lock:
-        worker_info = auto_mode_workers.get(chat_id)
+        worker_info = account_workers.get(chat_id)
         if worker_info and worker_info["thread"] and worker_info["thread"].is_alive() and worker_info["status"] == "active":
              logging.info(f"Отправка сигнала остановки потоку авто-режима для чата {chat_id}...")
              worker_info["stop_event"].set()
              worker_info["status"] = "stopping" 
-             session[f'auto_mode_status_{chat_id}'] = "stopping"
+             session[auto_mode_session_key(chat_id)] = "stopping"
              flash(f"Авто-режим для чата {chat_id} останавливается...", "info")
         elif worker_info and worker_info["status"] == "stopping":
              flash(f"Авто-режим для чата {chat_id} уже в процессе остановки.", "info")
         else:
              flash(f"Авто-режим для чата {chat_id} не был активен.", "warning")
-             if chat_id in auto_mode_workers:
-                 del auto_mode_workers[chat_id]
-             session[f'auto_mode_status_{chat_id}'] = "inactive"
+             if chat_id in account_workers:
+                 del account_workers[chat_id]
+             session[auto_mode_session_key(chat_id)] = "inactive"
+
+    return redirect(url_for('chat_page', chat_id=chat_id))
+
+@app.route('/cancel_sending/<sint:chat_id>', methods=['POST'])
+def cancel_sending(chat_id):
+    """Отменяет еще не отправленные части ответов в очереди чата."""
+    logging.info("Запрос POST /cancel_sending/%s", chat_id)
+
+    cancelled_parts, error = run_in_telegram_loop(cancel_pending_sends(chat_id))
+    if error:
+        flash(f"Не удалось отменить отправку: {error}", "error")
+    elif cancelled_parts:
+        flash(f"Отправка отменена. Пропущено частей: {cancelled_parts}.", "success")
+    else:
+        flash("В очереди отправки этого чата ничего нет.", "info")
 
     return redirect(url_for('chat_page', chat_id=chat_id))
 
+@app.route('/send_queue_stats')
+def send_queue_stats():
+    """Возвращает состояние очередей отправки (длина очереди и время текущей отправки)."""
+    return jsonify({'status': 'success', 'queues': {str(chat_id): stats for chat_id, stats in get_send_queue_stats().items()}})
+
+READY_MAX_LOOP_LAG_S = 2.0
+
+def get_auto_mode_health():
+    """
+    Потоки авто-режима по аккаунтам: {ключ: {статус: число потоков}}. Поток, который завершился,
+    хотя его не останавливали (статус active), считается как "dead".
+    """
+    with auto_mode_lock:
+        snapshot = {key: list(account_workers.values()) for key, account_workers in auto_mode_workers.items()}
+    health = {}
+    for key, workers in snapshot.items():
+        counts = {}
+        for worker_info in workers:
+            status = worker_info["status"]
+            if status == "active" and not (worker_info["thread"] and worker_info["thread"].is_alive()):
+                status = "dead"
+            counts[status] = counts.get(status, 0) + 1
+        health[key] = counts
+    return health
+
+def build_liveness_report():
+    """Живость процесса для /healthz: цикл Telethon запущен и проба лага в нем отмечалась недавно."""
+    telegram_health = get_telegram_health()
+    alive = telegram_health["loop_responsive"]
+    return alive, {
+        'status': 'ok' if alive else 'error',
+        'instance': INSTANCE_NUMBER,
+        'uptime_s': round(time.perf_counter() - STARTUP_STARTED_AT, 1),
+        'telegram_loop': {name: telegram_health[name] for name in
+                          ('loop_running', 'loop_responsive', 'loop_lag_ms', 'loop_max_lag_ms', 'loop_probe_age_s')},
+    }
+
+def build_readiness_report():
+    """
+    Готовность принимать трафик для /readyz: цикл Telethon отвечает без большого лага
+    (READY_MAX_LOOP_LAG_S), все аккаунты подключены, клиент Gemini создан и API доступен.
+    Состояние авто-режима и очередей отправки выводится для наблюдения, но на готовность не влияет.
+    """
+    telegram_health = get_telegram_health()
+    gemini_health = get_gemini_health()
+    loop_lag_ms = telegram_health["loop_lag_ms"]
+    checks = {
+        'telegram_loop': telegram_health["loop_responsive"],
+        'telegram_loop_lag': loop_lag_ms is not None and loop_lag_ms <= READY_MAX_LOOP_LAG_S * 1000.0,
+        'telegram_connected': bool(telegram_health["accounts"]) and all(
+            account["connected"] for account in telegram_health["accounts"].values()),
+        'gemini_client': gemini_health["client"] == "ready",
+        'gemini_reachable': gemini_health["reachable"] is not False,
+    }
+    ready = all(checks.values())
+    return ready, {
+        'status': 'ok' if ready else 'error',
+        'instance': INSTANCE_NUMBER,
+        'checks': checks,
+        'telegram': telegram_health,
+        'gemini': gemini_health,
+        'auto_mode': get_auto_mode_health(),
+    }
+
+@app.route('/healthz')
+def healthz():
+    """Проверка живости для супервизора: 200, если процесс и цикл Telethon работают, иначе 503."""
+    alive, report = build_liveness_report()
+    return jsonify(report), 200 if alive else 503
+
+@app.route('/readyz')
+def readyz():
+    """Проверка готовности для балансировщика: 200, если все проверки из checks пройдены, иначе 503."""
+    ready, report = build_readiness_report()
+    return jsonify(report), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus (общие для всех аккаунтов)."""
+    return Response(metrics.render_metrics(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/traces')
+def traces_page():
+    """Водопад последних трасс ответов авто-режима (?limit=N, по умолчанию TRACES_VIEW_LIMIT)."""
+    limit = max(1, min(request.args.get('limit', TRACES_VIEW_LIMIT, type=int), TRACES_VIEW_MAX_LIMIT))
+    traces = load_recent_traces(limit)
+    for trace in traces:
+        trace["started_at"] = datetime.fromtimestamp(trace["start"]).strftime('%Y-%m-%d %H:%M:%S')
+        trace["rows"] = waterfall_rows(trace)
+    return render_template('traces.html', traces=traces, limit=limit)
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+def is_profiler_request_allowed():
+    """
+    Профайлер доступен только администратору: если задан PROFILER_TOKEN - по токену
+    (заголовок X-Profiler-Token или ?token=), иначе только с localhost.
+    """
+    if PROFILER_TOKEN:
+        supplied_token = request.headers.get('X-Profiler-Token') or request.args.get('token', '')
+        return hmac.compare_digest(supplied_token.encode(), PROFILER_TOKEN.encode())
+    return request.remote_addr in LOCAL_ADDRESSES
+
+@app.route('/profiler')
+def profiler_status():
+    """Состояние профайлера: текущий и последний профиль, список файлов для скачивания."""
+    if not is_profiler_request_allowed():
+        return jsonify({'status': 'error', 'message': 'Доступ запрещен.'}), 403
+    return jsonify({'status': 'success', **profiler.get_profile_status()})
+
+@app.route('/profiler/start', methods=['POST'])
+def profiler_start():
+    """Запускает сэмплирующий профайлер всех потоков (?seconds=N&interval_ms=M)."""
+    if not is_profiler_request_allowed():
+        return jsonify({'status': 'error', 'message': 'Доступ запрещен.'}), 403
+    seconds = request.values.get('seconds', profiler.DEFAULT_PROFILE_SECONDS, type=float)
+    interval_ms = request.values.get('interval_ms', profiler.DEFAULT_SAMPLE_INTERVAL_S * 1000.0, type=float)
+    profile, error = profiler.start_profile(seconds, interval_ms / 1000.0)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 409
+    logging.info("Запрос POST /profiler/start: профиль на %s сек.", profile['seconds'])
+    return jsonify({'status': 'success', 'profile': profile})
+
+@app.route('/profiler/download/<file_name>')
+def profiler_download(file_name):
+    """Отдает файл профиля в формате collapsed stacks (для flamegraph.pl, speedscope, inferno)."""
+    if not is_profiler_request_allowed():
+        return jsonify({'status': 'error', 'message': 'Доступ запрещен.'}), 403
+    file_path = profiler.profile_file_path(file_name)
+    if not file_path:
+        return jsonify({'status': 'error', 'message': 'Профиль не найден.'}), 404
+    return send_file(os.path.abspath(file_path), mimetype='text/plain', as_attachment=True, download_name=file_name)
+
 @app.route('/save_global_settings', methods=['POST'])
 def save_global_settings_route():
     """Сохраняет глобальные настройки."""
     logging.info("Запрос POST /save_global_settings")
 
     try:
-        settings_to_save = {
+        settings_to_save = load_global_settings()
+        settings_to_save.update({
             'media_cleanup_enabled': 'media_cleanup_enabled' in request.form,
             'media_cleanup_days': int(request.form.get('media_cleanup_days', 7)),
-        }
+        })
 
         if save_global_settings(settings_to_save):
             flash("Глобальные настройки успешно сохранены.", "success")
             if settings_to_save['media_cleanup_enabled']:
                 days = settings_to_save['media_cleanup_days']
                 logging.info(f"Запуск очистки кэша по запросу после сохранения настроек (файлы старше {days} дней).")
-                cleanup_old_cache_files(directory="media_cache", max_age_days=days)
+                cleanup_media_caches(max_age_days=days)
         else:
             flash("Ошибка при сохранении глобальных настроек.", "error")
 
@@ -1271,6 +1792,7 @@ def save_chat_settings_route(chat_id):
             'enable_google_search': 'enable_google_search' in request.form,
             'enable_thinking': 'enable_thinking' in request.form,
             'num_messages_to_fetch': int(request.form.get('num_messages_to_fetch')),
+            'history_token_budget': max(0, int(request.form.get('history_token_budget') or 0)),
             'sticker_choosing_delay_min': float(request.form.get('sticker_choosing_delay_min')),
             'sticker_choosing_delay_max': float(request.form.get('sticker_choosing_delay_max')),
             'base_thinking_delay_s_min': float(request.form.get('base_thinking_delay_s_min')),
@@ -1278,6 +1800,8 @@ def save_chat_settings_route(chat_id):
             'typing_delay_ms_min': float(request.form.get('typing_delay_ms_min')),
             'typing_delay_ms_max': float(request.form.get('typing_delay_ms_max')),
             'max_typing_duration_s': float(request.form.get('max_typing_duration_s')),
+            'cancel_reply_on_new_message': 'cancel_reply_on_new_message' in request.form,
+            'overlap_typing_with_generation': 'overlap_typing_with_generation' in request.form,
             'substitution_chance': float(request.form.get('substitution_chance')),
             'transposition_chance': float(request.form.get('transposition_chance')),
             'skip_chance': float(request.form.get('skip_chance')),
@@ -1481,34 +2005,215 @@ def send_reply(chat_id):
 
     return redirect(url_for('chat_page', chat_id=chat_id))
 
+# --- ASGI-режим (python main.py --asgi) ---
+# Горячие маршруты ниже выполняются прямо в цикле событий Telethon и ожидают
+# корутины telegram_utils через await, без перехода между потоками.
+# Все остальные URL по-прежнему обслуживает Flask-приложение (в пуле потоков).
+
+async def asgi_index(request):
+    from asgi_utils import render_in_flask_context
+    logging.info("Запрос GET / (ASGI)")
+    force_refresh = request.query_params.get('refresh') == '1'
+    chats_data, error = await await_in_telegram_loop(get_cached_chats(limit=CHARTS_LIMIT, force_refresh=force_refresh))
+    return await render_in_flask_context(app, request, render_index_page, chats_data, error)
+
+async def asgi_chat_history_page(request):
+    from asgi_utils import render_in_flask_context
+    chat_id = request.path_params['chat_id']
+    offset_id, limit = parse_history_page_args(request.query_params)
+    logging.info("Запрос GET /chat/%s/history (offset_id=%s, limit=%s, ASGI)", chat_id, offset_id, limit)
+    # Настройки читаются из JSON-файла: в пуле потоков, чтобы не задерживать общий цикл Telethon.
+    settings_to_use = await asyncio.to_thread(get_chat_settings, chat_id)
+
+    chat_info_data = get_cached_chat_info(chat_id)
+    if not offset_id and not chat_info_data:
+        chat_info_data, _ = await await_in_telegram_loop(get_chat_info(chat_id))
+
+    page, error = await await_in_telegram_loop(
+        get_history_page(chat_id, limit=limit, settings=settings_to_use, download_media=False, offset_id=offset_id)
+    )
+    return await render_in_flask_context(app, request, history_page_response, page, error, chat_info_data)
+
+async def asgi_get_media(request):
+    from starlette.responses import JSONResponse
+    chat_id = request.path_params['chat_id']
+    message_id = request.path_params['message_id']
+    logging.info("AJAX-запрос на получение медиа для сообщения %s в чате %s (ASGI)", message_id, chat_id)
+    media_parts, error = await await_in_telegram_loop(get_media_for_message(chat_id, message_id))
+
+    if error:
+        return JSONResponse({'status': 'error', 'message': error}, status_code=500)
+
+    return JSONResponse({'status': 'success', 'parts': media_parts})
+
+async def asgi_get_media_batch(request):
+    from starlette.responses import JSONResponse, StreamingResponse
+    chat_id = request.path_params['chat_id']
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    message_ids = parse_media_batch_ids(payload)
+    if not message_ids:
+        return JSONResponse({'status': 'error', 'message': 'Не переданы ID сообщений.'}, status_code=400)
+    as_files = media_batch_wants_files(payload)
+
+    logging.info("AJAX-запрос на пакетное получение медиа для %d сообщений в чате %s (ASGI)", len(message_ids), chat_id)
+
+    async def generate():
+        async for message_id, media_result, error in iter_media_for_messages(chat_id, message_ids, as_files=as_files):
+            yield media_batch_line(chat_id, message_id, media_result, error, as_files)
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+async def asgi_get_media_file(request):
+    from starlette.responses import FileResponse, JSONResponse
+    from starlette.staticfiles import NotModifiedResponse
+    chat_id = request.path_params['chat_id']
+    message_id = request.path_params['message_id']
+
+    file_path, mime_type = find_cached_media_file(chat_id, message_id)
+    if not file_path:
+        logging.info("Файла медиа для сообщения %s в чате %s нет в кэше, загрузка... (ASGI)", message_id, chat_id)
+        media_file, error = await await_in_telegram_loop(get_media_file_for_message(chat_id, message_id))
+        if error:
+            return JSONResponse({'status': 'error', 'message': error}, status_code=media_file_error_status(error))
+        file_path, mime_type = media_file['path'], media_file['mime_type']
+
+    response = FileResponse(file_path, media_type=mime_type, stat_result=os.stat(file_path),
+                            headers={'Cache-Control': f'public, max-age={MEDIA_FILE_MAX_AGE}, immutable'})
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and response.headers['etag'] in [tag.strip() for tag in if_none_match.split(',')]:
+        return NotModifiedResponse(response.headers)
+    return response
+
+async def asgi_send_queue_stats(request):
+    from starlette.responses import JSONResponse
+    return JSONResponse({'status': 'success', 'queues': {str(chat_id): stats for chat_id, stats in get_send_queue_stats().items()}})
+
+async def asgi_healthz(request):
+    from starlette.responses import JSONResponse
+    alive, report = build_liveness_report()
+    return JSONResponse(report, status_code=200 if alive else 503)
+
+async def asgi_readyz(request):
+    from starlette.responses import JSONResponse
+    ready, report = build_readiness_report()
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+async def asgi_metrics(request):
+    from starlette.responses import Response as StarletteResponse
+    return StarletteResponse(metrics.render_metrics(), headers={'content-type': metrics.CONTENT_TYPE})
+
+ASGI_NATIVE_ROUTES = [
+    ('/', asgi_index, ['GET']),
+    ('/chat/{chat_id:sint}/history', asgi_chat_history_page, ['GET']),
+    ('/media/{chat_id:sint}/batch', asgi_get_media_batch, ['POST']),
+    ('/media/{chat_id:sint}/{message_id:int}/file', asgi_get_media_file, ['GET']),
+    ('/media/{chat_id:sint}/{message_id:int}', asgi_get_media, ['GET']),
+    ('/send_queue_stats', asgi_send_queue_stats, ['GET']),
+    ('/healthz', asgi_healthz, ['GET']),
+    ('/readyz', asgi_readyz, ['GET']),
+    ('/metrics', asgi_metrics, ['GET']),
+]
+
+def account_prefix_asgi(asgi_app):
+    """
+    ASGI-аналог AccountPrefixMiddleware: префикс /a/<ключ аккаунта> переносится в root_path
+    (маршруты Starlette и Flask сопоставляются без него), а аккаунт становится текущим для запроса.
+    """
+    async def app_with_account(scope, receive, send):
+        if scope["type"] == "http":
+            root_path = scope.get("root_path", "")
+            key, _ = split_account_prefix(scope["path"][len(root_path):])
+            if key is not None:
+                scope = dict(scope, root_path=root_path + ACCOUNT_URL_PREFIX + key)
+            use_account(key)
+        await asgi_app(scope, receive, send)
+    return app_with_account
+
+def run_asgi_mode(accounts: list, port: int):
+    """
+    Запускает Telethon и ASGI-сервер (uvicorn) в одном цикле событий в главном потоке.
+    Возвращается после остановки сервера (Ctrl+C), предварительно отключив Telegram.
+    """
+    from asgi_utils import create_asgi_app, serve_asgi_app
+
+    async def run_all():
+        telegram_task = asyncio.create_task(telegram_main_loop(
+            TELAGRAMM_API_ID,
+            TELAGRAMM_API_HASH,
+            accounts,
+            telegram_ready_event
+        ))
+        logging.info("Ожидание инициализации Telegram...")
+        with startup_phase("telegram_connect"):
+            await asyncio.to_thread(telegram_ready_event.wait)
+        logging.info(Fore.GREEN + "Сигнал готовности Telegram получен. ASGI-сервер запускается.")
+        start_media_cache_cleanup()
+        print_startup_profile()
+
+        try:
+            await serve_asgi_app(account_prefix_asgi(create_asgi_app(app, ASGI_NATIVE_ROUTES)), host='0.0.0.0', port=port)
+        finally:
+            await asyncio.to_thread(stop_telegram_thread)
+            try:
+                await asyncio.wait_for(telegram_task, timeout=15)
+            except asyncio.TimeoutError:
+                logging.warning("Цикл Telethon не завершился вовремя.")
+
+    asyncio.run(run_all())
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Запуск Telegram AI бота.")
     parser.add_argument('--account', type=int, help='Номер аккаунта для автоматического выбора.')
+    parser.add_argument('--asgi', action='store_true', help='Запустить веб-интерфейс в ASGI-режиме (uvicorn) в одном цикле событий с Telethon.')
+    parser.add_argument('--all-accounts', action='store_true', help=f'Запустить все аккаунты из {ACCOUNTS_JSON_FILE} в одном процессе (адреса /a/<ключ аккаунта>/...).')
+    parser.add_argument('--profile-startup', action='store_true', help='Вывести длительность этапов запуска (импорт, аккаунты, подключение к Telegram, фоновые задачи).')
     args = parser.parse_args()
+    profile_startup_enabled = args.profile_startup
+    record_startup_phase("imports", time.perf_counter() - STARTUP_STARTED_AT)
+
+    log_utils.setup_logging()
+    for logging_error in log_utils.apply_logging_settings(load_global_settings()):
+        logging.warning("Настройки логирования: %s", logging_error)
+    log_utils.watch_settings_file(GLOBAL_SETTINGS_FILE, load_global_settings)
     
     flask_port = 5000 + INSTANCE_NUMBER 
 
     initialize_gemini()
-
-    global_settings = load_global_settings()
-    if global_settings.get('media_cleanup_enabled', True):
-        cleanup_days = global_settings.get('media_cleanup_days', 7)
-        logging.info(f"Запуск очистки кэша при старте (файлы старше {cleanup_days} дней).")
-        cleanup_old_cache_files(directory="media_cache", max_age_days=cleanup_days)
-    else:
-        logging.info("Автоматическая очистка кэша при старте отключена в настройках.")
-    
-    selected_session = choose_account_from_console(args.account)
+    profiler.install_signal_handler()
+
+    with startup_phase("accounts"):
+        if args.all_accounts:
+            selected_accounts = register_all_accounts()
+            multi_account_mode = bool(selected_accounts)
+            if not selected_accounts:
+                print(Fore.YELLOW + f"Файл '{ACCOUNTS_JSON_FILE}' не найден или пуст. Используется сессия по умолчанию: '{DEFAULT_SESSION_NAME}'")
+                selected_accounts = register_selected_account(DEFAULT_SESSION_NAME)
+        else:
+            selected_accounts = register_selected_account(choose_account_from_console(args.account))
+
+    if args.asgi:
+        print(Fore.CYAN + f"=== Запуск инстанса #{INSTANCE_NUMBER} (ASGI) ===")
+        print(Fore.CYAN + f"Веб-интерфейс будет доступен по адресу: http://127.0.0.1:{flask_port}")
+        print_account_urls(flask_port)
+        run_asgi_mode(selected_accounts, flask_port)
+        raise SystemExit(0)
     
-    start_telegram_thread(selected_session)
+    with startup_phase("telegram_connect"):
+        start_telegram_thread(selected_accounts)
     
-    atexit.register(stop_telegram_thread)
+        atexit.register(stop_telegram_thread)
     
-    logging.info("Ожидание инициализации Telegram...")
-    telegram_ready_event.wait() 
+        logging.info("Ожидание инициализации Telegram...")
+        telegram_ready_event.wait() 
     logging.info(Fore.GREEN + "Сигнал готовности Telegram получен. Сервер Flask запускается.")
+    start_media_cache_cleanup()
     
     print(Fore.CYAN + f"=== Запуск инстанса #{INSTANCE_NUMBER} ===")
     print(Fore.CYAN + f"Веб-интерфейс будет доступен по адресу: http://127.0.0.1:{flask_port}")
+    print_account_urls(flask_port)
+    print_startup_profile()
 
     app.run(debug=True, host='0.0.0.0', port=flask_port, use_reloader=False)
\ No newline at end of file
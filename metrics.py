@@ -0,0 +1,184 @@
+"""
+Метрики горячих путей в текстовом формате Prometheus без внешних сервисов:
+счетчики, датчики и гистограммы хранятся в памяти процесса и отдаются по /metrics.
+Обновлять метрики можно из любого потока (Flask, цикл Telethon, потоки авто-режима).
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (1024, 16 * 1024, 128 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 20 * 1024 ** 2, 50 * 1024 ** 2)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+REGISTRY = []
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+class Metric:
+    """Общая часть метрик: имя, описание, имена меток и значения по наборам меток."""
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        unknown = set(labels) - set(self.labelnames)
+        if unknown:
+            raise ValueError(f"Метрика {self.name}: неизвестные метки {sorted(unknown)}")
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        """Список (суффикс имени, значения меток, доп. метки, значение) для вывода."""
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    Датчик. Если задан collect, значения берутся из него в момент выдачи:
+    collect() возвращает число (для датчика без меток) или словарь {значения меток: число}.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        collected = self.collect()
+        if not isinstance(collected, dict):
+            collected = {(): collected}
+        return [("", tuple(str(value) for value in (key if isinstance(key, tuple) else (key,))), (), value)
+                for key, value in sorted(collected.items())]
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Контекстный менеджер: наблюдает длительность блока в секундах."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(state["counts"]), state["sum"], state["count"])
+                        for key, state in sorted(self._values.items())]
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, (("le", _format_value(upper_bound)),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=(), collect=None):
+    return _register(Gauge(name, documentation, labelnames, collect))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+def render_metrics():
+    """Все зарегистрированные метрики в текстовом формате Prometheus (версия 0.0.4)."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HISTORY_SECONDS = histogram(
+    "teekagram_history_seconds", "Время получения и форматирования страницы истории (get_formatted_history / get_history_page).")
+HISTORY_MESSAGES = histogram(
+    "teekagram_history_messages", "Число сообщений Telegram в одной запрошенной странице истории.", buckets=COUNT_BUCKETS)
+MEDIA_DOWNLOAD_SECONDS = histogram(
+    "teekagram_media_download_seconds", "Время загрузки медиа из Telegram (без попаданий в дисковый кэш).", ("media_type",))
+MEDIA_DOWNLOAD_BYTES = histogram(
+    "teekagram_media_download_bytes", "Размер медиа, загруженного из Telegram.", ("media_type",), buckets=SIZE_BUCKETS)
+MEDIA_CACHE_HITS = counter(
+    "teekagram_media_cache_hits_total", "Медиа, найденное в дисковом кэше без загрузки из Telegram.")
+GEMINI_REQUEST_SECONDS = histogram(
+    "teekagram_gemini_request_seconds", "Задержка generate_chat_reply_original по модели и исходу.", ("model", "outcome"))
+GEMINI_RATE_LIMITED = counter(
+    "teekagram_gemini_rate_limited_total", "Ответы Gemini 429 (Resource Exhausted).", ("model",))
+TELEGRAM_LOOP_QUEUE_SECONDS = histogram(
+    "teekagram_telegram_loop_queue_seconds", "Задержка между передачей корутины в цикл Telethon и началом ее выполнения.",
+    ("operation",))
+TELEGRAM_LOOP_TIMEOUTS = counter(
+    "teekagram_telegram_loop_timeouts_total", "Операции в цикле Telethon, прерванные по таймауту.", ("operation",))
+SEND_PLAN_SECONDS = histogram(
+    "teekagram_send_plan_seconds", "Длительность execute_send_plan, включая ожидание очереди чата.", ("outcome",))
+TELEGRAM_FLOOD_WAITS = counter(
+    "teekagram_telegram_flood_waits_total", "Ошибки FloodWait от Telegram по операции.", ("operation",))
+TELEGRAM_LOOP_LAG_SECONDS = histogram(
+    "teekagram_telegram_loop_lag_seconds", "Насколько позже запланированного просыпается проба цикла Telethon (лаг цикла событий).")
+AUTO_MODE_WORKERS = gauge(
+    "teekagram_auto_mode_workers", "Активные потоки авто-режима.", ("account",))
+LOG_RECORDS_DROPPED = counter(
+    "teekagram_log_records_dropped_total", "Записи лога, отброшенные из-за переполненной очереди вывода.")
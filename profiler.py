@@ -0,0 +1,176 @@
+"""
+Встроенный сэмплирующий профайлер для работающего инстанса.
+
+Отдельный поток раз в interval_s секунд снимает стеки всех потоков процесса через
+sys._current_frames() (поток Flask/uvicorn, цикл Telethon, потоки авто-режима) и считает
+одинаковые стеки. Результат записывается в PROFILES_DIR в формате collapsed stacks
+("поток;модуль.функция;... число_сэмплов"), который понимают flamegraph.pl, speedscope
+и inferno. Кадры подписываются как модуль.qualname, поэтому функции telegram_utils и
+gemini_utils видны под своими именами.
+
+Профайлер меряет настенное время: ждущие потоки тоже попадают в сэмплы (в threading.wait,
+selectors.select и т.п.), поэтому для поиска нагрузки на CPU смотрите на стеки, которые
+заканчиваются не ожиданием. Одновременно работает не больше одного профиля.
+"""
+import os
+import re
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+PROFILES_DIR = 'data/profiles'
+PROFILE_FILE_SUFFIX = '.folded'
+DEFAULT_PROFILE_SECONDS = 30.0
+MAX_PROFILE_SECONDS = 300.0
+DEFAULT_SAMPLE_INTERVAL_S = 0.01
+MIN_SAMPLE_INTERVAL_S = 0.001
+MAX_STACK_DEPTH = 200
+# AutoMode-123, AutoMode--100123, Thread-7 (process_request_thread), ThreadPoolExecutor-0_3:
+# номера чатов и потоков убираются, чтобы однотипные потоки попадали в один стек.
+THREAD_NUMBER_PATTERN = re.compile(r'[-_]+\d+')
+
+_profile_lock = threading.Lock()
+_active_profile = None
+_last_profile = None
+
+def thread_group(thread_name):
+    return THREAD_NUMBER_PATTERN.sub('', thread_name) or thread_name
+
+def frame_label(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', '?')
+    return f"{module}.{getattr(code, 'co_qualname', code.co_name)}".replace(';', ':')
+
+def collapse_stack(thread_name, frame):
+    """Стек потока от корня к текущему кадру одной строкой collapsed-формата (без числа сэмплов)."""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_group(thread_name).replace(';', ':'))
+    return ';'.join(reversed(labels))
+
+class SamplingProfile:
+    """Один запуск профайлера: снимает стеки seconds секунд и записывает их в файл."""
+
+    def __init__(self, seconds, interval_s, profiles_dir):
+        self.seconds = seconds
+        self.interval_s = interval_s
+        self.profiles_dir = profiles_dir
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.file_name = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+
+    def _sample(self, own_ident):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            self.stacks[collapse_stack(thread_names.get(ident, f"thread-{ident}"), frame)] += 1
+        self.samples += 1
+
+    def _run(self):
+        global _active_profile, _last_profile
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                self._sample(own_ident)
+                time.sleep(self.interval_s)
+            self.file_name = self._write()
+            logging.info(f"Профайлер: {self.samples} сэмплов записано в {self.file_name}.")
+        except Exception as e:
+            self.error = str(e)
+            logging.error(f"Профайлер: ошибка при снятии профиля: {e}", exc_info=True)
+        finally:
+            self.finished_at = time.time()
+            with _profile_lock:
+                _active_profile = None
+                _last_profile = self
+
+    def _write(self):
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        file_name = f"profile-{datetime.fromtimestamp(self.started_at).strftime('%Y%m%d-%H%M%S')}{PROFILE_FILE_SUFFIX}"
+        with open(os.path.join(self.profiles_dir, file_name), 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return file_name
+
+    def to_dict(self):
+        return {
+            "seconds": self.seconds,
+            "interval_ms": round(self.interval_s * 1000.0, 3),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "file_name": self.file_name,
+            "error": self.error,
+        }
+
+def start_profile(seconds=DEFAULT_PROFILE_SECONDS, interval_s=DEFAULT_SAMPLE_INTERVAL_S, profiles_dir=None):
+    """
+    Запускает профайлер в фоновом потоке на seconds секунд (не больше MAX_PROFILE_SECONDS).
+    Возвращает (описание профиля, None) или (None, ошибка), если профиль уже снимается.
+    """
+    global _active_profile
+    seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+    interval_s = max(float(interval_s), MIN_SAMPLE_INTERVAL_S)
+    with _profile_lock:
+        if _active_profile is not None:
+            return None, "Профиль уже снимается."
+        _active_profile = SamplingProfile(seconds, interval_s, profiles_dir or PROFILES_DIR)
+        profile = _active_profile
+    logging.info(f"Профайлер запущен на {seconds:.1f} сек (интервал {interval_s * 1000.0:.1f} мс).")
+    profile.thread.start()
+    return profile.to_dict(), None
+
+def list_profiles(profiles_dir=None):
+    """Файлы профилей в PROFILES_DIR, новые первыми."""
+    profiles_dir = profiles_dir or PROFILES_DIR
+    if not os.path.isdir(profiles_dir):
+        return []
+    files = [name for name in os.listdir(profiles_dir) if name.endswith(PROFILE_FILE_SUFFIX)]
+    return sorted(files, reverse=True)
+
+def get_profile_status(profiles_dir=None):
+    with _profile_lock:
+        active, last = _active_profile, _last_profile
+    return {
+        "active": active.to_dict() if active else None,
+        "last": last.to_dict() if last else None,
+        "files": list_profiles(profiles_dir),
+    }
+
+def profile_file_path(file_name, profiles_dir=None):
+    """Путь к файлу профиля или None, если такого профиля нет (имена с путями не принимаются)."""
+    if os.path.basename(file_name) != file_name or not file_name.endswith(PROFILE_FILE_SUFFIX):
+        return None
+    path = os.path.join(profiles_dir or PROFILES_DIR, file_name)
+    return path if os.path.isfile(path) else None
+
+def install_signal_handler(seconds=DEFAULT_PROFILE_SECONDS):
+    """
+    По сигналу SIGUSR2 (kill -USR2 <pid>) снимает профиль на seconds секунд.
+    Вызывать из главного потока; на платформах без SIGUSR2 (Windows) возвращает False.
+    """
+    if not hasattr(signal, 'SIGUSR2'):
+        return False
+
+    def start_from_signal():
+        _, error = start_profile(seconds)
+        if error:
+            logging.warning(f"Профайлер: сигнал пропущен - {error}")
+
+    # Обработчик сигнала прерывает главный поток в произвольном месте, поэтому блокировки
+    # профайлера берутся уже в отдельном потоке.
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=start_from_signal, daemon=True).start())
+    return True
@@ -0,0 +1,389 @@
+"""
+Супервизор нескольких инстансов TeekaGramAi (замена zapuskScript.bat для Linux-серверов).
+
+Читает манифест инстансов (по умолчанию data/instances.json, пример - data/instancesExample.json),
+запускает каждый бот отдельным дочерним процессом со своим окружением, аккаунтом и портом,
+перезапускает упавшие процессы с экспоненциальной задержкой и отдает сводное состояние:
+    GET /status   - JSON по всем инстансам (процесс, перезапуски, проверка здоровья)
+    GET /metrics  - метрики инстансов (если у них задан metrics_path) с меткой instance
+
+Запуск из корня проекта:
+    python supervisor.py --manifest data/instances.json --port 5000
+
+Номер аккаунта передается дочернему процессу через --account, поэтому выбор аккаунта
+в консоли не ждет ввода. Авторизацию нового аккаунта (код из Telegram) нужно один раз
+пройти обычным запуском python main.py.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s')
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+INSTANCES_MANIFEST_FILE = 'data/instances.json'
+SUPERVISOR_PORT = 5000
+BASE_INSTANCE_PORT = 5000
+
+RESTART_BACKOFF_BASE_S = 1.0
+RESTART_BACKOFF_MAX_S = 60.0
+STABLE_RUN_S = 60.0
+HEALTH_CHECK_INTERVAL_S = 10.0
+HEALTH_CHECK_TIMEOUT_S = 5.0
+STOP_TIMEOUT_S = 20.0
+
+DEFAULT_INSTANCE = {
+    "folder": ".",
+    "account": None,
+    "instance_number": None,
+    "args": [],
+    "env": {},
+    "log_file": None,
+    "health_path": "/healthz",
+    "metrics_path": "/metrics",
+    "enabled": True,
+}
+
+def load_manifest(manifest_file):
+    """
+    Загружает список инстансов из JSON-манифеста: {"instances": [{...}, ...]}.
+    Недостающие поля берутся из DEFAULT_INSTANCE; instance_number по умолчанию - порядковый номер (с 1),
+    относительный folder отсчитывается от папки проекта (например, "../ai_telegramm_2").
+    Инстанс слушает порт BASE_INSTANCE_PORT + instance_number, поэтому номер должен быть целым не меньше 1
+    (порт 5000 занимает сам супервизор) и не повторяться; иначе - ValueError.
+    """
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    instances = []
+    for index, raw_instance in enumerate(manifest.get("instances", []), start=1):
+        instance = dict(DEFAULT_INSTANCE, **raw_instance)
+        if not instance["enabled"]:
+            continue
+        instance.setdefault("name", f"bot{index}")
+        if instance["instance_number"] is None:
+            instance["instance_number"] = index
+        instance_number = instance["instance_number"]
+        if not isinstance(instance_number, int) or isinstance(instance_number, bool) or instance_number < 1:
+            raise ValueError(f"Инстанс '{instance['name']}': instance_number должен быть целым числом не меньше 1, получено {instance_number!r}.")
+        if any(other["instance_number"] == instance_number for other in instances):
+            raise ValueError(f"Инстанс '{instance['name']}': instance_number {instance_number} уже используется другим инстансом.")
+        folder = instance["folder"]
+        instance["folder"] = os.path.normpath(os.path.join(PROJECT_DIR, folder))
+        if not instance["log_file"]:
+            instance["log_file"] = os.path.join(PROJECT_DIR, 'logs', f"{instance['name']}.log")
+        instances.append(instance)
+    return instances
+
+class Instance:
+    """Один дочерний процесс бота: запуск, остановка, перезапуск с задержкой и состояние для /status."""
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config["name"]
+        self.port = BASE_INSTANCE_PORT + int(config["instance_number"])
+        self.process = None
+        self.log_handle = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures_in_row = 0
+        self.next_start_at = 0.0
+        self.last_exit_code = None
+        self.health = {"ok": False, "status_code": None, "latency_ms": None, "error": "not checked", "checked_at": None}
+        self.stopping = False
+
+    def command(self):
+        command = [sys.executable, 'main.py']
+        if self.config["account"] is not None:
+            command += ['--account', str(self.config["account"])]
+        return command + [str(arg) for arg in self.config["args"]]
+
+    def environment(self):
+        env = dict(os.environ)
+        env["INSTANCE_NUMBER"] = str(self.config["instance_number"])
+        env["PYTHONUNBUFFERED"] = "1"
+        env.update({key: str(value) for key, value in self.config["env"].items()})
+        return env
+
+    def start(self):
+        """Запускает процесс бота; stdin закрыт, вывод пишется в log_file инстанса."""
+        os.makedirs(os.path.dirname(self.config["log_file"]), exist_ok=True)
+        self.log_handle = open(self.config["log_file"], 'ab')
+        logging.info(f"[{self.name}] Запуск: {' '.join(self.command())} (папка {self.config['folder']}, порт {self.port})")
+        self.process = subprocess.Popen(
+            self.command(), cwd=self.config["folder"], env=self.environment(),
+            stdin=subprocess.DEVNULL, stdout=self.log_handle, stderr=subprocess.STDOUT,
+        )
+        self.started_at = time.monotonic()
+        self.health = dict(self.health, ok=False, error="starting")
+
+    def poll(self):
+        """
+        Проверяет, не завершился ли процесс. Для упавшего процесса назначает перезапуск
+        через RESTART_BACKOFF_BASE_S * 2^(падений подряд - 1) секунд (не больше RESTART_BACKOFF_MAX_S);
+        счетчик падений подряд сбрасывается, если процесс проработал хотя бы STABLE_RUN_S.
+        """
+        if self.process is None:
+            if not self.stopping and time.monotonic() >= self.next_start_at:
+                if self.started_at is not None:
+                    self.restarts += 1
+                self.start()
+            return
+
+        exit_code = self.process.poll()
+        if exit_code is None:
+            return
+
+        run_time_s = time.monotonic() - self.started_at
+        self._close_log()
+        self.process = None
+        self.last_exit_code = exit_code
+        self.health = dict(self.health, ok=False, error=f"exited with code {exit_code}")
+        if self.stopping:
+            return
+
+        self.failures_in_row = 1 if run_time_s >= STABLE_RUN_S else self.failures_in_row + 1
+        delay_s = min(RESTART_BACKOFF_MAX_S, RESTART_BACKOFF_BASE_S * 2 ** (self.failures_in_row - 1))
+        self.next_start_at = time.monotonic() + delay_s
+        logging.warning(f"[{self.name}] Процесс завершился с кодом {exit_code} через {run_time_s:.1f} сек. "
+                        f"Перезапуск через {delay_s:.0f} сек. (падений подряд: {self.failures_in_row}).")
+
+    def stop(self, timeout=STOP_TIMEOUT_S):
+        """Останавливает процесс: SIGINT (чтобы бот корректно отключился от Telegram), затем kill по таймауту."""
+        self.stopping = True
+        if self.process is None or self.process.poll() is not None:
+            self._close_log()
+            return
+        logging.info(f"[{self.name}] Остановка процесса {self.process.pid}...")
+        try:
+            self.process.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f"[{self.name}] Процесс не завершился за {timeout:.0f} сек., принудительная остановка.")
+            self.process.kill()
+            self.process.wait()
+        self.last_exit_code = self.process.returncode
+        self._close_log()
+
+    def _close_log(self):
+        if self.log_handle:
+            self.log_handle.close()
+            self.log_handle = None
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def check_health(self):
+        """Запрашивает health_path инстанса; результат сохраняется в self.health."""
+        if self.process is None:
+            return
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(self.url(self.config["health_path"]), timeout=HEALTH_CHECK_TIMEOUT_S) as response:
+                response.read()
+                status_code = response.status
+            error = None
+        except urllib.error.HTTPError as e:
+            status_code, error = e.code, f"HTTP {e.code}"
+        except (urllib.error.URLError, OSError) as e:
+            status_code, error = None, str(getattr(e, 'reason', e))
+        self.health = {
+            "ok": error is None,
+            "status_code": status_code,
+            "latency_ms": round((time.perf_counter() - start) * 1000.0, 1),
+            "error": error,
+            "checked_at": time.time(),
+        }
+
+    def fetch_metrics(self):
+        """Текст метрик инстанса (metrics_path) или None, если путь не задан или инстанс недоступен."""
+        if self.process is None or not self.config["metrics_path"]:
+            return None
+        try:
+            with urllib.request.urlopen(self.url(self.config["metrics_path"]), timeout=HEALTH_CHECK_TIMEOUT_S) as response:
+                return response.read().decode('utf-8', errors='replace')
+        except (urllib.error.URLError, OSError) as e:
+            logging.warning(f"[{self.name}] Не удалось получить метрики: {e}")
+            return None
+
+    def status(self):
+        running = self.process is not None
+        return {
+            "name": self.name,
+            "port": self.port,
+            "account": self.config["account"],
+            "pid": self.process.pid if running else None,
+            "running": running,
+            "uptime_s": round(time.monotonic() - self.started_at, 1) if running else 0.0,
+            "restarts": self.restarts,
+            "failures_in_row": self.failures_in_row,
+            "last_exit_code": self.last_exit_code,
+            "next_start_in_s": round(max(0.0, self.next_start_at - time.monotonic()), 1) if not running else 0.0,
+            "health": self.health,
+        }
+
+def add_instance_label(metrics_text, instance_name):
+    """Добавляет метку instance="..." ко всем сэмплам текста метрик в формате Prometheus."""
+    label = f'instance="{instance_name}"'
+    lines = []
+    for line in metrics_text.splitlines():
+        if not line or line.startswith('#'):
+            lines.append(line)
+            continue
+        name_part, _, value_part = line.rpartition(' ')
+        if '{' in name_part:
+            metric_name, _, labels = name_part.partition('{')
+            labels = labels.rstrip('}')
+            name_part = f"{metric_name}{{{label},{labels}}}" if labels else f"{metric_name}{{{label}}}"
+        else:
+            name_part = f"{name_part}{{{label}}}"
+        lines.append(f"{name_part} {value_part}")
+    return "\n".join(lines)
+
+class Supervisor:
+    """Следит за всеми инстансами манифеста в фоновом потоке и отдает их сводное состояние."""
+
+    def __init__(self, instances):
+        self.instances = [Instance(config) for config in instances]
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        last_health_check = 0.0
+        while not self.stop_event.is_set():
+            with self.lock:
+                for instance in self.instances:
+                    instance.poll()
+            if time.monotonic() - last_health_check >= HEALTH_CHECK_INTERVAL_S:
+                last_health_check = time.monotonic()
+                for instance in self.instances:
+                    instance.check_health()
+            self.stop_event.wait(0.5)
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            for instance in self.instances:
+                instance.stopping = True
+            for instance in self.instances:
+                instance.stop()
+
+    def status(self):
+        with self.lock:
+            statuses = [instance.status() for instance in self.instances]
+        return {
+            "instances": statuses,
+            "running": sum(1 for status in statuses if status["running"]),
+            "healthy": sum(1 for status in statuses if status["health"]["ok"]),
+            "total": len(statuses),
+        }
+
+    def metrics(self):
+        """Метрики супервизора и всех инстансов с metrics_path в текстовом формате Prometheus."""
+        lines = [
+            "# HELP teekagram_instance_up Процесс инстанса запущен (1) или нет (0).",
+            "# TYPE teekagram_instance_up gauge",
+        ]
+        statuses = self.status()["instances"]
+        lines += [f'teekagram_instance_up{{instance="{s["name"]}"}} {int(s["running"])}' for s in statuses]
+        lines += ["# HELP teekagram_instance_healthy Последняя проверка здоровья успешна (1) или нет (0).",
+                  "# TYPE teekagram_instance_healthy gauge"]
+        lines += [f'teekagram_instance_healthy{{instance="{s["name"]}"}} {int(s["health"]["ok"])}' for s in statuses]
+        lines += ["# HELP teekagram_instance_restarts_total Число перезапусков инстанса супервизором.",
+                  "# TYPE teekagram_instance_restarts_total counter"]
+        lines += [f'teekagram_instance_restarts_total{{instance="{s["name"]}"}} {s["restarts"]}' for s in statuses]
+
+        seen_comments = set()
+        for instance in self.instances:
+            metrics_text = instance.fetch_metrics()
+            if not metrics_text:
+                continue
+            for line in add_instance_label(metrics_text, instance.name).splitlines():
+                if line.startswith('#'):
+                    if line in seen_comments:
+                        continue
+                    seen_comments.add(line)
+                lines.append(line)
+        return "\n".join(lines) + "\n"
+
+def make_status_handler(supervisor):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] == '/status':
+                body = json.dumps(supervisor.status(), ensure_ascii=False, indent=2).encode('utf-8')
+                content_type = 'application/json; charset=utf-8'
+            elif self.path.split('?')[0] == '/metrics':
+                body = supervisor.metrics().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f"Супервизор: {self.address_string()} {format % args}")
+    return StatusHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Супервизор нескольких инстансов TeekaGramAi.")
+    parser.add_argument('--manifest', default=INSTANCES_MANIFEST_FILE, help='JSON-манифест инстансов.')
+    parser.add_argument('--port', type=int, default=SUPERVISOR_PORT, help='Порт для /status и /metrics супервизора.')
+    args = parser.parse_args()
+
+    try:
+        instances = load_manifest(args.manifest)
+    except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+        logging.error(f"Не удалось прочитать манифест инстансов '{args.manifest}': {e}")
+        raise SystemExit(1)
+    if not instances:
+        logging.error(f"В манифесте '{args.manifest}' нет включенных инстансов.")
+        raise SystemExit(1)
+    busy_instance = next((instance for instance in instances
+                          if BASE_INSTANCE_PORT + instance["instance_number"] == args.port), None)
+    if busy_instance:
+        logging.error(f"Порт супервизора {args.port} совпадает с портом инстанса '{busy_instance['name']}'.")
+        raise SystemExit(1)
+
+    supervisor = Supervisor(instances)
+
+    def request_stop(signum, frame):
+        logging.info(f"Получен сигнал {signum}, остановка инстансов...")
+        supervisor.stop_event.set()
+
+    # Обработчики ставятся до запуска дочерних процессов: перехваченные сигналы при exec
+    # сбрасываются к стандартным, поэтому SIGINT дойдет до бота, даже если супервизор запущен в фоне.
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    monitor_thread = threading.Thread(target=supervisor.run, name="Supervisor", daemon=True)
+    monitor_thread.start()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_status_handler(supervisor))
+    server_thread = threading.Thread(target=server.serve_forever, name="SupervisorHTTP", daemon=True)
+    server_thread.start()
+    logging.info(f"Супервизор запущен: инстансов {len(instances)}, состояние на http://127.0.0.1:{args.port}/status")
+
+    try:
+        while not supervisor.stop_event.is_set():
+            supervisor.stop_event.wait(1.0)
+    finally:
+        server.shutdown()
+        monitor_thread.join(timeout=5)
+        supervisor.stop()
+        logging.info("Супервизор остановлен.")
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,152 @@
 import asyncio
 import re
 import random
-import string
-import emoji
 import os
 import json  
-from telethon import TelegramClient, errors, functions
+import time
+import queue
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from telethon import TelegramClient, errors, functions, events, utils
 from telethon.tl.functions.account import UpdateStatusRequest
 from telethon.tl.types import (
-    MessageMediaPhoto, MessageMediaDocument, MessageMediaUnsupported, MessageMediaContact,
-    MessageMediaGeo, MessageMediaGame, MessageMediaInvoice, MessageMediaPoll,
-    MessageMediaVenue,
-    MessageService, DocumentAttributeVideo, DocumentAttributeAudio,
+    MessageMediaPhoto, MessageMediaDocument,
     InputDocument, SendMessageChooseStickerAction, ReactionEmoji,
-    MessageReactions, ReactionCustomEmoji, PeerUser, PeerChannel
+    ReactionCustomEmoji, PeerChannel, PeerChat,
+    User, UpdateUserName, UpdateUser, UpdateChat, UpdateChannel
 )
 from datetime import datetime, timedelta
 import logging
 import base64
 
+from text_utils import final_fine_tune_sms
+from history_pipeline import format_history
+from metrics import (
+    HISTORY_SECONDS, HISTORY_MESSAGES, MEDIA_DOWNLOAD_SECONDS, MEDIA_DOWNLOAD_BYTES, MEDIA_CACHE_HITS,
+    TELEGRAM_LOOP_QUEUE_SECONDS, TELEGRAM_LOOP_TIMEOUTS, SEND_PLAN_SECONDS, TELEGRAM_FLOOD_WAITS,
+    TELEGRAM_LOOP_LAG_SECONDS
+)
+from tracing import span
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s') 
 logging.getLogger('telethon').setLevel(logging.WARNING)
 
-client = None
-my_id = None
 telegram_loop = None
 
 MEDIA_CACHE_DIR = "media_cache"
+MEDIA_BATCH_CONCURRENCY = 4
 STICKER_DB = {}
 STICKER_ID_TO_CODENAME = {}
 STICKER_JSON_FILE = 'data/stickers.json'
 
+ENTITY_CACHE_TTL_S = 1800
+
+DIALOG_LIST_STALE_AFTER_S = 120
+DIALOG_LIST_MIN_REFRESH_INTERVAL_S = 15
+DIALOG_LIST_REFRESH_INTERVAL_S = 900
+
+READ_ACK_FLUSH_INTERVAL_S = 2.0
+READ_ACK_MAX_ATTEMPTS = 3
+
+GENERATION_TYPING_MAX_S = 300
+SEND_CANCELLED_MESSAGE = "Sending cancelled during typing simulation."
+
+LOOP_LAG_PROBE_INTERVAL_S = 1.0
+LOOP_STALLED_AFTER_S = 10.0
+loop_lag_state = {"lag_s": None, "max_lag_s": 0.0, "checked_at": None}
+
+@dataclass
+class TelegramAccount:
+    """
+    Аккаунт Telegram и все его состояние: клиент, собственный ID и кэши.
+    Несколько аккаунтов работают в одном процессе и в общем цикле telegram_loop;
+    стикеры, Gemini и таблицы эмодзи при этом загружаются один раз на всех.
+    """
+    key: str
+    name: str
+    session_name: str
+    media_cache_dir: str = MEDIA_CACHE_DIR
+    client: TelegramClient = None
+    my_id: int = None
+    chat_info_cache: dict = field(default_factory=dict)
+    entity_cache: dict = field(default_factory=dict)
+    dialog_list_cache: dict = field(default_factory=lambda: {
+        "chats": None, "limit": 0, "updated_at": 0.0, "dirty": False,
+        "refresh_task": None, "refresh_limit": 0, "attempted_at": 0.0,
+    })
+    read_acks: dict = field(default_factory=lambda: {"acked": {}, "pending": {}, "attempts": {}, "flush_task": None})
+    send_queues: dict = field(default_factory=dict)
+    generation_typing: dict = field(default_factory=dict)
+    last_rpc_at: float = None
+
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected()
+
+ACCOUNTS = {}
+current_account = ContextVar('current_account', default=None)
+
+def register_account(key, name, session_name, media_cache_dir=MEDIA_CACHE_DIR):
+    """Регистрирует аккаунт (до запуска telegram_main_loop) и возвращает его TelegramAccount."""
+    account = TelegramAccount(key=key, name=name, session_name=session_name, media_cache_dir=media_cache_dir)
+    ACCOUNTS[key] = account
+    return account
+
+def get_account(key=None):
+    """
+    Аккаунт по ключу; без ключа - аккаунт текущего контекста (запроса, потока авто-режима
+    или задачи Telethon), а если он не задан - первый зарегистрированный. None, если аккаунтов нет.
+    """
+    if key is not None:
+        return ACCOUNTS.get(key)
+    account = current_account.get()
+    if account is not None:
+        return account
+    return next(iter(ACCOUNTS.values()), None)
+
+def use_account(key):
+    """
+    Делает аккаунт с ключом key текущим для этого потока/задачи
+    (неизвестный ключ или None - аккаунт по умолчанию). Возвращает текущий аккаунт.
+    """
+    current_account.set(ACCOUNTS.get(key))
+    return get_account()
+
+def _for_account(account, handler):
+    """Обработчик событий клиента account, выполняющийся в контексте этого аккаунта."""
+    async def account_handler(event):
+        current_account.set(account)
+        await handler(event)
+    return account_handler
+
+MEDIA_MIME_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'video/mp4': '.mp4',
+    'audio/mpeg': '.mp3',
+    'audio/ogg': '.ogg',
+    'application/pdf': '.pdf',
+}
+MEDIA_EXTENSION_MIMES = {ext: mime for mime, ext in MEDIA_MIME_EXTENSIONS.items()}
+
 def get_extension_from_mime(mime_type):
     """Возвращает расширение файла на основе MIME-типа."""
-    mapping = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png',
-        'image/webp': '.webp',
-        'video/mp4': '.mp4',
-        'audio/mpeg': '.mp3',
-        'audio/ogg': '.ogg',
-        'application/pdf': '.pdf',
-    }
-    return mapping.get(mime_type)
+    return MEDIA_MIME_EXTENSIONS.get(mime_type)
+
+def get_media_cache_path(chat_id, message_id, file_ext):
+    """Путь к файлу медиа сообщения в дисковом кэше текущего аккаунта."""
+    return os.path.join(get_account().media_cache_dir, f"{chat_id}_{message_id}{file_ext}")
+
+def find_cached_media_file(chat_id, message_id):
+    """
+    Ищет уже сохраненный файл медиа сообщения в дисковом кэше без обращения к Telegram.
+    Возвращает (путь, MIME-тип) или (None, None).
+    """
+    for file_ext, mime_type in MEDIA_EXTENSION_MIMES.items():
+        cache_filepath = get_media_cache_path(chat_id, message_id, file_ext)
+        if os.path.isfile(cache_filepath):
+            return cache_filepath, mime_type
+    return None, None
 
 def cleanup_old_cache_files(directory, max_age_days):
     """
@@ -125,388 +229,37 @@ async def update_online_status_periodically(client_instance):
     while client_instance and client_instance.is_connected():
         try:
             await client_instance(UpdateStatusRequest(offline=False))
+            get_account().last_rpc_at = time.time()
             logging.info("Статус 'online' обновлен.")
         except Exception as e:
             logging.warning(f"Не удалось обновить статус 'online': {e}")
         
         await asyncio.sleep(75)
 
-def make_human_like_typos(text: str,
-                    substitution_chance=0.005,
-                    transposition_chance=0.005,
-                    skip_chance=0.002,
-                    lower_chance=0.01) -> str:
-    """
-    Добавляет в текст человекоподобные опечатки для русского и английского языков,
-    cтрого избешая замены букв одного языка на буквы другого.
-
-    Args:
-        text: Исходный текст.
-        substitution_chance: Вероятность замены буквы на соседнюю по той же ракадке (на символ).
-        transposition_chance: Вероятность перестановки двух соседних букв (на символ).
-        skip_chance: Вероятность пропуска (удаления) буквы или цифры (на символ).
-
-    Returns:
-        Текст с возможными опечатками.
-    """
-
-    RU_LOWER = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
-    RU_UPPER = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
-    RU_ALPHABET = set(RU_LOWER + RU_UPPER)
-
-    EN_LOWER = string.ascii_lowercase
-    EN_UPPER = string.ascii_uppercase
-    EN_ALPHABET = set(EN_LOWER + EN_UPPER)
-
-    RU_TYPO_SUBSTITUTIONS = {
-        '.': ['ж', 'ю'],
-        '\\': ['ъ'],
-        'А': ['К', 'М', 'В', 'П'],
-        'Б': ['Л', 'Ь', 'Ю'],
-        'В': ['У', 'С', 'Ы', 'А'],
-        'Г': ['О', 'Н', 'Ш'],
-        'Д': ['Щ', 'Ю', 'Л', 'Ж'],
-        'Е': ['П', 'К', 'Н'],
-        'Ж': ['З', '.', 'Д', 'Э'],
-        'З': ['Ж', 'Щ', 'Х'],
-        'И': ['П', 'М', 'Т'],
-        'Й': ['Ф', 'Ц'],
-        'К': ['А', 'У', 'Е'],
-        'Л': ['Ш', 'Б', 'О', 'Д'],
-        'М': ['А', 'С', 'И'],
-        'Н': ['Р', 'Е', 'Г'],
-        'О': ['Г', 'Ь', 'Р', 'Л'],
-        'П': ['Е', 'И', 'А', 'Р'],
-        'Р': ['Н', 'Т', 'П', 'О'],
-        'С': ['В', 'Ч', 'М'],
-        'Т': ['Р', 'И', 'Ь'],
-        'У': ['В', 'Ц', 'К'],
-        'Ф': ['Й', 'Я', 'Ы'],
-        'Х': ['Э', 'З', 'Ъ'],
-        'Ц': ['Ы', 'Й', 'У'],
-        'Ч': ['Ы', 'Я', 'С'],
-        'Ш': ['Л', 'Г', 'Щ'],
-        'Щ': ['Д', 'Ш', 'З'],
-        'Ъ': ['Х', '\\'],
-        'Ы': ['Ц', 'Ч', 'Ф', 'В'],
-        'Ь': ['О', 'Т', 'Б'],
-        'Э': ['Х', 'Ж'],
-        'Ю': ['Д', 'Б', '.'],
-        'Я': ['Ф', 'Ч'],
-        'а': ['к', 'м', 'в', 'п'],
-        'б': ['л', 'ь', 'ю'],
-        'в': ['у', 'с', 'ы', 'а'],
-        'г': ['о', 'н', 'ш'],
-        'д': ['щ', 'ю', 'л', 'ж'],
-        'е': ['п', 'к', 'н'],
-        'ж': ['з', '.', 'д', 'э'],
-        'з': ['ж', 'щ', 'х'],
-        'и': ['п', 'м', 'т'],
-        'й': ['ф', 'ц'],
-        'к': ['а', 'у', 'е'],
-        'л': ['ш', 'б', 'о', 'д'],
-        'м': ['а', 'с', 'и'],
-        'н': ['р', 'е', 'г'],
-        'о': ['г', 'ь', 'р', 'л'],
-        'п': ['е', 'и', 'а', 'р'],
-        'р': ['н', 'т', 'п', 'о'],
-        'с': ['в', 'ч', 'м'],
-        'т': ['р', 'и', 'ь'],
-        'у': ['в', 'ц', 'к'],
-        'ф': ['й', 'я', 'ы'],
-        'х': ['э', 'з', 'ъ'],
-        'ц': ['ы', 'й', 'у'],
-        'ч': ['ы', 'я', 'с'],
-        'ш': ['л', 'г', 'щ'],
-        'щ': ['д', 'ш', 'з'],
-        'ъ': ['х', '\\'],
-        'ы': ['ц', 'ч', 'ф', 'в'],
-        'ь': ['о', 'т', 'б'],
-        'э': ['х', 'ж'],
-        'ю': ['д', 'б', '.'],
-        'я': ['ф', 'ч']
-    }
-
-    EN_TYPO_SUBSTITUTIONS = {
-        'A': ['Q', 'Z', 'S'],
-        'B': ['G', 'V', 'N'],
-        'C': ['D', 'X', 'V'],
-        'D': ['E', 'C', 'S', 'F'],
-        'E': ['D', 'W', 'R'],
-        'F': ['R', 'V', 'D', 'G'],
-        'G': ['T', 'B', 'F', 'H'],
-        'H': ['Y', 'N', 'G', 'J'],
-        'I': ['K', 'U', 'O'],
-        'J': ['U', 'M', 'H', 'K'],
-        'K': ['I', ',', 'J', 'L'],
-        'L': ['O', '.', 'K', ';'],
-        'M': ['J', 'N', ','],
-        'N': ['H', 'B', 'M'],
-        'O': ['L', 'I', 'P'],
-        'P': [';', 'O', '['],
-        'Q': ['A', 'W'],
-        'R': ['F', 'E', 'T'],
-        'S': ['W', 'X', 'A', 'D'],
-        'T': ['G', 'R', 'Y'],
-        'U': ['J', 'Y', 'I'],
-        'V': ['F', 'C', 'B'],
-        'W': ['S', 'Q', 'E'],
-        'X': ['S', 'Z', 'C'],
-        'Y': ['H', 'T', 'U'],
-        'Z': ['A', 'X'],
-        'a': ['q', 'z', 's'],
-        'b': ['g', 'v', 'n'],
-        'c': ['d', 'x', 'v'],
-        'd': ['e', 'c', 's', 'f'],
-        'e': ['d', 'w', 'r'],
-        'f': ['r', 'v', 'd', 'g'],
-        'g': ['t', 'b', 'f', 'h'],
-        'h': ['y', 'n', 'g', 'j'],
-        'i': ['k', 'u', 'o'],
-        'j': ['u', 'm', 'h', 'k'],
-        'k': ['i', ',', 'j', 'l'],
-        'l': ['o', '.', 'k', ';'],
-        'm': ['j', 'n', ','],
-        'n': ['h', 'b', 'm'],
-        'o': ['l', 'i', 'p'],
-        'p': [';', 'o', '['],
-        'q': ['a', 'w'],
-        'r': ['f', 'e', 't'],
-        's': ['w', 'x', 'a', 'd'],
-        't': ['g', 'r', 'y'],
-        'u': ['j', 'y', 'i'],
-        'v': ['f', 'c', 'b'],
-        'w': ['s', 'q', 'e'],
-        'x': ['s', 'z', 'c'],
-        'y': ['h', 't', 'u'],
-        'z': ['a', 'x']
-    }
-
-    RU_TYPO_TRANSPOSITIONS = [
-        "ст", "тс", "ол", "ло", "ть", "ьт", "но", "он", "ер", "ре",
-        "ов", "во", "пр", "рп", "на", "ан", "ко", "ок", "то", "от", "ет", "те",
-        "СТ", "ТС", "ОЛ", "ЛО", "ТЬ", "ЬТ", "НО", "ОН", "ЕР", "РЕ",
-        "ОВ", "ВО", "ПР", "РП", "НА", "АН", "КО", "ОК", "ТО", "ОТ", "ЕТ", "ТЕ"
-    ]
-
-    EN_TYPO_TRANSPOSITIONS = [
-        "on", "no", "re", "er", "th", "ht", "in", "ni", "at", "ta",
-        "en", "ne", "es", "se", "ou", "uo", "is", "si", "of", "fo", "he", "eh",
-        "ON", "NO", "RE", "ER", "TH", "HT", "IN", "NI", "AT", "TA",
-        "EN", "NE", "ES", "SE", "OU", "UO", "IS", "SI", "OF", "FO", "HE", "EH"
-    ]
-
-    ALL_TYPO_TRANSPOSITIONS_SET = set(RU_TYPO_TRANSPOSITIONS + EN_TYPO_TRANSPOSITIONS)
-
-
-    chars = list(text)
-    new_chars = []
-    i = 0
-    is_after_punctuation = True
-    while i < len(chars):
-        char = chars[i]
-        processed = False
-        
-        if is_after_punctuation and char.isupper():
-            if random.random() < lower_chance:
-                char = char.lower()
-
-        if char in '.?!':
-            is_after_punctuation = True
-        
-        elif char not in ' \t\n\r':
-            is_after_punctuation = False
-
-        
-        if i + 1 < len(chars):
-            next_char = chars[i+1]
-            current_pair = char + next_char
-            
-            is_letter_pair = char.isalpha() and next_char.isalpha()
-            same_language = (char in RU_ALPHABET and next_char in RU_ALPHABET) or \
-                            (char in EN_ALPHABET and next_char in EN_ALPHABET)
-
-          
-            should_check_transposition = (current_pair in ALL_TYPO_TRANSPOSITIONS_SET) or \
-                                         (is_letter_pair and same_language) or \
-                                         (char.isdigit() and next_char.isdigit()) 
-
-            if should_check_transposition and random.random() < transposition_chance:
-                new_chars.append(next_char)
-                new_chars.append(char)
-                i += 2 
-                processed = True
-
-        if not processed:
-
-            if char.isalnum() and random.random() < skip_chance:
-                i += 1
-                processed = True 
-
-            
-            elif random.random() < substitution_chance:
-                substituted = False
-                
-                if char in RU_ALPHABET and char in RU_TYPO_SUBSTITUTIONS:
-                    possible_typos = RU_TYPO_SUBSTITUTIONS[char]
-                    if possible_typos: 
-                        typo_char = random.choice(possible_typos)
-                        new_chars.append(typo_char)
-                        substituted = True
-                
-                elif char in EN_ALPHABET and char in EN_TYPO_SUBSTITUTIONS:
-                     possible_typos = EN_TYPO_SUBSTITUTIONS[char]
-                     if possible_typos:
-                        typo_char = random.choice(possible_typos)
-                        new_chars.append(typo_char)
-                        substituted = True
-             
-                elif (not char.isalnum()) and char in RU_TYPO_SUBSTITUTIONS:
-                    possible_typos = RU_TYPO_SUBSTITUTIONS[char]
-                    if possible_typos:
-                        typo_char = random.choice(possible_typos)
-                        new_chars.append(typo_char)
-                        substituted = True
-                 
-                elif (not char.isalnum()) and char in EN_TYPO_SUBSTITUTIONS:
-                    possible_typos = EN_TYPO_SUBSTITUTIONS[char]
-                    if possible_typos:
-                        typo_char = random.choice(possible_typos)
-                        new_chars.append(typo_char)
-                        substituted = True
-
-                
-                if substituted:
-                    i += 1
-                    processed = True
-
-        
-        if not processed:
-            new_chars.append(char)
-            i += 1
-
-    return "".join(new_chars)
-
-EMOJI_PATTERN = re.compile(
-    "({})".format(
-        "|".join(re.escape(e) for e in sorted(emoji.EMOJI_DATA.keys(), key=len, reverse=True))
-    )
-)
-
-def simulate_word_loss(text: str, chance: float, max_words: int) -> tuple[str, str]:
-    """
-    Симулирует "потерю" случайных слов в тексте.
-
-    Args:
-        text: Исходный текст.
-        chance: Вероятность того, что потеря слов произойдет (0.0 до 1.0).
-        max_words: Максимальное количество слов для удаления.
-
-    Returns:
-        Кортеж из (текст с возможными потерями, исходный полный текст).
-    """
-    if random.random() < chance:
-        words = text.split()
-        if len(words) > 4: 
-            num_to_remove = random.randint(1, min(max_words, len(words) // 3))
-            
-            lost_indices = sorted(random.sample(range(len(words)), num_to_remove), reverse=True)
-            
-            for index in lost_indices:
-                words.pop(index)
-
-            modified_text = " ".join(words)
-            return modified_text, text
-
-    return text, text
-
-
-def final_fine_tune_sms(comment: str,                     
-                    substitution_chance=0.005,
-                    transposition_chance=0.005,
-                    skip_chance=0.002,
-                    lower_chance=0.01,
-                    word_loss_chance=0.0,
-                    max_lost_words=0
-                    ) -> tuple[str, str]:
-    if not comment:
-        return "", ""
-
-    cleaned_comment = comment.replace('&quot;', '"')
-
-    cleaned_comment = cleaned_comment.replace('—', '-')
-
-    nickname_tag_pattern = r"<\s*ник\s*:.*?>"
-    cleaned_comment = re.sub(nickname_tag_pattern, '', cleaned_comment, flags=re.IGNORECASE)
-
-    timestamp_pattern = r'^\[\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}\]\s*'
-    cleaned_comment = re.sub(timestamp_pattern, '', cleaned_comment, flags=re.MULTILINE)
-
-    spurious_id_pattern = r'\s*\(\s*(U?ID)\s*:\s*\d+\s*\)\s*'
-    cleaned_comment = re.sub(spurious_id_pattern, ' ', cleaned_comment, flags=re.IGNORECASE)
-
-    cleaned_comment = re.sub(r'(.)\1{45,}', lambda m: m.group(1) * 25, cleaned_comment)
-
-    cleaned_comment = re.sub(
-        f'{EMOJI_PATTERN.pattern}\\1{{5,}}', 
-        lambda m: m.group(1) * 5, 
-        cleaned_comment
-    )
-
-    def truncate_emoji_sequence(match):
-        long_sequence = match.group(0)
-        emojis_in_sequence = EMOJI_PATTERN.findall(long_sequence)
-        return ''.join(emojis_in_sequence[:14])
-
-    cleaned_comment = re.sub(
-        f'(?:{EMOJI_PATTERN.pattern}){{15,}}', 
-        truncate_emoji_sequence, 
-        cleaned_comment
-    )
-    
-    
-    n = len(cleaned_comment)
-    last_significant_char_index = -1
-
-    for i in range(n - 1, -1, -1):
-        char = cleaned_comment[i]
-        if not char.isspace() and not emoji.is_emoji(char):
-            last_significant_char_index = i
-            break 
-
-    if last_significant_char_index != -1 and cleaned_comment[last_significant_char_index] == '.':
-        if last_significant_char_index == 0 or cleaned_comment[last_significant_char_index - 1] != '.':
-            cleaned_comment = cleaned_comment[:last_significant_char_index] + cleaned_comment[last_significant_char_index + 1:]
-
-    text_with_typos = make_human_like_typos(cleaned_comment, substitution_chance, transposition_chance, skip_chance, lower_chance)
-    
-    modified_text, original_text_with_typos = simulate_word_loss(text_with_typos, word_loss_chance, max_lost_words)
-
-    return modified_text, original_text_with_typos
-
-async def connect_telegram(api_id, api_hash, session_name='telegram_session'):
-    """Подключается к Telegram (выполняется в цикле telegram_loop)."""
-    global client, my_id
+async def connect_telegram(account, api_id, api_hash):
+    """Подключает аккаунт account к Telegram (выполняется в цикле telegram_loop)."""
+    client = account.client
     if client and client.is_connected() and await client.is_user_authorized():
-        logging.info("Уже подключены к Telegram.")
-        if my_id is None:
+        logging.info("Аккаунт '%s' уже подключен к Telegram.", account.name)
+        if account.my_id is None:
             try:
                 me = await client.get_me()
-                if me: my_id = me.id
+                if me: account.my_id = me.id
             except Exception as e:
                  logging.error(f"Не удалось получить ID пользователя при проверке: {e}")
         return client
 
-    logging.info("Подключение к Telegram в выделенном цикле...")
-    client = TelegramClient(session_name, api_id, api_hash,
+    logging.info("Подключение аккаунта '%s' к Telegram в выделенном цикле...", account.name)
+    client = TelegramClient(account.session_name, api_id, api_hash,
                             loop=telegram_loop, 
                             system_version="4.16.30-vxCUSTOM")
+    account.client = client
 
     try:
         await client.connect()
         if not await client.is_user_authorized():
-            logging.info("Требуется авторизация (в консоли, где запущен поток)...")
-            phone_number = input("Введите ваш номер телефона (+...): ")
+            logging.info("Требуется авторизация аккаунта '%s' (в консоли, где запущен поток)...", account.name)
+            phone_number = input(f"Введите номер телефона для '{account.name}' (+...): ")
             await client.send_code_request(phone_number)
             try:
                 code = input("Введите код из Telegram: ")
@@ -520,8 +273,8 @@ async def connect_telegram(api_id, api_hash, session_name='telegram_session'):
 
         me = await client.get_me()
         if me:
-            my_id = me.id
-            logging.info(f"Подключены как {me.first_name} (ID: {my_id}).")
+            account.my_id = me.id
+            logging.info("Аккаунт '%s': подключены как %s (ID: %s).", account.name, me.first_name, account.my_id)
         else:
              logging.error("Не удалось получить информацию о себе после подключения.")
              await client.disconnect()
@@ -531,16 +284,19 @@ async def connect_telegram(api_id, api_hash, session_name='telegram_session'):
         logging.error("Неверный формат номера телефона.")
         return None
     except errors.FloodWaitError as e:
+         TELEGRAM_FLOOD_WAITS.inc(operation="connect")
          logging.error(f"Слишком много запросов при подключении. Подождите {e.seconds} секунд.")
          return None
     except Exception as e:
-        logging.error(f"Ошибка подключения к Telegram: {e}")
+        logging.error("Ошибка подключения аккаунта '%s' к Telegram: %s", account.name, e)
         if client and client.is_connected():
              await client.disconnect()
         return None
 
 async def get_chats(limit=50):
     """Получает список последних чатов (личных и групп), отсеивая каналы."""
+    account = get_account()
+    client = account.client
     if not client or not client.is_connected() or not await client.is_user_authorized():
         logging.warning("get_chats: Клиент Telegram не подключен или не авторизован.")
         return [], "Telegram client not connected or authorized."
@@ -561,6 +317,8 @@ async def get_chats(limit=50):
                     'name': dialog.name or f"Chat ID: {dialog.id}"
                 }
                 chats.append(chat_info)
+                account.chat_info_cache[dialog.id] = chat_info
+                remember_entity(dialog.id, entity)
 
         logging.info(f"Получено {len(chats)} чатов (личные и группы).")
     except errors.AuthKeyError:
@@ -571,9 +329,165 @@ async def get_chats(limit=50):
         error = f"Error getting chat list: {e}"
     return chats, error
 
+async def _refresh_dialog_list(limit):
+    """
+    Перечитывает список диалогов через get_chats и сохраняет его в кэш списка чатов аккаунта.
+    Одновременные обновления объединяются: пока идет одно, остальные ждут его результат.
+    """
+    dialog_list = get_account().dialog_list_cache
+    refresh_task = dialog_list["refresh_task"]
+    if refresh_task is None or refresh_task.done() or dialog_list["refresh_limit"] < limit:
+        async def refresh():
+            dialog_list["dirty"] = False
+            dialog_list["attempted_at"] = time.time()
+            chats, error = await get_chats(limit=limit)
+            if error:
+                dialog_list["dirty"] = True
+            else:
+                dialog_list.update({"chats": chats, "limit": limit, "updated_at": time.time()})
+            return chats, error
+        dialog_list["refresh_limit"] = limit
+        refresh_task = asyncio.create_task(refresh())
+        dialog_list["refresh_task"] = refresh_task
+    return await asyncio.shield(refresh_task)
+
+async def get_cached_chats(limit=50, force_refresh=False):
+    """
+    Список чатов из памяти (stale-while-revalidate): если кэш устарел или помечен событиями
+    как неактуальный, сразу отдается сохраненный список, а обновление запускается в фоне.
+    Telegram запрашивается синхронно только при пустом кэше, большем limit или force_refresh.
+    Обновления (в том числе ручные) не чаще раза в DIALOG_LIST_MIN_REFRESH_INTERVAL_S секунд.
+    """
+    dialog_list = get_account().dialog_list_cache
+    cached_chats = dialog_list["chats"]
+    recently_attempted = time.time() - dialog_list["attempted_at"] < DIALOG_LIST_MIN_REFRESH_INTERVAL_S
+    if cached_chats is None or dialog_list["limit"] < limit or (force_refresh and not recently_attempted):
+        chats, error = await _refresh_dialog_list(limit)
+        if error and cached_chats:
+            logging.warning("Не удалось обновить список чатов, используется сохраненный: %s", error)
+            return cached_chats[:limit], None
+        return chats[:limit], error
+
+    age_s = time.time() - dialog_list["updated_at"]
+    if (dialog_list["dirty"] or age_s > DIALOG_LIST_STALE_AFTER_S) and not recently_attempted:
+        refresh_task = dialog_list["refresh_task"]
+        if refresh_task is None or refresh_task.done():
+            logging.info("Список чатов устарел (%.0f сек.), обновление в фоне.", age_s)
+            asyncio.create_task(_refresh_dialog_list(dialog_list["limit"]))
+    return cached_chats[:limit], None
+
+def get_dialog_list_updated_at():
+    """Время (timestamp) последнего успешного обновления списка чатов или None."""
+    dialog_list = get_account().dialog_list_cache
+    return dialog_list["updated_at"] or None
+
+async def _update_dialog_list_on_message(event):
+    """Поднимает чат с новым сообщением в начало сохраненного списка (как в клиенте Telegram)."""
+    dialog_list = get_account().dialog_list_cache
+    cached_chats = dialog_list["chats"]
+    if cached_chats is None or not (event.is_private or event.is_group):
+        return
+    for index, chat_info in enumerate(cached_chats):
+        if chat_info['id'] == event.chat_id:
+            if index:
+                cached_chats.insert(0, cached_chats.pop(index))
+            return
+    dialog_list["dirty"] = True
+
+async def _mark_dialog_list_dirty(event):
+    """Изменения состава или названий чатов: список будет перечитан при следующем обращении."""
+    dialog_list = get_account().dialog_list_cache
+    dialog_list["dirty"] = True
+
+async def refresh_dialog_list_periodically(client_instance):
+    """Фоновая задача: редкое обновление списка чатов, если он устарел или был помечен событиями."""
+    dialog_list = get_account().dialog_list_cache
+    while client_instance and client_instance.is_connected():
+        await asyncio.sleep(DIALOG_LIST_REFRESH_INTERVAL_S)
+        if dialog_list["chats"] is None:
+            continue
+        age_s = time.time() - dialog_list["updated_at"]
+        if dialog_list["dirty"] or age_s >= DIALOG_LIST_REFRESH_INTERVAL_S:
+            try:
+                await _refresh_dialog_list(dialog_list["limit"])
+                logging.info("Список чатов обновлен в фоне.")
+            except Exception as e:
+                logging.warning("Не удалось обновить список чатов в фоне: %s", e)
+
+
+def _entity_type(entity):
+    """Тип сущности Telegram: 'user', 'bot', 'group' или 'channel'."""
+    if isinstance(entity, User):
+        return 'bot' if getattr(entity, 'bot', False) else 'user'
+    if getattr(entity, 'broadcast', False):
+        return 'channel'
+    return 'group'
+
+def remember_entity(peer_id, entity):
+    """Сохраняет в кэш имен аккаунта отображаемое имя, username и тип сущности; возвращает запись кэша."""
+    entity_cache = get_account().entity_cache
+    name = getattr(entity, 'title', None)
+    if not name:
+        name = getattr(entity, 'first_name', '') or ''
+        last_name = getattr(entity, 'last_name', '')
+        if last_name:
+            name = f"{name} {last_name}".strip()
+    entity_info = {
+        "id": entity.id,
+        "name": name,
+        "username": getattr(entity, 'username', None),
+        "type": _entity_type(entity),
+        "cached_at": time.time(),
+    }
+    entity_cache[peer_id] = entity_info
+    return entity_info
+
+def get_cached_entity_info(peer_id):
+    """Запись кэша имен аккаунта для peer_id, если она моложе ENTITY_CACHE_TTL_S, иначе None."""
+    entity_cache = get_account().entity_cache
+    entity_info = entity_cache.get(peer_id)
+    if entity_info and time.time() - entity_info["cached_at"] < ENTITY_CACHE_TTL_S:
+        return entity_info
+    return None
+
+def invalidate_entity(peer_id):
+    """Удаляет сущность из кэша имен аккаунта (например, после смены имени)."""
+    entity_cache = get_account().entity_cache
+    if entity_cache.pop(peer_id, None):
+        logging.info("Кэш имени для %s сброшен.", peer_id)
+
+async def _invalidate_entities_on_update(update):
+    """Сбрасывает кэш имен по событиям смены имени пользователя или названия чата."""
+    if isinstance(update, (UpdateUserName, UpdateUser)):
+        invalidate_entity(update.user_id)
+    elif isinstance(update, UpdateChat):
+        invalidate_entity(utils.get_peer_id(PeerChat(update.chat_id)))
+    elif isinstance(update, UpdateChannel):
+        invalidate_entity(utils.get_peer_id(PeerChannel(update.channel_id)))
+
+def get_sender_display_name(msg):
+    """Имя отправителя для префикса <ник:...>: из кэша имен или из msg.sender (с сохранением в кэш)."""
+    entity_info = get_cached_entity_info(msg.sender_id)
+    if not entity_info:
+        if not msg.sender:
+            return f"User_{msg.sender_id}"
+        entity_info = remember_entity(msg.sender_id, msg.sender)
+    return (entity_info["name"] or entity_info["username"] or f"User_{entity_info['id']}").strip()
 
 async def get_chat_info(chat_id):
-    """Получает информацию о конкретном чате по ID."""
+    """
+    Получает информацию о конкретном чате по ID.
+    Имя берется из кэша имен аккаунта, client.get_entity вызывается только при его отсутствии.
+    """
+    account = get_account()
+    client = account.client
+    chat_info_cache = account.chat_info_cache
+    entity_info = get_cached_entity_info(chat_id)
+    if entity_info:
+        chat_info = {'id': entity_info["id"], 'name': entity_info["name"] or f"ID: {entity_info['id']}"}
+        chat_info_cache[chat_id] = chat_info
+        return chat_info, None
+
     if not client or not client.is_connected() or not await client.is_user_authorized():
         logging.warning(f"get_chat_info({chat_id}): Клиент Telegram не подключен или не авторизован.")
         return None, "Telegram client not connected or authorized."
@@ -581,16 +495,10 @@ async def get_chat_info(chat_id):
     error = None
     try:
         entity = await client.get_entity(chat_id)
-        name = getattr(entity, 'title', None) 
-        if not name: 
-            name = getattr(entity, 'first_name', '')
-            last_name = getattr(entity, 'last_name', '')
-            if last_name:
-                name = f"{name} {last_name}".strip()
-        if not name: 
-            name = f"ID: {entity.id}"
-
-        chat_info = {'id': entity.id, 'name': name}
+        entity_info = remember_entity(chat_id, entity)
+
+        chat_info = {'id': entity.id, 'name': entity_info["name"] or f"ID: {entity.id}"}
+        chat_info_cache[chat_id] = chat_info
     except ValueError:
          logging.error(f"Не удалось найти чат с ID: {chat_id}")
          error = f"Could not find chat with ID: {chat_id}"
@@ -602,12 +510,80 @@ async def get_chat_info(chat_id):
         error = f"Error getting chat info for {chat_id}: {e}"
     return chat_info, error
 
+def get_cached_chat_info(chat_id):
+    """
+    Возвращает последнюю известную информацию о чате (из get_chat_info или get_chats)
+    без обращения к Telegram, либо None, если чат еще не запрашивался.
+    """
+    chat_info_cache = get_account().chat_info_cache
+    chat_info = chat_info_cache.get(chat_id)
+    return dict(chat_info) if chat_info else None
+
+def schedule_read_acknowledge(chat_id, max_id):
+    """
+    Ставит отметку о прочтении чата до max_id в очередь (выполняется в цикле telegram_loop).
+    Отметка отправляется, только если max_id больше уже отмеченного, а все отметки за
+    READ_ACK_FLUSH_INTERVAL_S секунд по всем чатам объединяются и отправляются одним проходом
+    (для каждого чата - одна с наибольшим ID).
+    """
+    read_acks = get_account().read_acks
+    if max_id <= max(read_acks["acked"].get(chat_id, 0), read_acks["pending"].get(chat_id, 0)):
+        return
+    read_acks["pending"][chat_id] = max_id
+    flush_task = read_acks["flush_task"]
+    if flush_task is None or flush_task.done():
+        read_acks["flush_task"] = asyncio.create_task(_flush_read_acknowledges())
+
+def _requeue_read_acknowledge(read_acks, chat_id, max_id):
+    if max_id > read_acks["pending"].get(chat_id, 0):
+        read_acks["pending"][chat_id] = max_id
+
+async def _flush_read_acknowledges():
+    """
+    Каждые READ_ACK_FLUSH_INTERVAL_S секунд отправляет накопленные отметки о прочтении, пока они есть:
+    отметки, поставленные во время отправки, уходят следующим проходом той же задачи. Неудачная
+    отметка повторяется до READ_ACK_MAX_ATTEMPTS раз; без подключения отметки ждут следующего вызова
+    schedule_read_acknowledge.
+    """
+    account = get_account()
+    client = account.client
+    read_acks = account.read_acks
+    while read_acks["pending"]:
+        await asyncio.sleep(READ_ACK_FLUSH_INTERVAL_S)
+        pending = read_acks["pending"]
+        read_acks["pending"] = {}
+        if not client or not client.is_connected():
+            logging.warning("Отметки о прочтении для %d чатов отложены: клиент не подключен.", len(pending))
+            for chat_id, max_id in pending.items():
+                _requeue_read_acknowledge(read_acks, chat_id, max_id)
+            return
+        sent = 0
+        for chat_id, max_id in pending.items():
+            try:
+                await client.send_read_acknowledge(chat_id, max_id=max_id)
+                read_acks["acked"][chat_id] = max(read_acks["acked"].get(chat_id, 0), max_id)
+                read_acks["attempts"].pop(chat_id, None)
+                sent += 1
+            except Exception as read_err:
+                attempts = read_acks["attempts"].get(chat_id, 0) + 1
+                if attempts < READ_ACK_MAX_ATTEMPTS:
+                    read_acks["attempts"][chat_id] = attempts
+                    _requeue_read_acknowledge(read_acks, chat_id, max_id)
+                    logging.warning("Не удалось отметить сообщения в чате %s как прочитанные (попытка %d): %s",
+                                    chat_id, attempts, read_err)
+                else:
+                    read_acks["attempts"].pop(chat_id, None)
+                    logging.warning("Отметка о прочтении в чате %s отброшена после %d попыток: %s",
+                                    chat_id, attempts, read_err)
+        logging.debug("Отправлены отметки о прочтении для %d чатов.", sent)
+
 async def get_media_for_message(chat_id, message_id):
     """
     Загружает медиа-контент для ОДНОГО конкретного сообщения.
     Использует дисковый кэш, сохраняя файлы как изображения/видео, а не JSON.
     Возвращает список 'parts' в формате base64, как и раньше, для совместимости с Gemini.
     """
+    client = get_account().client
     if not client or not client.is_connected():
         return None, "Telegram client is not connected."
     
@@ -615,310 +591,254 @@ async def get_media_for_message(chat_id, message_id):
         msg = await client.get_messages(chat_id, ids=message_id)
         if not msg or not msg.media:
             return None, "Message not found or has no media."
+    except Exception as e:
+        logging.error("Ошибка при получении медиа для сообщения %s в чате %s: %s", message_id, chat_id, e, exc_info=True)
+        return None, f"An unexpected error occurred: {e}"
 
-        media_type = None
-        mime_type = None
-        file_ext = None
-        
-        if isinstance(msg.media, MessageMediaPhoto):
-            media_type = 'image'
-            mime_type = 'image/jpeg'
-            file_ext = '.jpg'
-        elif isinstance(msg.media, MessageMediaDocument):
-            doc = msg.media.document
-            mime_type = getattr(doc, 'mime_type', '')
-            file_ext = get_extension_from_mime(mime_type)
-            if file_ext == '.mp4': media_type = 'video'
-            elif file_ext in ['.mp3', '.ogg']: media_type = 'audio'
-            elif file_ext == '.pdf': media_type = 'file'
-
-        if not media_type or not mime_type or not file_ext:
-            return None, "Unsupported media type for download."
-
-        cache_filename = f"{chat_id}_{msg.id}{file_ext}"
-        cache_filepath = os.path.join(MEDIA_CACHE_DIR, cache_filename)
-
-        if os.path.exists(cache_filepath):
-            logging.info(f"Медиа найдено в кэше: {cache_filepath}. Чтение файла...")
-            try:
-                with open(cache_filepath, 'rb') as f:
-                    media_bytes = f.read()
-                
-                base64_data = base64.b64encode(media_bytes).decode('utf-8')
-                part_key = f"{media_type}_base64"
-                return [{"mime_type": mime_type, part_key: base64_data}], None
+    return await _load_media_for_message(chat_id, msg)
+
+def _detect_media_type(msg):
+    """Определяет (тип медиа, MIME-тип, расширение) для сообщения; (None, None, None), если тип не поддерживается."""
+    media_type = None
+    mime_type = None
+    file_ext = None
+
+    if isinstance(msg.media, MessageMediaPhoto):
+        media_type = 'image'
+        mime_type = 'image/jpeg'
+        file_ext = '.jpg'
+    elif isinstance(msg.media, MessageMediaDocument):
+        doc = msg.media.document
+        mime_type = getattr(doc, 'mime_type', '')
+        file_ext = get_extension_from_mime(mime_type)
+        if file_ext == '.mp4': media_type = 'video'
+        elif file_ext in ['.mp3', '.ogg']: media_type = 'audio'
+        elif file_ext == '.pdf': media_type = 'file'
+
+    if not media_type or not mime_type or not file_ext:
+        return None, None, None
+    return media_type, mime_type, file_ext
+
+async def _cache_media_file_for_message(chat_id, msg):
+    """
+    Гарантирует, что медиа уже полученного сообщения лежит в дисковом кэше.
+    Возвращает ({"path", "media_type", "mime_type", "data"}, ошибка), где data - байты файла,
+    если он был только что загружен из Telegram (иначе None), а path - None, если сохранить файл не удалось.
+    """
+    media_type, mime_type, file_ext = _detect_media_type(msg)
+    if not media_type:
+        return None, "Unsupported media type for download."
 
-            except Exception as e:
-                logging.warning(f"Не удалось прочитать файл из кэша {cache_filepath}, будет произведена повторная загрузка: {e}")
+    cache_filepath = get_media_cache_path(chat_id, msg.id, file_ext)
+    media_file = {"path": cache_filepath, "media_type": media_type, "mime_type": mime_type, "data": None}
 
-        logging.info(f"Медиа не найдено в кэше. Загрузка из Telegram...")
+    if os.path.exists(cache_filepath):
+        logging.debug("Медиа найдено в кэше: %s.", cache_filepath)
+        MEDIA_CACHE_HITS.inc()
+        return media_file, None
+
+    logging.info("Медиа не найдено в кэше. Загрузка из Telegram...")
+    with MEDIA_DOWNLOAD_SECONDS.time(media_type=media_type), span("media_download", message_id=msg.id, media_type=media_type) as download_span:
         media_bytes = await msg.download_media(file=bytes)
+        download_span.set(bytes=len(media_bytes or b""))
 
-        if not media_bytes:
-             return None, "Failed to download media from Telegram."
+    if not media_bytes:
+         return None, "Failed to download media from Telegram."
+    MEDIA_DOWNLOAD_BYTES.observe(len(media_bytes), media_type=media_type)
+    media_file["data"] = media_bytes
 
-        try:
-            os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
-            with open(cache_filepath, 'wb') as f:
-                f.write(media_bytes)
-            logging.info(f"Медиа сохранено в кэш: {cache_filepath}")
-        except IOError as e:
-            logging.error(f"Не удалось сохранить медиа в кэш {cache_filepath}: {e}")
+    try:
+        os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        with open(cache_filepath, 'wb') as f:
+            f.write(media_bytes)
+        logging.info("Медиа сохранено в кэш: %s", cache_filepath)
+    except IOError as e:
+        logging.error("Не удалось сохранить медиа в кэш %s: %s", cache_filepath, e)
+        media_file["path"] = None
+
+    return media_file, None
+
+async def _load_media_for_message(chat_id, msg):
+    """Возвращает (parts, ошибка) для уже полученного сообщения с медиа: из дискового кэша или из Telegram."""
+    message_id = msg.id
+    try:
+        media_file, error = await _cache_media_file_for_message(chat_id, msg)
+        if error:
+            return None, error
+
+        media_bytes = media_file["data"]
+        if media_bytes is None:
+            try:
+                with open(media_file["path"], 'rb') as f:
+                    media_bytes = f.read()
+            except Exception as e:
+                logging.warning("Не удалось прочитать файл из кэша %s, будет произведена повторная загрузка: %s", media_file['path'], e)
+                media_bytes = await msg.download_media(file=bytes)
+                if not media_bytes:
+                    return None, "Failed to download media from Telegram."
 
         base64_data = base64.b64encode(media_bytes).decode('utf-8')
-        part_key = f"{media_type}_base64"
+        part_key = f"{media_file['media_type']}_base64"
         
-        return [{"mime_type": mime_type, part_key: base64_data}], None
+        return [{"mime_type": media_file["mime_type"], part_key: base64_data}], None
 
     except Exception as e:
-        logging.error(f"Ошибка при получении медиа для сообщения {message_id} в чате {chat_id}: {e}", exc_info=True)
+        logging.error("Ошибка при получении медиа для сообщения %s в чате %s: %s", message_id, chat_id, e, exc_info=True)
         return None, f"An unexpected error occurred: {e}"
 
-async def get_formatted_history(chat_id, limit=60, group_threshold_minutes=4.5, settings=None, download_media=True):
+async def _load_media_file_for_message(chat_id, msg):
+    """Возвращает ({"path", "media_type", "mime_type"}, ошибка): медиа сообщения, сохраненное в дисковый кэш."""
+    try:
+        media_file, error = await _cache_media_file_for_message(chat_id, msg)
+        if error:
+            return None, error
+        if not media_file["path"]:
+            return None, "Failed to save media to cache."
+        return {"path": media_file["path"], "media_type": media_file["media_type"], "mime_type": media_file["mime_type"]}, None
+    except Exception as e:
+        logging.error("Ошибка при сохранении медиа сообщения %s в чате %s: %s", msg.id, chat_id, e, exc_info=True)
+        return None, f"An unexpected error occurred: {e}"
+
+async def get_media_file_for_message(chat_id, message_id):
+    """
+    Загружает медиа ОДНОГО сообщения в дисковый кэш (если его там еще нет) для отдачи файлом.
+    Возвращает ({"path", "media_type", "mime_type"}, ошибка).
+    """
+    client = get_account().client
+    if not client or not client.is_connected():
+        return None, "Telegram client is not connected."
+
+    try:
+        msg = await client.get_messages(chat_id, ids=message_id)
+        if not msg or not msg.media:
+            return None, "Message not found or has no media."
+    except Exception as e:
+        logging.error("Ошибка при получении сообщения %s в чате %s: %s", message_id, chat_id, e, exc_info=True)
+        return None, f"An unexpected error occurred: {e}"
+
+    return await _load_media_file_for_message(chat_id, msg)
+
+async def iter_media_for_messages(chat_id, message_ids, max_concurrency=MEDIA_BATCH_CONCURRENCY, as_files=False):
+    """
+    Асинхронный генератор медиа для нескольких сообщений одного чата.
+    Все сообщения запрашиваются одним вызовом get_messages(ids=[...]), загрузка идет
+    параллельно (не больше max_concurrency одновременно), а результаты отдаются
+    по мере готовности как кортежи (message_id, parts, ошибка).
+    При as_files=True медиа только сохраняется в дисковый кэш, и вместо parts
+    отдается словарь {"path", "media_type", "mime_type"}.
+    """
+    client = get_account().client
+    load_media = _load_media_file_for_message if as_files else _load_media_for_message
+    message_ids = list(message_ids)
+    if not client or not client.is_connected():
+        for message_id in message_ids:
+            yield message_id, None, "Telegram client is not connected."
+        return
+
+    try:
+        messages = await client.get_messages(chat_id, ids=message_ids)
+    except Exception as e:
+        logging.error("Ошибка пакетного получения сообщений %s в чате %s: %s", message_ids, chat_id, e, exc_info=True)
+        for message_id in message_ids:
+            yield message_id, None, f"An unexpected error occurred: {e}"
+        return
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def load(message_id, msg):
+        if not msg or not msg.media:
+            return message_id, None, "Message not found or has no media."
+        async with semaphore:
+            media_result, error = await load_media(chat_id, msg)
+        return message_id, media_result, error
+
+    tasks = [asyncio.create_task(load(message_id, msg)) for message_id, msg in zip(message_ids, messages)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def get_formatted_history(chat_id, limit=60, group_threshold_minutes=4.5, settings=None, download_media=True, token_budget=None):
     """
     Получает историю сообщений, форматирует ее по особому, чтобы нейросеть
     могла лучше понимать команды и общение, и объединяет последовательные сообщения.
+    token_budget - если задан, из последних limit сообщений берутся самые новые,
+    укладывающиеся в этот бюджет токенов (по локальной оценке).
+    """
+    with span("get_formatted_history", limit=limit, download_media=download_media) as history_span:
+        page, error_message = await get_history_page(chat_id, limit=limit, group_threshold_minutes=group_threshold_minutes,
+                                                     settings=settings, download_media=download_media, token_budget=token_budget)
+        history_span.set(fetched=page["fetched_count"] if page else 0, blocks=len(page["messages"]) if page else 0)
+        if error_message:
+            history_span.fail(error_message)
+    return (page["messages"] if page else []), error_message
+
+async def get_history_page(chat_id, limit=60, group_threshold_minutes=4.5, settings=None, download_media=True, offset_id=0, token_budget=None):
     """
-    global my_id
+    Получает одну страницу истории в формате get_formatted_history.
+    offset_id - курсор: берутся сообщения старше сообщения с этим ID (0 - самые новые).
+    Возвращает ({"messages": [...], "fetched_count": число полученных сообщений Telegram,
+    "next_offset_id": курсор следующей страницы или None}, ошибка).
+    Сообщения отмечаются прочитанными только при запросе первой страницы.
+    """
+    account = get_account()
+    client = account.client
+    empty_page = {"messages": [], "fetched_count": 0, "next_offset_id": None}
     if not client or not client.is_connected() or not await client.is_user_authorized():
-        return [], "Telegram client not connected or authorized."
+        return empty_page, "Telegram client not connected or authorized."
 
     final_formatted_messages = []
+    fetched_count = 0
+    next_offset_id = None
     error_message = None
 
-    if my_id is None:
+    if account.my_id is None:
         try:
             me = await client.get_me()
-            if me: my_id = me.id
-            else: return [], "Error: Could not determine user ID."
+            if me: account.my_id = me.id
+            else: return empty_page, "Error: Could not determine user ID."
         except Exception as e:
-            return [], f"Error getting user ID: {e}"
+            return empty_page, f"Error getting user ID: {e}"
 
     if settings is None:
         settings = {}
 
-    replace_placeholder_with_empty = settings.get('ignore_all_media', False)
-    loading_error_suffix = " - не удалось загрузить."
-    group_delta = timedelta(minutes=group_threshold_minutes)
-    split_separator = "\n{split}\n"
-    is_group_chat = chat_id < 0
-
+    history_started = time.perf_counter()
     try:
-        logging.info(f"Запрос истории для чата {chat_id}, лимит {limit}, режим загрузки: {download_media}")
-        messages = await client.get_messages(chat_id, limit=limit)
-        logging.info(f"Получено {len(messages)} сообщений.")
+        logging.debug("Запрос истории для чата %s, лимит %s, курсор %s, режим загрузки: %s", chat_id, limit, offset_id, download_media)
+        messages = await client.get_messages(chat_id, limit=limit, offset_id=offset_id)
+        logging.debug("Получено %d сообщений.", len(messages))
+        HISTORY_MESSAGES.observe(len(messages))
 
         if not messages:
-            return [], None
-
-        try:
-            await client.send_read_acknowledge(chat_id, max_id=messages[0].id)
-        except Exception as read_err:
-            logging.warning(f"Не удалось отметить сообщения как прочитанные: {read_err}")
-
-
-        all_reactions_on_messages = {}
-        for msg in messages:
-            if msg and isinstance(msg.reactions, MessageReactions) and msg.reactions.recent_reactions:
-                reactions_list = []
-                for recent_reaction in msg.reactions.recent_reactions:
-                    reactor_id = None
-                    peer = recent_reaction.peer_id
-                    if isinstance(peer, PeerUser):
-                        reactor_id = peer.user_id
-                    elif isinstance(peer, PeerChannel):
-                        reactor_id = peer.channel_id
-                    
-                    if reactor_id and hasattr(recent_reaction, 'reaction'):
-                        emoji = ''
-                        if isinstance(recent_reaction.reaction, ReactionEmoji):
-                            emoji = recent_reaction.reaction.emoticon
-                        if emoji:
-                            reactions_list.append({'reactor_id': reactor_id, 'emoji': emoji})
-                if reactions_list:
-                    all_reactions_on_messages[msg.id] = reactions_list
-
-        raw_intermediate_list = []
-        messages.reverse()
-
-        for msg in messages:
-            if isinstance(msg, MessageService) or not msg.sender_id:
-                continue
-
-            role = "model" if msg.sender_id == my_id else "user"
-            timestamp_str = msg.date.strftime("%Y-%m-%d %H:%M:%S")
-            id_prefix = f"(ID: {msg.id}) " if role == "user" or is_group_chat else ""
-            timestamp_info = f"{id_prefix}\n[{timestamp_str}]"
-            sender_prefix = ""
-            if is_group_chat and role == "user":
-                sender = msg.sender
-                sender_name = getattr(sender, 'first_name', '')
-                last_name = getattr(sender, 'last_name', '')
-                if last_name: sender_name = f"{sender_name} {last_name}".strip()
-                if not sender_name: sender_name = getattr(sender, 'username', f"User_{sender.id}") or f"User_{sender.id}"
-                sender_prefix = f"<ник:{sender_name.strip()}> "
-            
-            
-            reply_prefix = f"answer({msg.reply_to_msg_id})\n" if msg.reply_to_msg_id else ""
-            
-            is_media_message = False
-            content_parts = []
-            content_text = ""
-
-            if msg.media:
-                media_processed = False
-                if isinstance(msg.media, MessageMediaPhoto):
-                    placeholder = "[Изображение]" + loading_error_suffix
-                    if settings.get('can_see_photos', True):
-                        is_media_message = True
-                        if download_media:
-                            media_data, _ = await get_media_for_message(chat_id, msg.id)
-                            if media_data: content_parts.extend(media_data)
-                            else: is_media_message = False; content_text = placeholder
-                        else:
-                            content_parts.append({"type": "media_placeholder", "chat_id": chat_id, "message_id": msg.id})
-                    else:
-                        content_text = "" if replace_placeholder_with_empty else placeholder
-                    media_processed = True
-                elif isinstance(msg.media, MessageMediaDocument):
-                    doc = msg.media.document; doc_attrs = getattr(doc, 'attributes', []); doc_mime = getattr(doc, 'mime_type', '')
-                    is_video = any(isinstance(attr, DocumentAttributeVideo) for attr in doc_attrs)
-                    is_audio = any(isinstance(attr, DocumentAttributeAudio) for attr in doc_attrs)
-                    is_pdf = doc_mime == 'application/pdf'
-                    if is_video:
-                        is_round = any(getattr(attr, 'round_message', False) for attr in doc_attrs)
-                        placeholder = ("[Видео-кружок]" if is_round else "[Видео]") + loading_error_suffix
-                        if settings.get('can_see_videos', True):
-                            is_media_message = True
-                            if download_media:
-                                media_data, _ = await get_media_for_message(chat_id, msg.id)
-                                if media_data: content_parts.extend(media_data)
-                                else: is_media_message = False; content_text = placeholder
-                            else:
-                                content_parts.append({"type": "media_placeholder", "chat_id": chat_id, "message_id": msg.id})
-                        else: content_text = "" if replace_placeholder_with_empty else placeholder
-                        media_processed = True
-                    elif is_audio:
-                        is_voice = any(getattr(attr, 'voice', False) for attr in doc_attrs)
-                        placeholder = ("[Голосовое сообщение]" if is_voice else "[Аудиофайл]") + loading_error_suffix
-                        if settings.get('can_see_audio', True):
-                            is_media_message = True
-                            if download_media:
-                                media_data, _ = await get_media_for_message(chat_id, msg.id)
-                                if media_data: content_parts.extend(media_data)
-                                else: is_media_message = False; content_text = placeholder
-                            else:
-                                content_parts.append({"type": "media_placeholder", "chat_id": chat_id, "message_id": msg.id})
-                        else: content_text = "" if replace_placeholder_with_empty else placeholder
-                        media_processed = True
-                    elif is_pdf:
-                        placeholder = "[PDF-файл]" + loading_error_suffix
-                        if settings.get('can_see_files_pdf', True):
-                            is_media_message = True
-                            if download_media:
-                                media_data, _ = await get_media_for_message(chat_id, msg.id)
-                                if media_data: content_parts.extend(media_data)
-                                else: is_media_message = False; content_text = placeholder
-                            else:
-                                content_parts.append({"type": "media_placeholder", "chat_id": chat_id, "message_id": msg.id})
-                        else: content_text = "" if replace_placeholder_with_empty else placeholder
-                        media_processed = True
-                if not media_processed:
-                    placeholder_text = "[Медиа]"
-                    if isinstance(msg.media, MessageMediaContact): placeholder_text = "[Контакт]"
-                    elif isinstance(msg.media, MessageMediaGeo): placeholder_text = "[Геопозиция]"
-                    elif isinstance(msg.media, MessageMediaPoll): placeholder_text = "[Опрос]"
-                    elif isinstance(msg.media, MessageMediaVenue): placeholder_text = "[Место]"
-                    elif isinstance(msg.media, MessageMediaGame): placeholder_text = "[Игра]"
-                    elif isinstance(msg.media, MessageMediaInvoice): placeholder_text = "[Счет]"
-                    elif isinstance(msg.media, MessageMediaUnsupported): placeholder_text = "[Неподдерживаемое сообщение]"
-                    else: placeholder_text = "[Документ]"
-                    content_text = "" if replace_placeholder_with_empty else (placeholder_text + loading_error_suffix)
-            if msg.text:
-                if content_text:
-                    content_text = f"{msg.text}\n{content_text}"
-                else:
-                    content_text = msg.text
-            elif msg.sticker and not content_parts:
-                codename = STICKER_ID_TO_CODENAME.get(msg.sticker.id, '')
-                content_text = f"sticker({codename})" if codename else f"[Стикер]"
-
-            full_text_block = f"{reply_prefix}{timestamp_info}\n{sender_prefix}{content_text}".strip()
-            if full_text_block:
-                content_parts.insert(0, {"text": full_text_block})
-
-            raw_intermediate_list.append({
-                "role": role, "parts": content_parts, "is_media": is_media_message,
-                "_original_msg": msg, "_sender_id": msg.sender_id, "_msg_id": msg.id,
-                "_reactions_to_prepend": []
-            })
-        
-        msg_id_to_index = {item['_msg_id']: i for i, item in enumerate(raw_intermediate_list)}
-        for reacted_on_msg_id, reactions in all_reactions_on_messages.items():
-            if reacted_on_msg_id not in msg_id_to_index:
-                continue
-
-            start_index = msg_id_to_index[reacted_on_msg_id]
-            for reaction in reactions:
-                reactor_id = reaction['reactor_id']
-                reaction_command = f"react({reacted_on_msg_id})[{reaction['emoji']}]"
-                for i in range(start_index + 1, len(raw_intermediate_list)):
-                    if raw_intermediate_list[i]['_sender_id'] == reactor_id:
-                        if reaction_command not in raw_intermediate_list[i]['_reactions_to_prepend']:
-                            raw_intermediate_list[i]['_reactions_to_prepend'].append(reaction_command)
-                        break
-        
-        for item_data in raw_intermediate_list:
-            if item_data['_reactions_to_prepend']:
-                reactions_text = "\n".join(item_data['_reactions_to_prepend'])
-                found_text_part = False
-                for part in item_data['parts']:
-                    if 'text' in part:
-                        part['text'] = f"{reactions_text}\n{part['text']}"
-                        found_text_part = True
-                        break
-                if not found_text_part:
-                    item_data['parts'].insert(0, {'text': reactions_text})
-
-        if not raw_intermediate_list:
-            return [], None
-        for item_data in raw_intermediate_list:
-            current_msg_obj, current_parts, current_role, current_is_media = item_data["_original_msg"], item_data["parts"], item_data["role"], item_data["is_media"]
-            can_group = False
-            if final_formatted_messages:
-                last_entry = final_formatted_messages[-1]
-                last_msg_obj, last_is_media = last_entry.get("_original_msg"), last_entry.get("is_media", False)
-                
-                has_reaction_prefix = any('react(' in p.get('text', '') for p in current_parts if 'text' in p)
-                if (last_msg_obj and not current_is_media and not last_is_media and not has_reaction_prefix and
-                    current_role == last_entry["role"] and current_msg_obj.sender_id == last_msg_obj.sender_id and
-                    (current_msg_obj.date - last_msg_obj.date) < group_delta):
-                    can_group = True
-            if can_group:
-                text_to_append = "\n".join([p['text'] for p in current_parts if 'text' in p])
-                for part in last_entry["parts"]:
-                    if 'text' in part:
-                        text_to_append_cleaned = re.sub(r"^\(ID: \d+\)\s*\n\[\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}\]\n(<ник:.*?>\s)?", "", text_to_append)
-                        part["text"] += f"{split_separator}{text_to_append_cleaned}"
-                        break
-                last_entry["_original_msg"] = current_msg_obj
-            else:
-                final_formatted_messages.append({"role": current_role, "parts": current_parts, "is_media": current_is_media, "_original_msg": current_msg_obj})
-        
-        for entry in final_formatted_messages:
-            entry.pop("_original_msg", None)
-            entry.pop("is_media", None)
-            if '_sender_id' in entry: del entry['_sender_id']
-            if '_msg_id' in entry: del entry['_msg_id']
-            if '_reactions_to_prepend' in entry: del entry['_reactions_to_prepend']
-
+            HISTORY_SECONDS.observe(time.perf_counter() - history_started)
+            return empty_page, None
+
+        fetched_count = len(messages)
+        if fetched_count >= limit:
+            next_offset_id = messages[-1].id
+
+        if not offset_id:
+            schedule_read_acknowledge(chat_id, messages[0].id)
+
+        messages_by_id = {msg.id: msg for msg in messages}
+        final_formatted_messages = await format_history(
+            messages, chat_id, account.my_id, settings, download_media, group_threshold_minutes,
+            sticker_codenames=STICKER_ID_TO_CODENAME,
+            sender_name=get_sender_display_name,
+            load_media=lambda msg_id: _load_media_for_message(chat_id, messages_by_id[msg_id]),
+            token_budget=token_budget,
+        )
 
-        logging.info(f"Успешно отформатировано и сгруппировано {len(final_formatted_messages)} блоков.")
+        logging.debug("Успешно отформатировано и сгруппировано %d блоков.", len(final_formatted_messages))
         error_message = None
 
     except ValueError as e:
         error_message = f"Error: Chat ID {chat_id} not found or invalid."
     except errors.FloodWaitError as e:
+         TELEGRAM_FLOOD_WAITS.inc(operation="history")
          error_message = f"Error: Too many requests to Telegram (history). Wait {e.seconds} sec."
     except errors.AuthKeyError:
         error_message = "Authorization key error. Please try restarting the application or deleting the session file."
@@ -926,13 +846,15 @@ async def get_formatted_history(chat_id, limit=60, group_threshold_minutes=4.5,
         logging.exception(f"Неизвестная ошибка получения истории чата {chat_id}: {e}")
         error_message = f"Unknown error getting chat history: {e}"
 
-    return final_formatted_messages, error_message
+    HISTORY_SECONDS.observe(time.perf_counter() - history_started)
+    return {"messages": final_formatted_messages, "fetched_count": fetched_count, "next_offset_id": next_offset_id}, error_message
 
 async def send_telegram_reaction(chat_id, message_id, emoji):
     """
     Отправляет реакцию на конкретное сообщение.
     Возвращает (bool: success, str: error_message | None).
     """
+    client = get_account().client
     if not client or not client.is_connected():
         return False, "Telegram client not connected."
 
@@ -964,10 +886,12 @@ async def send_telegram_reaction(chat_id, message_id, emoji):
         return False, f"An unexpected error occurred while sending reaction: {e}"
 
 
-def calculate_telegram_send_delay(message_text: str, settings: dict) -> float:
+def calculate_telegram_send_delay(message_text: str, settings: dict, already_elapsed_s: float = 0.0) -> float:
     """
     Рассчитывает полную задержку для симуляции печати сообщения в Telegram.
     Эта логика вынесена из send_telegram_message для предрасчета таймаутов.
+    already_elapsed_s - сколько секунд индикатор "печатает..." уже был показан
+    (например, во время генерации ответа); это время вычитается из задержки.
     """
     settings_dict = settings if isinstance(settings, dict) else {}
     min_delay_ms = settings_dict.get('typing_delay_ms_min', 40.0)
@@ -988,13 +912,14 @@ def calculate_telegram_send_delay(message_text: str, settings: dict) -> float:
         base_thinking_delay_s = 0.0 
     
     full_delay_s = base_thinking_delay_s + total_typing_duration_s
-    return full_delay_s
+    return max(0.0, full_delay_s - already_elapsed_s)
 
 async def send_sticker_by_codename(chat_id, codename, settings=None):
     """
     Отправляет случайный стикер из набора по кодовому имени, симулируя выбор.
     Возвращает (bool: success, str: error_message | None).
     """
+    client = get_account().client
     if not client or not client.is_connected():
         return False, "Telegram client not connected."
 
@@ -1076,12 +1001,16 @@ async def edit_message_with_correction_simulation(sent_message, full_corrected_t
     await client.edit_message(sent_message.peer_id, sent_message.id, text=full_corrected_text)
     logging.info(f"Сообщение {sent_message.id} отредактировано на полную версию.")
 
-async def send_telegram_message(chat_id, message_text, settings=None):
+async def send_telegram_message(chat_id, message_text, settings=None, typing_head_start_s=0.0, cancel_event=None):
     """
     Отправляет сообщение в Telegram, обрабатывая префикс 'answer()' для ответа
     и симулируя печать перед отправкой. Гарантирует удаление ВСЕХ префиксов 'answer()',
     но использует ID для ответа только из ПЕРВОГО найденного.
+    typing_head_start_s - время, которое индикатор печати уже был показан до вызова.
+    Если cancel_event установлен во время симуляции печати, индикатор снимается, сообщение
+    не отправляется и возвращается (True, SEND_CANCELLED_MESSAGE).
     """
+    client = get_account().client
 
     if not client or not client.is_connected() or not await client.is_user_authorized():
         logging.warning(f"send_telegram_message({chat_id}): Клиент Telegram не подключен или не авторизован.")
@@ -1102,7 +1031,7 @@ async def send_telegram_message(chat_id, message_text, settings=None):
     message_text = re.sub(r"answer\s*\((\d+)\)", '', message_text, flags=re.IGNORECASE).strip()
     
     if first_match:
-        logging.info(f"Текст сообщения после удаления всех тегов answer(): '{message_text[:70]}...'")
+        logging.debug("Текст сообщения после удаления всех тегов answer(): '%.70s...'", message_text)
 
     if not message_text or not message_text.strip():
          logging.warning(f"Попытка отправить пустое сообщение в чат {chat_id} (возможно, после удаления 'answer()'). Отправка отменена.")
@@ -1134,15 +1063,25 @@ async def send_telegram_message(chat_id, message_text, settings=None):
     try:
         settings_dict = settings if isinstance(settings, dict) else {}
 
-        full_delay_s = calculate_telegram_send_delay(message_to_send_initially, settings_dict)
+        full_delay_s = calculate_telegram_send_delay(message_to_send_initially, settings_dict, already_elapsed_s=typing_head_start_s)
         
-        logging.info(f"Симуляция печати в чате {chat_id} на ~{full_delay_s:.2f} сек...")
+        if typing_head_start_s > 0:
+            logging.info("Индикатор печати уже был показан %.2f сек во время генерации.", typing_head_start_s)
+        logging.info("Симуляция печати в чате %s на ~%.2f сек...", chat_id, full_delay_s)
         async with client.action(chat_id, 'typing'):
-            await asyncio.sleep(full_delay_s)
+            if cancel_event is None:
+                await asyncio.sleep(full_delay_s)
+            else:
+                try:
+                    await asyncio.wait_for(cancel_event.wait(), timeout=full_delay_s)
+                    logging.info("Отправка в чат %s отменена во время симуляции печати.", chat_id)
+                    return True, SEND_CANCELLED_MESSAGE
+                except asyncio.TimeoutError:
+                    pass
 
-        logging.info(f"Отправка сообщения в чат {chat_id} (ответ на {reply_to_id if reply_to_id else 'нет'})...")
+        logging.info("Отправка сообщения в чат %s (ответ на %s)...", chat_id, reply_to_id or 'нет')
         sent_message = await client.send_message(chat_id, message_to_send_initially, reply_to=reply_to_id)
-        logging.info(f"Сообщение успешно отправлено в чат {chat_id}.")
+        logging.info("Сообщение успешно отправлено в чат %s.", chat_id)
         
         if message_to_send_initially != original_message_full and sent_message:
             await edit_message_with_correction_simulation(sent_message, original_message_full, settings_dict, client)
@@ -1155,7 +1094,7 @@ async def send_telegram_message(chat_id, message_text, settings=None):
             error = f"Invalid reply message ID {reply_to_id}. Sending without reply."
             reply_to_id = None
             try:
-                logging.info(f"Повторная отправка в чат {chat_id} (уже без ответа). Текст: '{original_message_full[:50].replace(chr(10), ' ')}...'")
+                logging.info("Повторная отправка в чат %s (уже без ответа).", chat_id)
                 await client.send_message(chat_id, original_message_full)
                 logging.info(f"Сообщение успешно отправлено в чат {chat_id} (без ответа после ошибки MsgIdInvalidError).")
                 success = True
@@ -1174,6 +1113,7 @@ async def send_telegram_message(chat_id, message_text, settings=None):
          success = False
          error = f"Error: Chat ID '{chat_id}' not found or invalid for sending."
     except errors.FloodWaitError as e:
+         TELEGRAM_FLOOD_WAITS.inc(operation="send_message")
          logging.error(f"Слишком много запросов при отправке в чат {chat_id}. Подождите {e.seconds} секунд.")
          success = False
          error = f"Error: Too many requests to Telegram (sending). Wait {e.seconds} sec."
@@ -1196,67 +1136,491 @@ async def send_telegram_message(chat_id, message_text, settings=None):
 
     return success, error
 
+async def _hold_generation_typing(chat_id, stop_event):
+    """Держит индикатор 'печатает...' до сигнала остановки (но не дольше GENERATION_TYPING_MAX_S)."""
+    account = get_account()
+    client = account.client
+    generation_typing = account.generation_typing
+    try:
+        async with client.action(chat_id, 'typing', auto_cancel=False):
+            await asyncio.wait_for(stop_event.wait(), timeout=GENERATION_TYPING_MAX_S)
+    except asyncio.TimeoutError:
+        logging.warning("Индикатор печати в чате %s снят по таймауту (%s сек).", chat_id, GENERATION_TYPING_MAX_S)
+        generation_typing.pop(chat_id, None)
+        await client.action(chat_id, 'cancel')
+    except Exception as e:
+        logging.warning("Не удалось показать индикатор печати в чате %s: %s", chat_id, e)
+
+async def start_generation_typing(chat_id):
+    """
+    Включает индикатор 'печатает...' в момент начала генерации ответа.
+    Время его показа потом вычитается из задержки симуляции печати первой текстовой части ответа.
+    Если индикатор уже включен (предыдущая генерация его не сняла), отсчет начинается заново.
+    Возвращает (bool: success, str: error_message | None).
+    """
+    account = get_account()
+    client = account.client
+    generation_typing = account.generation_typing
+    if not client or not client.is_connected():
+        return False, "Telegram client not connected."
+
+    previous_state = generation_typing.pop(chat_id, None)
+    if previous_state:
+        # Старая задача выходит из client.action без 'cancel', новая сразу продолжает индикатор.
+        previous_state["stop_event"].set()
+    stop_event = asyncio.Event()
+    generation_typing[chat_id] = {
+        "stop_event": stop_event,
+        "task": asyncio.create_task(_hold_generation_typing(chat_id, stop_event)),
+        "started_at": time.monotonic(),
+    }
+    logging.info("Индикатор печати в чате %s включен на время генерации.", chat_id)
+    return True, None
+
+async def stop_generation_typing(chat_id, cancel_indicator=True):
+    """
+    Выключает индикатор, включенный start_generation_typing.
+    Если cancel_indicator=False, индикатор не сбрасывается явно, чтобы отправка
+    продолжила его без "мигания".
+    Возвращает (float: сколько секунд индикатор был показан, str: error_message | None).
+    """
+    account = get_account()
+    client = account.client
+    generation_typing = account.generation_typing
+    typing_state = generation_typing.pop(chat_id, None)
+    if not typing_state:
+        return 0.0, None
+
+    typing_state["stop_event"].set()
+    try:
+        await asyncio.wait_for(typing_state["task"], timeout=5)
+        if cancel_indicator:
+            await client.action(chat_id, 'cancel')
+    except Exception as e:
+        logging.warning("Ошибка при выключении индикатора печати в чате %s: %s", chat_id, e)
+
+    return time.monotonic() - typing_state["started_at"], None
+
+def _get_send_queue(chat_id):
+    """Возвращает (создавая при необходимости) состояние очереди отправки для чата."""
+    send_queues = get_account().send_queues
+    queue_state = send_queues.get(chat_id)
+    if queue_state is None:
+        queue_state = {
+            "lock": asyncio.Lock(),
+            "generation": 0,
+            "pending_plans": 0,
+            "pending_parts": 0,
+            "queued_estimate_s": 0.0,
+            "in_flight_part": None,
+            "in_flight_since": None,
+            "cancel_on_new_message": False,
+            "cancel_event": asyncio.Event(),
+            "sent_parts": 0,
+            "cancelled_parts": 0,
+        }
+        send_queues[chat_id] = queue_state
+    return queue_state
+
+def estimate_send_task_duration(task: dict, settings: dict) -> float:
+    """
+    Возвращает верхнюю оценку длительности одной задачи плана отправки (в секундах),
+    включая паузу перед следующей частью. Используется для расчета таймаутов.
+    """
+    settings_dict = settings if isinstance(settings, dict) else {}
+    max_think_s = settings_dict.get('base_thinking_delay_s_max', 2.8)
+    pause_s = max(max_think_s, settings_dict.get('base_thinking_delay_s_min', 1.2))
+
+    if task["type"] == "text":
+        max_duration = settings_dict.get('max_typing_duration_s', 25.0)
+        if max_duration <= 0:
+            return pause_s
+        max_delay_ms = settings_dict.get('typing_delay_ms_max', 90.0)
+        typing_s = max(1.5, min(len(task["content"]) * max_delay_ms / 1000.0, max_duration))
+        correction_s = max_think_s * 0.9 + max_duration
+        return max_think_s + typing_s + correction_s + pause_s
+    if task["type"] == "sticker":
+        return settings_dict.get('sticker_choosing_delay_max', 5.5) + pause_s
+    return pause_s
+
+def estimate_send_plan_duration(tasks: list, settings: dict) -> float:
+    """Верхняя оценка длительности всего плана с запасом на сетевые задержки."""
+    return sum(estimate_send_task_duration(task, settings) + 20.0 for task in tasks)
+
+def get_send_queue_backlog_s(chat_id) -> float:
+    """Возвращает оценку времени, которое займут уже поставленные в очередь чата планы."""
+    send_queues = get_account().send_queues
+    queue_state = send_queues.get(chat_id)
+    return queue_state["queued_estimate_s"] if queue_state else 0.0
+
+def get_send_queue_stats() -> dict:
+    """
+    Возвращает состояние очередей отправки по чатам для мониторинга:
+    длину очереди (планы и части) и время выполнения текущей части.
+    """
+    send_queues = get_account().send_queues
+    now = time.monotonic()
+    stats = {}
+    for chat_id, queue_state in list(send_queues.items()):
+        in_flight_since = queue_state["in_flight_since"]
+        stats[chat_id] = {
+            "pending_plans": queue_state["pending_plans"],
+            "pending_parts": queue_state["pending_parts"],
+            "in_flight_part": queue_state["in_flight_part"],
+            "in_flight_s": round(now - in_flight_since, 3) if in_flight_since else 0.0,
+            "sent_parts": queue_state["sent_parts"],
+            "cancelled_parts": queue_state["cancelled_parts"],
+        }
+    return stats
+
+async def cancel_pending_sends(chat_id):
+    """
+    Отменяет все еще не отправленные части планов в очереди чата.
+    Текст, для которого сейчас идет симуляция печати, тоже отменяется (индикатор снимается);
+    стикер, реакция или уже начатая отправка текста будут доведены до конца.
+    Возвращает (int: количество отмененных частей, str: error_message | None).
+    """
+    send_queues = get_account().send_queues
+    queue_state = send_queues.get(chat_id)
+    if not queue_state or queue_state["pending_parts"] == 0:
+        return 0, None
+
+    queue_state["generation"] += 1
+    queue_state["cancel_event"].set()
+    queue_state["cancel_event"] = asyncio.Event()
+    in_flight_part = queue_state["in_flight_part"]
+    cancelled = queue_state["pending_parts"] - (1 if in_flight_part and in_flight_part != "text" else 0)
+    logging.info("Отмена отправки в чат %s: будет пропущено частей: %d.", chat_id, cancelled)
+    return cancelled, None
+
+async def _cancel_sends_on_incoming_message(event):
+    """
+    Отменяет недоотправленный ответ, если собеседник написал новое сообщение. В группах
+    учитываются только сообщения, которые отвечают на сообщение аккаунта или упоминают его
+    (Telegram отмечает их как mentioned), иначе в активной группе отменялся бы каждый ответ.
+    """
+    send_queues = get_account().send_queues
+    queue_state = send_queues.get(event.chat_id)
+    if not (queue_state and queue_state["cancel_on_new_message"] and queue_state["pending_parts"] > 0):
+        return
+    if not event.is_private and not getattr(event.message, 'mentioned', False):
+        return
+    logging.info("В чате %s пришло новое сообщение во время отправки ответа.", event.chat_id)
+    await cancel_pending_sends(event.chat_id)
+
+async def _execute_send_task(chat_id, task, settings, typing_head_start_s=0.0, cancel_event=None):
+    """Выполняет одну задачу плана отправки. Возвращает (success, error_message)."""
+    if task["type"] == "text":
+        logging.info("Отправка текста в чат %s (%d симв.).", chat_id, len(task["content"]))
+        logging.debug("Текст для чата %s: \"%.50s...\"", chat_id, task["content"])
+        return await send_telegram_message(chat_id, task["content"], settings=settings,
+                                           typing_head_start_s=typing_head_start_s, cancel_event=cancel_event)
+
+    if task["type"] == "sticker":
+        logging.info("Отправка стикера '%s' в чат %s.", task["content"], chat_id)
+        success, error_message = await send_sticker_by_codename(chat_id, task["content"], settings=settings)
+        if success and error_message:
+            logging.warning("Задача отправки стикера '%s' пропущена: %s", task['content'], error_message)
+        return success, error_message
+
+    if task["type"] == "reaction":
+        logging.info("Отправка реакции '%s' на сообщение %s в чат %s.", task["emoji"], task["message_id"], chat_id)
+        success, error_message = await send_telegram_reaction(chat_id, task["message_id"], task["emoji"])
+        if success and error_message:
+            logging.warning("Задача отправки реакции '%s' пропущена: %s", task['emoji'], error_message)
+        return success, error_message
+
+    return False, f"Unknown send task type: {task['type']}"
+
+async def execute_send_plan(chat_id, tasks, settings=None, cancel_on_new_message=False):
+    """
+    Выполняет план отправки (тексты, стикеры, реакции) через очередь чата.
+    Планы одного чата выполняются строго по порядку постановки в очередь,
+    планы разных чатов - параллельно. Недоотправленные части можно отменить
+    через cancel_pending_sends.
+    Возвращает (bool: success, str: error_message | None).
+    """
+    plan_started = time.perf_counter()
+    outcome = "error"
+    try:
+        with span("execute_send_plan", parts=len(tasks)) as plan_span:
+            success, error_message = await _execute_send_plan(chat_id, tasks, settings, cancel_on_new_message)
+            if success:
+                outcome = "cancelled" if error_message else "ok"
+            else:
+                plan_span.fail(error_message)
+            plan_span.set(outcome=outcome)
+        return success, error_message
+    finally:
+        SEND_PLAN_SECONDS.observe(time.perf_counter() - plan_started, outcome=outcome)
+
+async def _execute_send_plan(chat_id, tasks, settings, cancel_on_new_message):
+    generation_typing = get_account().generation_typing
+    settings_dict = settings if isinstance(settings, dict) else {}
+    queue_state = _get_send_queue(chat_id)
+    generation = queue_state["generation"]
+    cancel_event = queue_state["cancel_event"]
+    plan_estimate_s = estimate_send_plan_duration(tasks, settings_dict)
+    remaining_parts = len(tasks)
+    held_typing = None
+
+    queue_state["pending_plans"] += 1
+    queue_state["pending_parts"] += remaining_parts
+    queue_state["queued_estimate_s"] += plan_estimate_s
+    if queue_state["pending_plans"] > 1:
+        logging.info("План отправки в чат %s поставлен в очередь (планов в очереди: %s).", chat_id, queue_state['pending_plans'])
+
+    try:
+        async with queue_state["lock"]:
+            queue_state["cancel_on_new_message"] = cancel_on_new_message
+
+            # Индикатор печати, включенный на время генерации, остается включенным во время реакций
+            # перед первой текстовой частью, а время его показа засчитывается этой части.
+            # Если текста нет или перед ним стоит стикер, индикатор снимается сразу.
+            first_text_index = next((i for i, task in enumerate(tasks) if task["type"] == "text"), None)
+            held_typing = generation_typing.get(chat_id)
+            if held_typing and (first_text_index is None
+                                or any(task["type"] != "reaction" for task in tasks[:first_text_index])):
+                await stop_generation_typing(chat_id)
+                held_typing = None
+
+            for i, task in enumerate(tasks):
+                if queue_state["generation"] != generation:
+                    logging.info("План отправки в чат %s отменен. Пропущено частей: %s.", chat_id, remaining_parts)
+                    queue_state["cancelled_parts"] += remaining_parts
+                    return True, f"Send plan cancelled ({remaining_parts} parts skipped)."
+
+                typing_head_start_s = 0.0
+                if i == first_text_index and held_typing:
+                    typing_head_start_s, _ = await stop_generation_typing(chat_id, cancel_indicator=False)
+                    held_typing = None
+
+                queue_state["in_flight_part"] = task["type"]
+                queue_state["in_flight_since"] = time.monotonic()
+                try:
+                    with span("send_task", index=i, type=task["type"]) as task_span:
+                        success, error_message = await _execute_send_task(
+                            chat_id, task, settings_dict, typing_head_start_s=typing_head_start_s,
+                            cancel_event=cancel_event
+                        )
+                        if not success:
+                            task_span.fail(error_message)
+                finally:
+                    queue_state["in_flight_part"] = None
+                    queue_state["in_flight_since"] = None
+                    remaining_parts -= 1
+                    queue_state["pending_parts"] -= 1
+
+                if success and error_message == SEND_CANCELLED_MESSAGE:
+                    skipped_parts = remaining_parts + 1
+                    logging.info("План отправки в чат %s отменен во время печати. Пропущено частей: %d.", chat_id, skipped_parts)
+                    queue_state["cancelled_parts"] += skipped_parts
+                    return True, f"Send plan cancelled ({skipped_parts} parts skipped)."
+
+                if not success:
+                    logging.error("Ошибка отправки задачи %s (%s) в чат %s: %s", i+1, task['type'], chat_id, error_message)
+                    return False, error_message
+                queue_state["sent_parts"] += 1
+
+                if i < len(tasks) - 1:
+                    next_type = tasks[i+1]["type"]
+                    if task["type"] == "reaction" and next_type == "reaction":
+                        delay = random.uniform(0.3, 0.8)
+                        logging.info("Короткая пауза между реакциями: %.2f сек.", delay)
+                    else:
+                        min_pause = settings_dict.get('base_thinking_delay_s_min', 1.0)
+                        max_pause = settings_dict.get('base_thinking_delay_s_max', 2.0)
+                        if max_pause < min_pause: max_pause = min_pause
+                        delay = random.uniform(min_pause, max_pause)
+                        logging.info("Пауза перед следующей частью: %.2f сек.", delay)
+
+                    if delay > 0.05:
+                        await asyncio.sleep(delay)
+
+            return True, None
+    finally:
+        # План отменен или прерван ошибкой до первой текстовой части: индикатор больше не нужен.
+        if held_typing and generation_typing.get(chat_id) is held_typing:
+            await stop_generation_typing(chat_id)
+        queue_state["pending_plans"] -= 1
+        queue_state["pending_parts"] -= remaining_parts
+        queue_state["queued_estimate_s"] = max(0.0, queue_state["queued_estimate_s"] - plan_estimate_s)
+        if queue_state["pending_plans"] == 0:
+            queue_state["cancel_on_new_message"] = False
+
 async def disconnect_telegram():
-    """Отключается от Telegram (выполняется в цикле telegram_loop)."""
-    global client
-    if client and client.is_connected():
-        logging.info("Отключение от Telegram в выделенном цикле...")
-        await client.disconnect()
-        logging.info("Отключено.")
-    client = None
-
-async def telegram_main_loop(api_id, api_hash, session_name, ready_event):
-    global telegram_loop, client
-    telegram_loop = asyncio.get_running_loop()
-    logging.info(f"Цикл событий Telethon запущен: {telegram_loop}")
+    """Отключает от Telegram все аккаунты (выполняется в цикле telegram_loop)."""
+    for account in ACCOUNTS.values():
+        if account.is_connected():
+            logging.info("Отключение аккаунта '%s' от Telegram в выделенном цикле...", account.name)
+            await account.client.disconnect()
+            logging.info("Отключено.")
+        account.client = None
+
+def has_connected_accounts():
+    """True, если хотя бы один аккаунт подключен к Telegram."""
+    return any(account.is_connected() for account in ACCOUNTS.values())
+
+async def _start_account(account, api_id, api_hash):
+    """
+    Подключает аккаунт и запускает его фоновые задачи и обработчики событий.
+    Выполняется в контексте этого аккаунта, поэтому задачи, созданные здесь, видят его через get_account().
+    """
+    current_account.set(account)
+    client = await connect_telegram(account, api_id, api_hash)
+    if not client:
+        return None
 
-    client = await connect_telegram(api_id, api_hash, session_name)
+    asyncio.create_task(update_online_status_periodically(client))
+    logging.info("Фоновая задача для поддержания статуса 'online' аккаунта '%s' запущена.", account.name)
 
-    if client:
-        logging.info(">>> Клиент готов к работе в режиме активных запросов.")
-        
-        asyncio.create_task(update_online_status_periodically(client))
-        logging.info("Фоновая задача для поддержания статуса 'online' запущена.")
+    client.add_event_handler(_for_account(account, _cancel_sends_on_incoming_message), events.NewMessage(incoming=True))
+    client.add_event_handler(_for_account(account, _update_dialog_list_on_message), events.NewMessage())
+    client.add_event_handler(_for_account(account, _mark_dialog_list_dirty), events.ChatAction())
+    client.add_event_handler(_for_account(account, _invalidate_entities_on_update),
+                             events.Raw(types=[UpdateUserName, UpdateUser, UpdateChat, UpdateChannel]))
+
+    asyncio.create_task(refresh_dialog_list_periodically(client))
+    return client
+
+async def telegram_main_loop(api_id, api_hash, accounts, ready_event):
+    """
+    Подключает все аккаунты (по очереди, чтобы запросы авторизации в консоли не смешивались)
+    и работает, пока подключен хотя бы один из них. Все клиенты используют один цикл telegram_loop.
+    """
+    global telegram_loop
+    telegram_loop = asyncio.get_running_loop()
+    logging.info("Цикл событий Telethon запущен: %s", telegram_loop)
+    lag_probe_task = asyncio.create_task(probe_loop_lag())
+
+    clients = []
+    for account in accounts:
+        ACCOUNTS[account.key] = account
+        client = await asyncio.create_task(_start_account(account, api_id, api_hash))
+        if client:
+            clients.append(client)
+        else:
+            logging.error("Не удалось подключить аккаунт '%s' к Telegram.", account.name)
 
+    if clients:
+        logging.info(">>> Подключено аккаунтов: %s из %s. Клиенты готовы к работе в режиме активных запросов.", len(clients), len(accounts))
         ready_event.set()
-        await client.run_until_disconnected()
+        await asyncio.gather(*(client.run_until_disconnected() for client in clients))
     else:
         logging.error("Не удалось подключиться к Telegram. Поток завершается.")
         ready_event.set()
 
+    lag_probe_task.cancel()
     logging.info("Поток Telethon завершает работу.")
 
+async def probe_loop_lag(interval_s=LOOP_LAG_PROBE_INTERVAL_S):
+    """
+    Раз в interval_s секунд замеряет, насколько позже запланированного просыпается цикл telegram_loop.
+    Большой лаг значит, что цикл занят синхронной работой; если проба давно не отмечалась
+    (LOOP_STALLED_AFTER_S), цикл завис, и /healthz отвечает 503.
+    """
+    loop = asyncio.get_running_loop()
+    loop_lag_state["checked_at"] = time.time()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval_s)
+        lag_s = max(0.0, loop.time() - started - interval_s)
+        loop_lag_state["lag_s"] = lag_s
+        loop_lag_state["max_lag_s"] = max(loop_lag_state["max_lag_s"], lag_s)
+        loop_lag_state["checked_at"] = time.time()
+        TELEGRAM_LOOP_LAG_SECONDS.observe(lag_s)
+
+def get_telegram_health():
+    """
+    Состояние Telegram для /healthz и /readyz: работает ли цикл telegram_loop и его лаг,
+    а по каждому аккаунту - подключение, время последнего успешного запроса и размер очередей отправки.
+    """
+    now = time.time()
+    checked_at = loop_lag_state["checked_at"]
+    probe_age_s = now - checked_at if checked_at else None
+    loop_running = bool(telegram_loop and telegram_loop.is_running())
+    accounts = {}
+    for key, account in list(ACCOUNTS.items()):
+        send_queues = list(account.send_queues.values())
+        accounts[key] = {
+            "name": account.name,
+            "connected": account.is_connected(),
+            "last_rpc_at": account.last_rpc_at,
+            "last_rpc_age_s": round(now - account.last_rpc_at, 1) if account.last_rpc_at else None,
+            "send_queue": {
+                "chats": len(send_queues),
+                "pending_plans": sum(state["pending_plans"] for state in send_queues),
+                "pending_parts": sum(state["pending_parts"] for state in send_queues),
+            },
+        }
+    return {
+        "loop_running": loop_running,
+        "loop_responsive": loop_running and probe_age_s is not None and probe_age_s < LOOP_STALLED_AFTER_S,
+        "loop_lag_ms": round(loop_lag_state["lag_s"] * 1000.0, 1) if loop_lag_state["lag_s"] is not None else None,
+        "loop_max_lag_ms": round(loop_lag_state["max_lag_s"] * 1000.0, 1),
+        "loop_probe_age_s": round(probe_age_s, 1) if probe_age_s is not None else None,
+        "accounts": accounts,
+    }
+
+TELEGRAM_LOOP_ERROR_RESULTS = {
+    'get_chats': ([], "Telegram event loop not available or not running."),
+    'get_cached_chats': ([], "Telegram event loop not available or not running."),
+    'get_chat_info': (None, "Telegram event loop not available or not running."),
+    'get_formatted_history': ([], "Telegram event loop not available or not running."),
+    'get_history_page': ({"messages": [], "fetched_count": 0, "next_offset_id": None}, "Telegram event loop not available or not running."),
+    'send_telegram_message': (False, "Telegram event loop not available or not running."),
+    'execute_send_plan': (False, "Telegram event loop not available or not running."),
+    'cancel_pending_sends': (0, "Telegram event loop not available or not running."),
+    'stop_generation_typing': (0.0, "Telegram event loop not available or not running."),
+}
+
+# Операции, которые могут обойтись кэшем или локальными очередями без запроса к Telegram:
+# их успех не считается успешным обращением к Telegram (last_rpc_at для /readyz).
+LOCAL_TELEGRAM_OPERATIONS = frozenset({
+    'get_cached_chats', 'get_chat_info', 'cancel_pending_sends', 'start_generation_typing', 'stop_generation_typing',
+})
+
+def _record_rpc_result(coro_name, result):
+    """Обновляет last_rpc_at текущего аккаунта, если операция обращалась к Telegram и вернула (данные, None)."""
+    if (coro_name not in LOCAL_TELEGRAM_OPERATIONS and isinstance(result, tuple)
+            and len(result) == 2 and result[1] is None):
+        account = get_account()
+        if account:
+            account.last_rpc_at = time.time()
+    return result
+
+async def _measure_queue_delay(coro, coro_name, submitted_at):
+    """Отмечает, сколько корутина ждала начала выполнения в цикле Telethon, и выполняет ее."""
+    TELEGRAM_LOOP_QUEUE_SECONDS.observe(time.perf_counter() - submitted_at, operation=coro_name)
+    return _record_rpc_result(coro_name, await coro)
+
 def run_in_telegram_loop(coro, timeout=60):
     """
     Выполняет корутину в цикле событий потока Telethon и возвращает результат.
     Блокирует вызывающий поток Flask до получения результата.
     """
-    default_error_results = {
-        'get_chats': ([], "Telegram event loop not available or not running."),
-        'get_chat_info': (None, "Telegram event loop not available or not running."),
-        'get_formatted_history': ([], "Telegram event loop not available or not running."),
-        'send_telegram_message': (False, "Telegram event loop not available or not running."),
-    }
+    default_error_results = TELEGRAM_LOOP_ERROR_RESULTS
     coro_name = getattr(coro, '__name__', 'unknown')
 
     if not telegram_loop or not telegram_loop.is_running():
         logging.error(f"{coro_name}: Цикл событий Telethon не запущен или недоступен.")
         return default_error_results.get(coro_name, (None, "Telegram event loop not available or not running."))
 
-    global client
     if coro_name != 'connect_telegram':
-        if not client or not client.is_connected():
+        account = get_account()
+        if not account or not account.is_connected():
              logging.warning(f"{coro_name}: Попытка выполнить задачу, когда клиент не подключен.")
              error_msg = "Telegram client is not connected."
              return default_error_results.get(coro_name, (None, error_msg))
 
 
-    future = asyncio.run_coroutine_threadsafe(coro, telegram_loop)
+    future = asyncio.run_coroutine_threadsafe(_measure_queue_delay(coro, coro_name, time.perf_counter()), telegram_loop)
     try:
         result = future.result(timeout=timeout)
         return result
     except asyncio.TimeoutError:
          logging.error(f"Операция '{coro_name}' в потоке Telethon заняла слишком много времени (>{timeout}s).")
+         TELEGRAM_LOOP_TIMEOUTS.inc(operation=coro_name)
          telegram_loop.call_soon_threadsafe(future.cancel)
          error_msg = f"Telegram operation '{coro_name}' timed out."
          return default_error_results.get(coro_name, (None, error_msg))
@@ -1264,3 +1628,69 @@ def run_in_telegram_loop(coro, timeout=60):
         logging.exception(f"Ошибка при выполнении/получении результата '{coro_name}' из потока Telethon: {e}")
         error_msg = f"Error during '{coro_name}' execution in Telegram thread: {e}"
         return default_error_results.get(coro_name, (None, error_msg))
+
+def stream_in_telegram_loop(async_iterable, timeout=120):
+    """
+    Синхронный генератор поверх асинхронного генератора, который выполняется в цикле
+    событий Telethon: элементы передаются вызывающему потоку Flask по мере готовности.
+    Если потребитель прекращает чтение (например, клиент закрыл соединение),
+    асинхронный генератор отменяется.
+    """
+    if not telegram_loop or not telegram_loop.is_running():
+        logging.error("stream_in_telegram_loop: Цикл событий Telethon не запущен или недоступен.")
+        return
+
+    results = queue.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for item in async_iterable:
+                results.put(item)
+        except Exception as e:
+            logging.exception("Ошибка в потоковой задаче цикла Telethon: %s", e)
+        finally:
+            results.put(finished)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), telegram_loop)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            item = results.get(timeout=max(0.0, deadline - time.monotonic()))
+            if item is finished:
+                return
+            yield item
+    except queue.Empty:
+        logging.error("Потоковая операция в цикле Telethon заняла слишком много времени (>%ss).", timeout)
+    finally:
+        if not future.done():
+            telegram_loop.call_soon_threadsafe(future.cancel)
+
+async def await_in_telegram_loop(coro, timeout=60):
+    """
+    Асинхронный аналог run_in_telegram_loop для кода, который уже выполняется
+    в цикле событий Telethon (ASGI-режим): корутина ожидается напрямую, без
+    перехода между потоками. Ошибки и таймауты возвращаются так же, как в run_in_telegram_loop.
+    """
+    default_error_results = TELEGRAM_LOOP_ERROR_RESULTS
+    coro_name = getattr(coro, '__name__', 'unknown')
+
+    if coro_name != 'connect_telegram':
+        account = get_account()
+        if not account or not account.is_connected():
+            logging.warning("%s: Попытка выполнить задачу, когда клиент не подключен.", coro_name)
+            coro.close()
+            error_msg = "Telegram client is not connected."
+            return default_error_results.get(coro_name, (None, error_msg))
+
+    try:
+        return _record_rpc_result(coro_name, await asyncio.wait_for(coro, timeout=timeout))
+    except asyncio.TimeoutError:
+        logging.error("Операция '%s' в цикле Telethon заняла слишком много времени (>%ss).", coro_name, timeout)
+        TELEGRAM_LOOP_TIMEOUTS.inc(operation=coro_name)
+        error_msg = f"Telegram operation '{coro_name}' timed out."
+        return default_error_results.get(coro_name, (None, error_msg))
+    except Exception as e:
+        logging.exception("Ошибка при выполнении '%s' в цикле Telethon: %s", coro_name, e)
+        error_msg = f"Error during '{coro_name}' execution in Telegram loop: {e}"
+        return default_error_results.get(coro_name, (None, error_msg))
@@ -0,0 +1,579 @@
+import re
+import os
+import random
+import string
+import pickle
+import logging
+import importlib.util
+import numpy as np
+
+TOKEN_WORD = "word"
+TOKEN_SPACE = "space"
+TOKEN_PUNCT = "punct"
+TOKEN_EMOJI = "emoji"
+
+MAX_CHAR_REPEAT = 45
+CHAR_REPEAT_KEEP = 25
+MAX_EMOJI_REPEAT = 5
+MAX_EMOJI_RUN = 14
+
+EMOJI_TRIE_CACHE_FILE = "data/emoji_trie.pickle"
+_TRIE_END = ""
+_emoji_trie = None
+_emoji_start_pattern = None
+
+RU_LOWER = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+RU_UPPER = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+RU_ALPHABET = set(RU_LOWER + RU_UPPER)
+
+EN_LOWER = string.ascii_lowercase
+EN_UPPER = string.ascii_uppercase
+EN_ALPHABET = set(EN_LOWER + EN_UPPER)
+
+RU_TYPO_SUBSTITUTIONS = {
+    '.': ['ж', 'ю'],
+    '\\': ['ъ'],
+    'А': ['К', 'М', 'В', 'П'],
+    'Б': ['Л', 'Ь', 'Ю'],
+    'В': ['У', 'С', 'Ы', 'А'],
+    'Г': ['О', 'Н', 'Ш'],
+    'Д': ['Щ', 'Ю', 'Л', 'Ж'],
+    'Е': ['П', 'К', 'Н'],
+    'Ж': ['З', '.', 'Д', 'Э'],
+    'З': ['Ж', 'Щ', 'Х'],
+    'И': ['П', 'М', 'Т'],
+    'Й': ['Ф', 'Ц'],
+    'К': ['А', 'У', 'Е'],
+    'Л': ['Ш', 'Б', 'О', 'Д'],
+    'М': ['А', 'С', 'И'],
+    'Н': ['Р', 'Е', 'Г'],
+    'О': ['Г', 'Ь', 'Р', 'Л'],
+    'П': ['Е', 'И', 'А', 'Р'],
+    'Р': ['Н', 'Т', 'П', 'О'],
+    'С': ['В', 'Ч', 'М'],
+    'Т': ['Р', 'И', 'Ь'],
+    'У': ['В', 'Ц', 'К'],
+    'Ф': ['Й', 'Я', 'Ы'],
+    'Х': ['Э', 'З', 'Ъ'],
+    'Ц': ['Ы', 'Й', 'У'],
+    'Ч': ['Ы', 'Я', 'С'],
+    'Ш': ['Л', 'Г', 'Щ'],
+    'Щ': ['Д', 'Ш', 'З'],
+    'Ъ': ['Х', '\\'],
+    'Ы': ['Ц', 'Ч', 'Ф', 'В'],
+    'Ь': ['О', 'Т', 'Б'],
+    'Э': ['Х', 'Ж'],
+    'Ю': ['Д', 'Б', '.'],
+    'Я': ['Ф', 'Ч'],
+    'а': ['к', 'м', 'в', 'п'],
+    'б': ['л', 'ь', 'ю'],
+    'в': ['у', 'с', 'ы', 'а'],
+    'г': ['о', 'н', 'ш'],
+    'д': ['щ', 'ю', 'л', 'ж'],
+    'е': ['п', 'к', 'н'],
+    'ж': ['з', '.', 'д', 'э'],
+    'з': ['ж', 'щ', 'х'],
+    'и': ['п', 'м', 'т'],
+    'й': ['ф', 'ц'],
+    'к': ['а', 'у', 'е'],
+    'л': ['ш', 'б', 'о', 'д'],
+    'м': ['а', 'с', 'и'],
+    'н': ['р', 'е', 'г'],
+    'о': ['г', 'ь', 'р', 'л'],
+    'п': ['е', 'и', 'а', 'р'],
+    'р': ['н', 'т', 'п', 'о'],
+    'с': ['в', 'ч', 'м'],
+    'т': ['р', 'и', 'ь'],
+    'у': ['в', 'ц', 'к'],
+    'ф': ['й', 'я', 'ы'],
+    'х': ['э', 'з', 'ъ'],
+    'ц': ['ы', 'й', 'у'],
+    'ч': ['ы', 'я', 'с'],
+    'ш': ['л', 'г', 'щ'],
+    'щ': ['д', 'ш', 'з'],
+    'ъ': ['х', '\\'],
+    'ы': ['ц', 'ч', 'ф', 'в'],
+    'ь': ['о', 'т', 'б'],
+    'э': ['х', 'ж'],
+    'ю': ['д', 'б', '.'],
+    'я': ['ф', 'ч']
+}
+
+EN_TYPO_SUBSTITUTIONS = {
+    'A': ['Q', 'Z', 'S'],
+    'B': ['G', 'V', 'N'],
+    'C': ['D', 'X', 'V'],
+    'D': ['E', 'C', 'S', 'F'],
+    'E': ['D', 'W', 'R'],
+    'F': ['R', 'V', 'D', 'G'],
+    'G': ['T', 'B', 'F', 'H'],
+    'H': ['Y', 'N', 'G', 'J'],
+    'I': ['K', 'U', 'O'],
+    'J': ['U', 'M', 'H', 'K'],
+    'K': ['I', ',', 'J', 'L'],
+    'L': ['O', '.', 'K', ';'],
+    'M': ['J', 'N', ','],
+    'N': ['H', 'B', 'M'],
+    'O': ['L', 'I', 'P'],
+    'P': [';', 'O', '['],
+    'Q': ['A', 'W'],
+    'R': ['F', 'E', 'T'],
+    'S': ['W', 'X', 'A', 'D'],
+    'T': ['G', 'R', 'Y'],
+    'U': ['J', 'Y', 'I'],
+    'V': ['F', 'C', 'B'],
+    'W': ['S', 'Q', 'E'],
+    'X': ['S', 'Z', 'C'],
+    'Y': ['H', 'T', 'U'],
+    'Z': ['A', 'X'],
+    'a': ['q', 'z', 's'],
+    'b': ['g', 'v', 'n'],
+    'c': ['d', 'x', 'v'],
+    'd': ['e', 'c', 's', 'f'],
+    'e': ['d', 'w', 'r'],
+    'f': ['r', 'v', 'd', 'g'],
+    'g': ['t', 'b', 'f', 'h'],
+    'h': ['y', 'n', 'g', 'j'],
+    'i': ['k', 'u', 'o'],
+    'j': ['u', 'm', 'h', 'k'],
+    'k': ['i', ',', 'j', 'l'],
+    'l': ['o', '.', 'k', ';'],
+    'm': ['j', 'n', ','],
+    'n': ['h', 'b', 'm'],
+    'o': ['l', 'i', 'p'],
+    'p': [';', 'o', '['],
+    'q': ['a', 'w'],
+    'r': ['f', 'e', 't'],
+    's': ['w', 'x', 'a', 'd'],
+    't': ['g', 'r', 'y'],
+    'u': ['j', 'y', 'i'],
+    'v': ['f', 'c', 'b'],
+    'w': ['s', 'q', 'e'],
+    'x': ['s', 'z', 'c'],
+    'y': ['h', 't', 'u'],
+    'z': ['a', 'x']
+}
+
+RU_TYPO_TRANSPOSITIONS = [
+    "ст", "тс", "ол", "ло", "ть", "ьт", "но", "он", "ер", "ре",
+    "ов", "во", "пр", "рп", "на", "ан", "ко", "ок", "то", "от", "ет", "те",
+    "СТ", "ТС", "ОЛ", "ЛО", "ТЬ", "ЬТ", "НО", "ОН", "ЕР", "РЕ",
+    "ОВ", "ВО", "ПР", "РП", "НА", "АН", "КО", "ОК", "ТО", "ОТ", "ЕТ", "ТЕ"
+]
+
+EN_TYPO_TRANSPOSITIONS = [
+    "on", "no", "re", "er", "th", "ht", "in", "ni", "at", "ta",
+    "en", "ne", "es", "se", "ou", "uo", "is", "si", "of", "fo", "he", "eh",
+    "ON", "NO", "RE", "ER", "TH", "HT", "IN", "NI", "AT", "TA",
+    "EN", "NE", "ES", "SE", "OU", "UO", "IS", "SI", "OF", "FO", "HE", "EH"
+]
+
+ALL_TYPO_TRANSPOSITIONS_SET = frozenset(RU_TYPO_TRANSPOSITIONS + EN_TYPO_TRANSPOSITIONS)
+
+# Итоговая таблица замен: для букв - соседние клавиши той же раскладки,
+# для знаков препинания приоритет у русской раскладки (как и раньше).
+TYPO_SUBSTITUTIONS = {
+    char: tuple(typos)
+    for table in (EN_TYPO_SUBSTITUTIONS, RU_TYPO_SUBSTITUTIONS)
+    for char, typos in table.items()
+    if typos and (not char.isalnum() or char in RU_ALPHABET or char in EN_ALPHABET)
+}
+
+_WHITESPACE_CHARS = ' \t\n\r'
+_SENTENCE_END_CHARS = '.?!'
+
+# Столбцы массива случайных чисел, который генерируется один раз на сообщение.
+_DRAW_LOWER, _DRAW_TRANSPOSE, _DRAW_SKIP, _DRAW_SUBSTITUTE, _DRAW_CHOICE = range(5)
+_DRAW_COLUMNS = 5
+
+_default_rng = np.random.default_rng()
+
+def _is_after_sentence_end(text: str, index: int) -> bool:
+    """True, если перед позицией index (без учета пробелов) начало текста или конец предложения."""
+    i = index - 1
+    while i >= 0 and text[i] in _WHITESPACE_CHARS:
+        i -= 1
+    return i < 0 or text[i] in _SENTENCE_END_CHARS
+
+def _can_transpose(char: str, next_char: str) -> bool:
+    if char + next_char in ALL_TYPO_TRANSPOSITIONS_SET:
+        return True
+    if char.isalpha() and next_char.isalpha():
+        return (char in RU_ALPHABET and next_char in RU_ALPHABET) or \
+               (char in EN_ALPHABET and next_char in EN_ALPHABET)
+    return char.isdigit() and next_char.isdigit()
+
+def make_human_like_typos(text: str,
+                    substitution_chance=0.005,
+                    transposition_chance=0.005,
+                    skip_chance=0.002,
+                    lower_chance=0.01,
+                    rng=None) -> str:
+    """
+    Добавляет в текст человекоподобные опечатки для русского и английского языков,
+    cтрого избешая замены букв одного языка на буквы другого.
+
+    Все случайные числа для сообщения берутся одним массивом NumPy, после чего
+    посимвольно обрабатываются только позиции, где сработала хотя бы одна вероятность;
+    остальной текст копируется срезами.
+
+    Args:
+        text: Исходный текст.
+        substitution_chance: Вероятность замены буквы на соседнюю по той же ракадке (на символ).
+        transposition_chance: Вероятность перестановки двух соседних букв (на символ).
+        skip_chance: Вероятность пропуска (удаления) буквы или цифры (на символ).
+        lower_chance: Вероятность написать заглавную букву в начале предложения строчной.
+        rng: numpy.random.Generator для воспроизводимого результата (по умолчанию общий генератор модуля).
+
+    Returns:
+        Текст с возможными опечатками.
+    """
+    if not text:
+        return text
+    if rng is None:
+        rng = _default_rng
+
+    draws = rng.random((len(text), _DRAW_COLUMNS))
+    thresholds = np.array([lower_chance, transposition_chance, skip_chance, substitution_chance, 1.0])
+    hits = draws < thresholds
+    candidates = np.flatnonzero(hits[:, :_DRAW_CHOICE].any(axis=1))
+    if candidates.size == 0:
+        return text
+
+    new_chars = []
+    copied_until = 0
+    for i in candidates.tolist():
+        if i < copied_until:
+            continue
+        char = text[i]
+        row = hits[i]
+        new_chars.append(text[copied_until:i])
+        copied_until = i + 1
+
+        if row[_DRAW_LOWER] and char.isupper() and _is_after_sentence_end(text, i):
+            char = char.lower()
+
+        if row[_DRAW_TRANSPOSE] and i + 1 < len(text) and _can_transpose(char, text[i + 1]):
+            new_chars.append(text[i + 1])
+            new_chars.append(char)
+            copied_until = i + 2
+
+        elif char.isalnum() and row[_DRAW_SKIP]:
+            pass
+
+        elif row[_DRAW_SUBSTITUTE] and char in TYPO_SUBSTITUTIONS:
+            possible_typos = TYPO_SUBSTITUTIONS[char]
+            new_chars.append(possible_typos[int(draws[i, _DRAW_CHOICE] * len(possible_typos))])
+
+        else:
+            new_chars.append(char)
+
+    new_chars.append(text[copied_until:])
+    return "".join(new_chars)
+
+def _emoji_data_key():
+    """Ключ версии словаря emoji: путь и mtime установленного пакета (без его импорта)."""
+    spec = importlib.util.find_spec("emoji")
+    if spec is None or not spec.origin:
+        return None
+    return spec.origin, os.path.getmtime(spec.origin)
+
+def _build_emoji_trie() -> dict:
+    """Строит префиксное дерево по всем последовательностям из emoji.EMOJI_DATA."""
+    import emoji
+
+    trie = {}
+    for sequence in emoji.EMOJI_DATA:
+        node = trie
+        for char in sequence:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = True
+    return trie
+
+def _char_class_pattern(chars) -> str:
+    """Собирает компактный класс символов вида [a-cx-z] из набора символов."""
+    ranges = []
+    for code in sorted(ord(char) for char in chars if char):
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return "[{}]".format("".join(
+        re.escape(chr(first)) if first == last else f"{re.escape(chr(first))}-{re.escape(chr(last))}"
+        for first, last in ranges
+    ))
+
+def load_emoji_trie():
+    """
+    Возвращает (trie, start_pattern) для поиска эмодзи.
+    Дерево строится при первом обращении и кэшируется на диске в EMOJI_TRIE_CACHE_FILE;
+    кэш пересобирается, если изменилась установленная версия пакета emoji.
+    start_pattern - класс символов, с которых может начинаться эмодзи.
+    """
+    global _emoji_trie, _emoji_start_pattern
+    if _emoji_trie is not None:
+        return _emoji_trie, _emoji_start_pattern
+
+    data_key = _emoji_data_key()
+    trie = None
+    try:
+        with open(EMOJI_TRIE_CACHE_FILE, 'rb') as f:
+            cached = pickle.load(f)
+        if data_key is not None and cached.get("key") == data_key:
+            trie = cached["trie"]
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError) as e:
+        logging.warning(f"Не удалось прочитать кэш эмодзи {EMOJI_TRIE_CACHE_FILE}, он будет пересобран: {e}")
+
+    if trie is None:
+        trie = _build_emoji_trie()
+        try:
+            os.makedirs(os.path.dirname(EMOJI_TRIE_CACHE_FILE), exist_ok=True)
+            with open(EMOJI_TRIE_CACHE_FILE, 'wb') as f:
+                pickle.dump({"key": data_key, "trie": trie}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logging.error(f"Не удалось сохранить кэш эмодзи {EMOJI_TRIE_CACHE_FILE}: {e}")
+
+    _emoji_start_pattern = re.compile(_char_class_pattern(trie))
+    _emoji_trie = trie
+    return _emoji_trie, _emoji_start_pattern
+
+def _match_emoji_at(text: str, start: int, trie: dict) -> int:
+    """Возвращает конец самого длинного эмодзи, начинающегося в позиции start, или -1."""
+    node = trie
+    end = -1
+    i = start
+    n = len(text)
+    while i < n:
+        node = node.get(text[i])
+        if node is None:
+            break
+        i += 1
+        if _TRIE_END in node:
+            end = i
+    return end
+
+def find_emoji_spans(text: str) -> list[tuple[int, int]]:
+    """Находит все эмодзи в тексте (самое длинное совпадение слева направо) как пары (начало, конец)."""
+    trie, start_pattern = load_emoji_trie()
+    spans = []
+    pos = 0
+    while True:
+        candidate = start_pattern.search(text, pos)
+        if candidate is None:
+            break
+        start = candidate.start()
+        end = _match_emoji_at(text, start, trie)
+        if end == -1:
+            pos = start + 1
+        else:
+            spans.append((start, end))
+            pos = end
+    return spans
+
+def find_emoji_runs(text: str) -> list[list[tuple[int, int]]]:
+    """Группирует эмодзи, идущие вплотную друг за другом, в серии (списки пар (начало, конец))."""
+    runs = []
+    for span in find_emoji_spans(text):
+        if runs and runs[-1][-1][1] == span[0]:
+            runs[-1].append(span)
+        else:
+            runs.append([span])
+    return runs
+
+_NICKNAME_TAG = r"<\s*ник\s*:[^>\n]*>"
+_LINE_TIMESTAMP = rf"^(?:{_NICKNAME_TAG})*\[\d{{4}}-\d{{2}}-\d{{2}}\s\d{{2}}:\d{{2}}:\d{{2}}\]"
+_SPACE_OR_TAG = rf"(?:\s|{_NICKNAME_TAG})"
+_ID_GAP = rf"(?:\s|{_NICKNAME_TAG}|{_LINE_TIMESTAMP})"
+
+# Теги <ник:...> и метки времени удаляются в том же проходе, поэтому
+# в остальных шаблонах они считаются частью пробельных промежутков.
+_CLEANUP_PATTERN = re.compile(
+    rf"(?P<spurious_id>{_ID_GAP}*\({_ID_GAP}*U?ID{_ID_GAP}*:{_ID_GAP}*\d+{_ID_GAP}*\){_ID_GAP}*)"
+    rf"|(?P<timestamp>{_LINE_TIMESTAMP}{_SPACE_OR_TAG}*)"
+    rf"|(?P<nickname>{_NICKNAME_TAG})",
+    re.IGNORECASE | re.MULTILINE
+)
+
+def simulate_word_loss(text: str, chance: float, max_words: int) -> tuple[str, str]:
+    """
+    Симулирует "потерю" случайных слов в тексте.
+
+    Args:
+        text: Исходный текст.
+        chance: Вероятность того, что потеря слов произойдет (0.0 до 1.0).
+        max_words: Максимальное количество слов для удаления.
+
+    Returns:
+        Кортеж из (текст с возможными потерями, исходный полный текст).
+    """
+    if random.random() < chance:
+        words = text.split()
+        if len(words) > 4: 
+            num_to_remove = random.randint(1, min(max_words, len(words) // 3))
+            
+            lost_indices = sorted(random.sample(range(len(words)), num_to_remove), reverse=True)
+            
+            for index in lost_indices:
+                words.pop(index)
+
+            modified_text = " ".join(words)
+            return modified_text, text
+
+    return text, text
+
+def normalize_model_text(text: str) -> str:
+    """
+    Убирает из ответа модели служебные фрагменты, скопированные из истории:
+    теги <ник:...>, метки времени в начале строк и ложные "(ID: ...)".
+    Все шаблоны объединены в одно регулярное выражение и применяются за один проход.
+    """
+    text = text.replace('&quot;', '"').replace('—', '-')
+    return _CLEANUP_PATTERN.sub(lambda m: ' ' if m.lastgroup == 'spurious_id' else '', text)
+
+def _char_class(char: str) -> str:
+    if char.isspace():
+        return TOKEN_SPACE
+    if char.isalnum():
+        return TOKEN_WORD
+    return TOKEN_PUNCT
+
+def tokenize_text(text: str) -> list[tuple[str, str]]:
+    """
+    Разбивает текст на токены (тип, текст) за один проход по символам.
+    Каждый эмодзи - отдельный токен TOKEN_EMOJI, остальные символы объединяются
+    в токены слов, пробелов и пунктуации. Повторы одного символа длиннее
+    MAX_CHAR_REPEAT сокращаются до CHAR_REPEAT_KEEP прямо при разборе.
+    """
+    emoji_spans = dict(find_emoji_spans(text))
+    tokens = []
+    buffer = []
+    buffer_kind = None
+    i = 0
+    n = len(text)
+
+    while i < n:
+        emoji_end = emoji_spans.get(i)
+        if emoji_end is not None:
+            if buffer:
+                tokens.append((buffer_kind, "".join(buffer)))
+                buffer = []
+            tokens.append((TOKEN_EMOJI, text[i:emoji_end]))
+            buffer_kind = None
+            i = emoji_end
+            continue
+
+        char = text[i]
+        run_end = i + 1
+        while run_end < n and text[run_end] == char and run_end not in emoji_spans:
+            run_end += 1
+        run_length = run_end - i
+        if run_length > MAX_CHAR_REPEAT and char != '\n':
+            run_length = CHAR_REPEAT_KEEP
+
+        kind = _char_class(char)
+        if kind != buffer_kind and buffer:
+            tokens.append((buffer_kind, "".join(buffer)))
+            buffer = []
+        buffer_kind = kind
+        buffer.append(char * run_length if run_length > 1 else char)
+        i = run_end
+
+    if buffer:
+        tokens.append((buffer_kind, "".join(buffer)))
+    return tokens
+
+def tokens_to_text(tokens: list[tuple[str, str]]) -> str:
+    """Собирает текст обратно из токенов."""
+    return "".join(token_text for _, token_text in tokens)
+
+def limit_emoji_runs(tokens: list[tuple[str, str]],
+                     max_repeat: int | None = MAX_EMOJI_REPEAT,
+                     max_run: int | None = MAX_EMOJI_RUN) -> list[tuple[str, str]]:
+    """
+    Ограничивает "простыни" эмодзи: один и тот же эмодзи подряд - не больше max_repeat раз,
+    а непрерывная серия из более чем max_run эмодзи обрезается до первых max_run.
+    None отключает соответствующее ограничение.
+    """
+    result = []
+    run = []
+
+    def flush_run():
+        if max_run is not None and len(run) > max_run:
+            del run[max_run:]
+        result.extend(run)
+        run.clear()
+
+    for token in tokens:
+        if token[0] != TOKEN_EMOJI:
+            if run:
+                flush_run()
+            result.append(token)
+            continue
+
+        if max_repeat is None:
+            run.append(token)
+            continue
+        repeat_count = 0
+        for previous in reversed(run):
+            if previous[1] != token[1]:
+                break
+            repeat_count += 1
+        if repeat_count < max_repeat:
+            run.append(token)
+
+    if run:
+        flush_run()
+    return result
+
+def strip_trailing_period(tokens: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Убирает одиночную точку в конце сообщения (люди в мессенджерах ее обычно не ставят).
+    Пробелы и эмодзи после точки не мешают, многоточие не трогается.
+    """
+    for index in range(len(tokens) - 1, -1, -1):
+        kind, token_text = tokens[index]
+        if kind == TOKEN_SPACE or kind == TOKEN_EMOJI:
+            continue
+        if kind == TOKEN_PUNCT and token_text.endswith('.') and not token_text.endswith('..'):
+            tokens = list(tokens)
+            if len(token_text) == 1:
+                del tokens[index]
+            else:
+                tokens[index] = (kind, token_text[:-1])
+        break
+    return tokens
+
+def final_fine_tune_sms(comment: str,                     
+                    substitution_chance=0.005,
+                    transposition_chance=0.005,
+                    skip_chance=0.002,
+                    lower_chance=0.01,
+                    word_loss_chance=0.0,
+                    max_lost_words=0,
+                    rng=None
+                    ) -> tuple[str, str]:
+    """
+    Финальная обработка ответа модели перед отправкой: чистка служебных фрагментов,
+    ограничение повторов и эмодзи, удаление точки в конце, опечатки и "потеря" слов.
+    Текст разбирается на токены один раз, остальные шаги работают с потоком токенов.
+
+    rng - необязательный numpy.random.Generator для опечаток (см. make_human_like_typos).
+
+    Returns:
+        Кортеж из (текст для первой отправки, полный текст для исправления).
+    """
+    if not comment:
+        return "", ""
+
+    tokens = tokenize_text(normalize_model_text(comment))
+    tokens = limit_emoji_runs(tokens)
+    tokens = strip_trailing_period(tokens)
+    cleaned_comment = tokens_to_text(tokens)
+
+    text_with_typos = make_human_like_typos(cleaned_comment, substitution_chance, transposition_chance, skip_chance, lower_chance, rng=rng)
+    
+    modified_text, original_text_with_typos = simulate_word_loss(text_with_typos, word_loss_chance, max_lost_words)
+
+    return modified_text, original_text_with_typos
@@ -0,0 +1,198 @@
+"""
+Легковесная трассировка ответов авто-режима.
+
+Трасса начинается в auto_mode_worker (start_trace) и через contextvars проходит
+по всем вложенным вызовам, включая корутины, переданные в цикл Telethon
+(run_coroutine_threadsafe и create_task копируют контекст вызывающего потока).
+Вне трассы span() ничего не записывает, поэтому ручные запросы из веб-интерфейса
+трассы не создают.
+
+Каждая завершенная трасса дописывается одной строкой JSON в TRACES_FILE:
+    {"trace_id", "name", "start", "duration_ms", "attrs", "status", "spans": [...]}
+где spans - плоский список спанов со ссылками parent_id и смещением offset_ms от начала трассы.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+TRACES_FILE = 'data/traces.jsonl'
+TRACES_FILE_MAX_BYTES = 5 * 1024 * 1024
+MAX_SPANS_PER_TRACE = 500
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    span_id: str
+    parent_id: str | None
+    start: float
+    started_perf: float
+    attrs: dict = field(default_factory=dict)
+    duration_ms: float | None = None
+    status: str = "ok"
+    error: str | None = None
+    thread: str = ""
+
+    def set(self, **attrs):
+        """Добавляет атрибуты спану (значения должны сериализоваться в JSON)."""
+        self.attrs.update(attrs)
+
+    def fail(self, error):
+        self.status = "error"
+        self.error = str(error)
+
+class Trace:
+    """Спаны одной трассы. Спаны завершаются в разных потоках, поэтому список защищен блокировкой."""
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.spans = []
+        self.lock = threading.Lock()
+        self.dropped_spans = 0
+
+    def add(self, new_span):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append(new_span)
+            else:
+                self.dropped_spans += 1
+
+_current = ContextVar('current_span', default=None)
+
+def _new_span(name, parent_id, attrs):
+    return Span(name=name, span_id=uuid.uuid4().hex[:8], parent_id=parent_id, start=time.time(),
+                started_perf=time.perf_counter(), attrs=dict(attrs), thread=threading.current_thread().name)
+
+@contextmanager
+def _activate(trace, active_span):
+    token = _current.set((trace, active_span))
+    try:
+        yield active_span
+    except BaseException as e:
+        active_span.fail(str(e) or type(e).__name__)
+        raise
+    finally:
+        active_span.duration_ms = round((time.perf_counter() - active_span.started_perf) * 1000.0, 2)
+        _current.reset(token)
+
+@contextmanager
+def start_trace(name, **attrs):
+    """Начинает новую трассу с корневым спаном name; при выходе трасса записывается в TRACES_FILE."""
+    trace = Trace(name)
+    root = _new_span(name, None, attrs)
+    trace.add(root)
+    try:
+        with _activate(trace, root):
+            yield root
+    finally:
+        export_trace(trace)
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Вложенный спан текущей трассы. Если трассы нет, возвращается непривязанный спан,
+    атрибуты которого никуда не записываются.
+    """
+    current = _current.get()
+    if current is None:
+        yield _new_span(name, None, attrs)
+        return
+    trace, parent = current
+    child = _new_span(name, parent.span_id, attrs)
+    trace.add(child)
+    with _activate(trace, child):
+        yield child
+
+def current_span():
+    """Текущий спан или None вне трассы."""
+    current = _current.get()
+    return current[1] if current else None
+
+def trace_to_dict(trace):
+    with trace.lock:
+        spans = list(trace.spans)
+    root = spans[0]
+    return {
+        "trace_id": trace.trace_id,
+        "name": trace.name,
+        "start": root.start,
+        "duration_ms": root.duration_ms,
+        "attrs": root.attrs,
+        "status": root.status,
+        "dropped_spans": trace.dropped_spans,
+        "spans": [{
+            "span_id": s.span_id, "parent_id": s.parent_id, "name": s.name,
+            "offset_ms": round((s.started_perf - root.started_perf) * 1000.0, 2),
+            "duration_ms": s.duration_ms, "status": s.status, "error": s.error,
+            "thread": s.thread, "attrs": s.attrs,
+        } for s in spans],
+    }
+
+_export_lock = threading.Lock()
+
+def export_trace(trace, traces_file=None):
+    """Дописывает трассу в JSONL-файл; при превышении TRACES_FILE_MAX_BYTES файл переименовывается в .1."""
+    traces_file = traces_file or TRACES_FILE
+    try:
+        line = json.dumps(trace_to_dict(trace), ensure_ascii=False, default=str)
+        with _export_lock:
+            os.makedirs(os.path.dirname(traces_file) or '.', exist_ok=True)
+            if os.path.exists(traces_file) and os.path.getsize(traces_file) > TRACES_FILE_MAX_BYTES:
+                os.replace(traces_file, traces_file + '.1')
+            with open(traces_file, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+    except Exception as e:
+        logging.warning("Не удалось записать трассу %s: %s", trace.trace_id, e)
+
+def load_recent_traces(limit=20, traces_file=None):
+    """Последние limit трасс из JSONL-файла, от новых к старым."""
+    traces_file = traces_file or TRACES_FILE
+    if not os.path.exists(traces_file):
+        return []
+    recent = deque(maxlen=limit)
+    with open(traces_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                recent.append(line)
+    traces = []
+    for line in reversed(recent):
+        try:
+            traces.append(json.loads(line))
+        except json.JSONDecodeError:
+            logging.warning("Пропущена поврежденная строка в файле трасс.")
+    return traces
+
+def waterfall_rows(trace):
+    """
+    Спаны трассы в порядке обхода дерева (дети - по времени начала) с глубиной вложенности
+    и положением полосы в процентах от длительности трассы - для страницы /traces.
+    """
+    total_ms = trace.get("duration_ms") or 0.0
+    spans = trace.get("spans", [])
+    children = {}
+    for s in spans:
+        children.setdefault(s["parent_id"], []).append(s)
+    for siblings in children.values():
+        siblings.sort(key=lambda s: s["offset_ms"])
+
+    rows = []
+    stack = [(s, 0) for s in reversed(children.get(None, []))]
+    while stack:
+        s, depth = stack.pop()
+        duration_ms = s["duration_ms"] if s["duration_ms"] is not None else max(0.0, total_ms - s["offset_ms"])
+        rows.append({
+            **s,
+            "depth": depth,
+            "duration_ms": duration_ms,
+            "left_pct": round(100.0 * s["offset_ms"] / total_ms, 2) if total_ms else 0.0,
+            "width_pct": max(0.3, round(100.0 * duration_ms / total_ms, 2)) if total_ms else 100.0,
+        })
+        stack.extend((child, depth + 1) for child in reversed(children.get(s["span_id"], [])))
+    return rows